@@ -1,10 +1,15 @@
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Dict, Optional, Tuple
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import hashlib
 import os
+import time
 
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
 ALGORITHM = "HS256"
@@ -13,12 +18,146 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
 
+# bcrypt takes a few hundred ms of CPU (without holding the GIL), so it runs
+# in a small pool of its own: logins neither block the event loop nor take
+# the threads file I/O runs in. Hashes are counted per source (client
+# address): one source may only have a couple waiting, and once
+# MAX_PENDING_PASSWORD_HASHES are waiting in all, sources that already have
+# one are turned away. A flood from a few addresses is shed without locking
+# out everyone else.
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+MAX_PENDING_PASSWORD_HASHES = PASSWORD_HASH_WORKERS * 8
+MAX_PENDING_PASSWORD_HASHES_PER_SOURCE = 2
+
+_password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+_pending_password_hashes: Dict[str, int] = {}
+_pending_password_hashes_total = 0
+# Checked against for unknown usernames, so they take as long as wrong passwords
+_dummy_hash: Optional[str] = None
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
+async def _run_password_hash(source: str, fn, *args):
+    global _pending_password_hashes_total
+    pending = _pending_password_hashes.get(source, 0)
+    if pending >= MAX_PENDING_PASSWORD_HASHES_PER_SOURCE or (
+        pending and _pending_password_hashes_total >= MAX_PENDING_PASSWORD_HASHES
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many login attempts, try again later",
+            headers={"Retry-After": "1"},
+        )
+    _pending_password_hashes[source] = pending + 1
+    _pending_password_hashes_total += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_password_executor, fn, *args)
+    finally:
+        _pending_password_hashes_total -= 1
+        remaining = _pending_password_hashes[source] - 1
+        if remaining:
+            _pending_password_hashes[source] = remaining
+        else:
+            del _pending_password_hashes[source]
+
+async def verify_password_async(plain_password: str, hashed_password: Optional[str], source: str) -> bool:
+    """verify_password in the password pool, on behalf of `source`; a
+    missing hash (unknown user) costs the same and fails"""
+    global _dummy_hash
+    if hashed_password is None:
+        if _dummy_hash is None:
+            _dummy_hash = await _run_password_hash(source, get_password_hash, os.urandom(16).hex())
+        await _run_password_hash(source, verify_password, plain_password, _dummy_hash)
+        return False
+    return await _run_password_hash(source, verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password: str, source: str) -> str:
+    return await _run_password_hash(source, get_password_hash, password)
+
+# ===== Login throttling =====
+
+# Reverse proxies in front of the app, each appending the address it got the
+# request from to X-Forwarded-For. 0 (clients connect directly) uses the
+# connection's address, as anything in the header could be forged; the
+# Railway configs set 1 for Railway's edge.
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+
+LOGIN_WINDOW_SECONDS = 15 * 60
+# Failed logins allowed per window from one address, and for one username
+# from one address. Counting usernames per address means nobody can lock the
+# admin out from elsewhere by failing their username on purpose.
+LOGIN_FAILURES_PER_IP = 20
+LOGIN_FAILURES_PER_USER = 5
+# Addresses and usernames tracked, least recently failed forgotten first
+LOGIN_THROTTLE_MAX_KEYS = 10000
+
+def client_ip(request: Request) -> str:
+    forwarded = [part.strip() for part in request.headers.get("x-forwarded-for", "").split(",") if part.strip()]
+    if TRUSTED_PROXY_HOPS and len(forwarded) >= TRUSTED_PROXY_HOPS:
+        return forwarded[-TRUSTED_PROXY_HOPS]
+    return request.client.host if request.client else "unknown"
+
+class LoginThrottle:
+    """Failed logins per key over a sliding window, per server process"""
+
+    def __init__(self, window: float = LOGIN_WINDOW_SECONDS, max_keys: int = LOGIN_THROTTLE_MAX_KEYS):
+        self.window = window
+        self.max_keys = max_keys
+        self._failures: "OrderedDict[tuple, deque]" = OrderedDict()
+
+    def _recent(self, key: tuple, now: float) -> deque:
+        failures = self._failures.get(key)
+        if failures is None:
+            return deque()
+        while failures and failures[0] <= now - self.window:
+            failures.popleft()
+        if not failures:
+            del self._failures[key]
+        return failures
+
+    def retry_after(self, limits: Tuple[Tuple[tuple, int], ...]) -> Optional[int]:
+        """Seconds until a key under its limit again, or None if none is over"""
+        now = time.monotonic()
+        waits = []
+        for key, limit in limits:
+            failures = self._recent(key, now)
+            if len(failures) >= limit:
+                waits.append(failures[len(failures) - limit] + self.window - now)
+        return max(1, int(max(waits)) + 1) if waits else None
+
+    def fail(self, *keys: tuple):
+        now = time.monotonic()
+        for key in keys:
+            failures = self._failures.pop(key, None) or deque()
+            failures.append(now)
+            self._failures[key] = failures
+        while len(self._failures) > self.max_keys:
+            self._failures.popitem(last=False)
+
+    def clear(self, *keys: tuple):
+        for key in keys:
+            self._failures.pop(key, None)
+
+    def forgive(self, key: tuple):
+        """Take back the latest failure of a key, for an attempt that was
+        counted before it turned out to succeed"""
+        failures = self._failures.get(key)
+        if failures:
+            failures.pop()
+            if not failures:
+                del self._failures[key]
+
+login_throttle = LoginThrottle()
+
+def login_limits(ip: str, username: str) -> Tuple[Tuple[tuple, int], ...]:
+    return (("ip", ip), LOGIN_FAILURES_PER_IP), (("user", ip, username), LOGIN_FAILURES_PER_USER)
+
+# ===== Tokens =====
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -29,19 +168,59 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+# Verified tokens are remembered for a while so admin requests don't decode
+# and check the signature every time; never past the token's own expiry
+TOKEN_CACHE_SECONDS = 300
+TOKEN_CACHE_MAX_ENTRIES = 1024
+
+class TokenCache:
+    """Username by token hash, with a TTL and least recently used eviction"""
+
+    def __init__(self, ttl: float = TOKEN_CACHE_SECONDS, max_entries: int = TOKEN_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[bytes, Tuple[str, float]]" = OrderedDict()
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> Optional[str]:
+        key = self._key(token)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        username, expires_at = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return username
+
+    def add(self, token: str, username: str, token_expires_at: float):
+        self._entries[self._key(token)] = (username, min(time.time() + self.ttl, token_expires_at))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+token_cache = TokenCache()
+
+async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    token = credentials.credentials
+    username = token_cache.get(token)
+    if username is not None:
+        return username
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Could not validate credentials",
-            )
-        return username
     except JWTError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not validate credentials",
         )
+    username = payload.get("sub")
+    if username is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+        )
+    token_cache.add(token, username, payload.get("exp", float("inf")))
+    return username
@@ -0,0 +1,200 @@
+"""
+Reprocess the existing media library, e.g. after the image handler gained a
+new derivative or metadata field
+
+    python backfill.py [--workers N] [--rate N] [--missing] [--restart]
+
+Every image (and, where ffmpeg is installed, video) of every project is run
+through its media job handler in a process pool and the result is stored on
+the media item, the same way the media job worker does for new uploads. Progress is checkpointed in the
+backfill_runs collection after each batch, so an interrupted run resumes
+where it stopped (--restart starts over). To go easy on a live server the
+command runs at a lower CPU priority with few workers, and can be capped to
+a number of images per second.
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from content_store import delete_orphaned_variants
+from jobs import JOB_HANDLERS, media_fields, run_handler
+from media_store import EmbeddedMediaStore
+
+DEFAULT_WORKERS = 2
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_NICE = 10
+# _id of the checkpoint document in backfill_runs
+RUN_ID = "media"
+REPORT_INTERVAL_SECONDS = 10
+MAX_RECORDED_ERRORS = 100
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+class RateLimiter:
+    """Spaces out starts to at most `rate` per second (no limit if None)"""
+
+    def __init__(self, rate: Optional[float]):
+        self.interval = 1 / rate if rate else 0
+        self._next = 0.0
+
+    async def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        delay = self._next - now
+        self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+class Progress:
+    """Counts and a periodic throughput / ETA line"""
+
+    def __init__(self, total: int, done: int = 0, failed: int = 0):
+        self.total = total
+        self.done = done
+        self.failed = failed
+        self._resumed_at = done
+        self._started = time.monotonic()
+        self._reported = self._started
+
+    def report(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._reported < REPORT_INTERVAL_SECONDS:
+            return
+        self._reported = now
+        rate = (self.done - self._resumed_at) / max(now - self._started, 1e-6)
+        eta = format_duration((self.total - self.done) / rate) if rate > 0 else "?"
+        print(f"  {self.done}/{self.total} images ({self.failed} failed), {rate:.1f}/s, ETA {eta}")
+
+def wanted(media: dict, missing_only: bool) -> bool:
+    if media["type"] not in JOB_HANDLERS:
+        return False
+    # Images processed before dimensions and placeholders were stored
+    return not missing_only or media.get("placeholder") is None
+
+def batches(projects: List[dict], batch_size: int, missing_only: bool):
+    """(last project id, [(project id, media)]) per batch of whole projects
+    holding at least `batch_size` items, so a checkpoint never splits a project"""
+    batch: List[Tuple[str, dict]] = []
+    for project in projects:
+        batch.extend((project["id"], media) for media in project["media"] if wanted(media, missing_only))
+        if len(batch) >= batch_size:
+            yield project["id"], batch
+            batch = []
+    if projects:
+        yield projects[-1]["id"], batch
+
+async def load_checkpoint(db, restart: bool, missing_only: bool) -> dict:
+    checkpoint = await db.backfill_runs.find_one({"_id": RUN_ID})
+    if checkpoint and not restart and checkpoint.get("finished_at") is None:
+        print(f"Resuming the run started {checkpoint['started_at']:%Y-%m-%d %H:%M} "
+              f"after project {checkpoint['last_project_id']}")
+        return checkpoint
+    checkpoint = {
+        "_id": RUN_ID,
+        "last_project_id": None,
+        "missing_only": missing_only,
+        "done": 0,
+        "failed": 0,
+        "errors": [],
+        "started_at": datetime.utcnow(),
+        "updated_at": datetime.utcnow(),
+        "finished_at": None,
+    }
+    await db.backfill_runs.replace_one({"_id": RUN_ID}, checkpoint, upsert=True)
+    return checkpoint
+
+async def reprocess(db, media_store: EmbeddedMediaStore, executor: ProcessPoolExecutor,
+                    project_id: str, media: dict):
+    result = await run_handler(executor, media["type"], media["url"])
+    fields = media_fields(result, media["url"])
+    if not await media_store.update(project_id, media["id"], {**fields, "status": "ready"}):
+        # Deleted since the run started
+        await delete_orphaned_variants(db, media["url"], fields["variants"])
+
+async def backfill(db, media_store: EmbeddedMediaStore, executor: ProcessPoolExecutor,
+                   workers: int = DEFAULT_WORKERS, rate: Optional[float] = None,
+                   batch_size: int = DEFAULT_BATCH_SIZE, missing_only: bool = False,
+                   restart: bool = False) -> dict:
+    """Returns the total, done and failed image counts"""
+    checkpoint = await load_checkpoint(db, restart, missing_only)
+    missing_only = checkpoint["missing_only"]
+
+    projects = await db.projects.find({}, {"_id": 0, "id": 1, "media": 1}).sort("id", 1).to_list(None)
+    await media_store.attach(projects)
+    # Projects up to the checkpoint are done
+    last = checkpoint["last_project_id"]
+    remaining = [project for project in projects if last is None or project["id"] > last]
+
+    def count(projects: List[dict]) -> int:
+        return sum(wanted(media, missing_only) for project in projects for media in project["media"])
+
+    total = count(projects)
+    done_before = total - count(remaining)
+
+    progress = Progress(total, done=done_before, failed=checkpoint["failed"])
+    limiter = RateLimiter(rate)
+    in_flight = asyncio.Semaphore(workers)
+    errors = checkpoint["errors"]
+
+    async def run(project_id: str, media: dict):
+        async with in_flight:
+            await limiter.wait()
+            try:
+                await reprocess(db, media_store, executor, project_id, media)
+            except Exception as e:
+                progress.failed += 1
+                if len(errors) < MAX_RECORDED_ERRORS:
+                    errors.append({"project_id": project_id, "media_id": media["id"], "error": str(e)})
+            progress.done += 1
+            progress.report()
+
+    print(f"Reprocessing {total - done_before} of {total} images with {workers} workers")
+    for last_project_id, batch in batches(remaining, batch_size, missing_only):
+        await asyncio.gather(*(run(project_id, media) for project_id, media in batch))
+        await db.backfill_runs.update_one({"_id": RUN_ID}, {"$set": {
+            "last_project_id": last_project_id,
+            "done": progress.done,
+            "failed": progress.failed,
+            "errors": errors,
+            "updated_at": datetime.utcnow(),
+        }})
+
+    await db.backfill_runs.update_one({"_id": RUN_ID}, {"$set": {"finished_at": datetime.utcnow()}})
+    progress.report(force=True)
+    for error in errors:
+        print(f"  failed: {error['project_id']}/{error['media_id']}: {error['error']}")
+    return {"total": total, "done": progress.done, "failed": progress.failed}
+
+async def main(args):
+    from server import db, media_store
+    # Children inherit the lower priority
+    os.nice(args.nice)
+    # spawn keeps the children free of the parent's event loop and Mongo sockets
+    executor = ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        return await backfill(
+            db, media_store, executor, workers=args.workers, rate=args.rate, batch_size=args.batch_size,
+            missing_only=args.missing, restart=args.restart
+        )
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="processes to run handlers in")
+    parser.add_argument("--rate", type=float, help="at most this many images per second")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="images per checkpoint")
+    parser.add_argument("--nice", type=int, default=DEFAULT_NICE, help="CPU priority decrease")
+    parser.add_argument("--missing", action="store_true", help="only images without a placeholder")
+    parser.add_argument("--restart", action="store_true", help="ignore an unfinished run's checkpoint")
+    asyncio.run(main(parser.parse_args()))
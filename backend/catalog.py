@@ -0,0 +1,218 @@
+import asyncio
+import base64
+import bisect
+import json
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from models import Project, ProjectSummary, SiteSettings
+
+logger = logging.getLogger(__name__)
+
+# Media fields that let clients lay out and paint an image before loading it
+MEDIA_PREVIEW_FIELDS = ("width", "height", "placeholder", "color")
+
+def featured_images(projects: List[Project]) -> List[dict]:
+    """Media shown on the home slideshow: individually featured media plus
+    every media item of featured projects"""
+    featured = []
+    for project in projects:
+        for media in project.media:
+            # Include media if it's individually featured OR if project is featured
+            if media.featured or project.featured:
+                featured.append({
+                    "type": media.type,
+                    "url": media.url,
+                    "alt": media.alt,
+                    "variants": [variant.dict() for variant in media.variants],
+                    **media.dict(include=set(MEDIA_PREVIEW_FIELDS)),
+                    "poster": media.poster,
+                    "streams": [stream.dict() for stream in media.streams],
+                    "projectId": project.id,
+                    "projectTitle": project.title
+                })
+    return featured
+
+def featured_images_pipeline(sample_size: Optional[int] = None) -> List[dict]:
+    """Aggregation producing the same entries as featured_images() inside
+    Mongo, optionally sampling `sample_size` of them server-side"""
+    is_featured = {"$or": [{"featured": True}, {"media.featured": True}]}
+    pipeline = [
+        # Skip projects without any featured media before unwinding
+        {"$match": is_featured},
+        {"$unwind": "$media"},
+        {"$match": is_featured},
+        {"$project": {
+            "_id": 0,
+            "type": "$media.type",
+            "url": "$media.url",
+            "alt": {"$ifNull": ["$media.alt", ""]},
+            "variants": {"$ifNull": ["$media.variants", []]},
+            **{field: {"$ifNull": [f"$media.{field}", None]} for field in MEDIA_PREVIEW_FIELDS},
+            "poster": {"$ifNull": ["$media.poster", None]},
+            "streams": {"$ifNull": ["$media.streams", []]},
+            "projectId": "$id",
+            "projectTitle": "$title"
+        }},
+    ]
+    if sample_size is not None:
+        pipeline.append({"$sample": {"size": sample_size}})
+    return pipeline
+
+# ----- listings -----
+# Project lists are ordered by (order, id) and paginated with an opaque cursor
+# holding the (order, id) of the last item of the previous page
+
+def sort_key(project) -> Tuple[int, str]:
+    return (project.order, project.id)
+
+def encode_cursor(key: Tuple[int, str]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(key), separators=(",", ":")).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[int, str]:
+    """Raises ValueError for a cursor we didn't issue"""
+    try:
+        order, project_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(order, int) or not isinstance(project_id, str):
+        raise ValueError("Invalid cursor")
+    return order, project_id
+
+def after_cursor_filter(after: Tuple[int, str]) -> dict:
+    order, project_id = after
+    return {"$or": [{"order": {"$gt": order}}, {"order": order, "id": {"$gt": project_id}}]}
+
+def project_summary(project: Project) -> ProjectSummary:
+    media = sorted(project.media, key=lambda m: m.order)
+    images = [m for m in media if m.type == "image"]
+    cover = images[0] if images else (media[0] if media else None)
+    return ProjectSummary(
+        **project.dict(include=set(ProjectSummary.model_fields) - {"cover", "media_count"}),
+        cover=cover,
+        media_count=len(media)
+    )
+
+def _lowest_order(items) -> dict:
+    return {"$reduce": {
+        "input": items,
+        "initialValue": None,
+        "in": {"$cond": [
+            {"$or": [{"$eq": ["$$value", None]}, {"$lt": ["$$this.order", "$$value.order"]}]},
+            "$$this",
+            "$$value"
+        ]}
+    }}
+
+def project_summary_pipeline(match: dict, limit: Optional[int] = None,
+                             media_stages: Sequence[dict] = ()) -> List[dict]:
+    """Aggregation returning ProjectSummary-shaped documents, computing the
+    cover and media count in Mongo so the media arrays never leave it.
+    `media_stages` fill in `media` when it isn't embedded."""
+    media = {"$ifNull": ["$media", []]}
+    images = {"$filter": {"input": media, "cond": {"$eq": ["$$this.type", "image"]}}}
+    pipeline = [
+        {"$match": match},
+        {"$sort": {"order": 1, "id": 1}},
+    ]
+    if limit is not None:
+        pipeline.append({"$limit": limit})
+    pipeline.extend(media_stages)
+    pipeline.append({"$project": {
+        "_id": 0,
+        **{field: 1 for field in ProjectSummary.model_fields if field not in ("cover", "media_count")},
+        "cover": {"$ifNull": [_lowest_order(images), _lowest_order(media)]},
+        "media_count": {"$size": media}
+    }})
+    return pipeline
+
+def paginate(items: list, cursor: Optional[str], limit: int) -> Tuple[list, Optional[str]]:
+    """Page of an already (order, id)-sorted list and the cursor of the next page"""
+    start = 0
+    if cursor:
+        start = bisect.bisect_right([sort_key(item) for item in items], decode_cursor(cursor))
+    page = items[start:start + limit]
+    more = start + limit < len(items)
+    return page, encode_cursor(sort_key(page[-1])) if more and page else None
+
+class Catalog:
+    """In-process snapshot of projects and settings for the public read routes.
+
+    Loaded at startup and refreshed by the write routes, so public reads never
+    touch Mongo. Refreshes are serialized so a slower, older read can't
+    overwrite a newer one."""
+
+    def __init__(self, db, media_store):
+        self.db = db
+        self.media_store = media_store
+        self.loaded = False
+        self.version = 0
+        self.settings = SiteSettings()
+        self._projects: Dict[str, Project] = {}
+        self._ordered: List[Project] = []
+        self._published: List[Project] = []
+        self._summaries: List[ProjectSummary] = []
+        self._published_summaries: List[ProjectSummary] = []
+        self._featured: List[dict] = []
+        self._lock = asyncio.Lock()
+
+    # ----- reads -----
+
+    def get_project(self, project_id: str) -> Optional[Project]:
+        return self._projects.get(project_id)
+
+    def published_projects(self) -> List[Project]:
+        return self._published
+
+    def all_projects(self) -> List[Project]:
+        return self._ordered
+
+    def featured_images(self) -> List[dict]:
+        return self._featured
+
+    def project_summaries(self, published_only: bool = True) -> List[ProjectSummary]:
+        return self._published_summaries if published_only else self._summaries
+
+    # ----- refreshes -----
+
+    async def load(self):
+        async with self._lock:
+            projects = await self.media_store.attach(await self.db.projects.find().to_list(None))
+            settings = await self.db.settings.find_one({})
+            self._projects = {doc["id"]: Project(**doc) for doc in projects}
+            self.settings = SiteSettings(**settings) if settings else SiteSettings()
+            self._rebuild()
+            self.loaded = True
+        logger.info(f"Catalog loaded with {len(self._projects)} projects")
+
+    async def refresh_project(self, project_id: str):
+        """Re-read one project after a write; removes it if it no longer exists"""
+        async with self._lock:
+            doc = await self.db.projects.find_one({"id": project_id})
+            if doc:
+                await self.media_store.attach([doc])
+                self._projects[project_id] = Project(**doc)
+            else:
+                self._projects.pop(project_id, None)
+            self._rebuild()
+
+    async def refresh_projects(self):
+        """Re-read all projects, e.g. after a reorder touched every document"""
+        async with self._lock:
+            projects = await self.media_store.attach(await self.db.projects.find().to_list(None))
+            self._projects = {doc["id"]: Project(**doc) for doc in projects}
+            self._rebuild()
+
+    async def refresh_settings(self):
+        async with self._lock:
+            settings = await self.db.settings.find_one({})
+            self.settings = SiteSettings(**settings) if settings else SiteSettings()
+            self.version += 1
+
+    def _rebuild(self):
+        self._ordered = sorted(self._projects.values(), key=sort_key)
+        self._published = [p for p in self._ordered if p.published]
+        self._summaries = [project_summary(p) for p in self._ordered]
+        self._published_summaries = [s for s in self._summaries if s.published]
+        self._featured = featured_images(self._ordered)
+        self.version += 1
@@ -0,0 +1,94 @@
+"""
+Reference counts for content-addressed uploads
+
+Identical bytes are stored once (see utils.content_upload_url), so one file
+can back media items in several projects. Every media item or logo using a
+file holds a reference in the upload_refs collection; the file and its
+variants are deleted when the last reference is released.
+
+A ref document being deleted is marked `deleting` first, so an upload of the
+same bytes waits for the deletion to finish instead of having its file
+removed from under it.
+"""
+
+import asyncio
+import logging
+from typing import List
+
+from pymongo.errors import DuplicateKeyError
+
+from storage import upload_storage
+from upload_stream import SavedUpload
+from utils import is_content_addressed, upload_relative_path
+
+logger = logging.getLogger(__name__)
+
+# How long an upload waits for a concurrent deletion of the same content
+ACQUIRE_RETRIES = 20
+ACQUIRE_RETRY_SECONDS = 0.1
+
+async def acquire_ref(db, file_url: str):
+    key = upload_relative_path(file_url)
+    for _ in range(ACQUIRE_RETRIES):
+        try:
+            await db.upload_refs.update_one(
+                {"_id": key, "deleting": {"$ne": True}},
+                {"$inc": {"refs": 1}},
+                upsert=True
+            )
+            return
+        except DuplicateKeyError:
+            # The last reference was just released and the file is being deleted
+            await asyncio.sleep(ACQUIRE_RETRY_SECONDS)
+    raise RuntimeError(f"Upload {key} is stuck being deleted")
+
+async def commit_upload(db, upload: SavedUpload):
+    """Move a streamed upload into storage, taking a reference to it. The
+    reference is taken first so the file can't be deleted between the two
+    steps. An upload the client sent straight to storage has no temporary
+    file; it is checked to still be there once the reference is held."""
+    await acquire_ref(db, upload.file_url)
+    key = upload_relative_path(upload.file_url)
+    if upload.temp_path is not None:
+        await upload_storage.save(upload.temp_path, key)
+    elif not await upload_storage.exists(key):
+        # The last reference to the same content was released in between
+        await release_media(db, {"url": upload.file_url})
+        raise ValueError("Uploaded file is gone, upload it again")
+
+async def commit_uploads(db, uploads: List[SavedUpload]):
+    await asyncio.gather(*(commit_upload(db, upload) for upload in uploads))
+
+async def delete_upload_files(urls: List[str]):
+    for url in urls:
+        try:
+            await upload_storage.delete(upload_relative_path(url))
+        except Exception as e:
+            logger.error(f"Error deleting {url}: {e}")
+
+async def release_media(db, media: dict):
+    """Drop a media item's (or logo's) reference to its file; the file and
+    its variants go once nothing references them"""
+    if not is_content_addressed(media["url"]):
+        # Older uploads have unique names and are never shared
+        await delete_upload_files([media["url"]] + [v["url"] for v in media.get("variants", [])])
+        return
+
+    key = upload_relative_path(media["url"])
+    await db.upload_refs.update_one({"_id": key}, {"$inc": {"refs": -1}})
+    released = await db.upload_refs.find_one_and_update(
+        {"_id": key, "refs": {"$lte": 0}, "deleting": {"$ne": True}},
+        {"$set": {"deleting": True}}
+    )
+    if released:
+        await upload_storage.delete_with_derived(key)
+        await db.upload_refs.delete_one({"_id": key})
+
+async def delete_orphaned_variants(db, file_url: str, variants: List[dict]):
+    """Variants written for a media item that was deleted meanwhile; they are
+    kept if another item still uses the same original"""
+    if is_content_addressed(file_url) and await db.upload_refs.find_one(
+        {"_id": upload_relative_path(file_url), "refs": {"$gt": 0}}, {"_id": 1}
+    ):
+        return
+    await delete_upload_files([variant["url"] for variant in variants])
@@ -0,0 +1,86 @@
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import orjson
+from pydantic import BaseModel
+from starlette.requests import Request
+from starlette.responses import Response
+
+# Browsers may reuse a public response for max-age seconds, then serve it
+# stale for up to stale-while-revalidate seconds while revalidating in the background
+PUBLIC_CACHE_MAX_AGE = int(os.environ.get("PUBLIC_CACHE_MAX_AGE", "0"))
+PUBLIC_CACHE_SWR = int(os.environ.get("PUBLIC_CACHE_SWR", "60"))
+PUBLIC_CACHE_CONTROL = (
+    f"public, max-age={PUBLIC_CACHE_MAX_AGE}, stale-while-revalidate={PUBLIC_CACHE_SWR}"
+)
+
+def _dump_model(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def render_json(content: Any) -> bytes:
+    """Compact UTF-8 JSON, the same as FastAPI would send. Models are dumped
+    by pydantic-core and the rest encoded by orjson (datetimes included), so
+    nothing is validated again or walked by jsonable_encoder."""
+    return orjson.dumps(content, default=_dump_model)
+
+def json_response(content: Any, headers: Optional[Dict[str, str]] = None) -> Response:
+    """Response for a route whose content is already valid for its
+    response_model, skipping FastAPI's validation of it"""
+    return Response(render_json(content), media_type="application/json", headers=headers)
+
+def make_etag(body: bytes, weak: bool = False) -> str:
+    """ETag derived from content, so every worker computes the same one"""
+    tag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+    return f"W/{tag}" if weak else tag
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match always uses the weak comparison
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+def conditional_response(request: Request, body: bytes, etag: str,
+                         cache_control: str = PUBLIC_CACHE_CONTROL,
+                         headers: Optional[Dict[str, str]] = None) -> Response:
+    """JSON response with validators; 304 without a body when the client's
+    copy is current"""
+    headers = {"ETag": etag, "Cache-Control": cache_control, **(headers or {})}
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+# Keys come partly from requests (project ids), so the cache is bounded
+RENDER_CACHE_MAX_ENTRIES = 1024
+
+class RenderCache:
+    """Rendered bodies and ETags of public responses, valid for one catalog
+    version so unchanged content is serialized and hashed only once. The
+    least recently used entry is dropped beyond max_entries."""
+
+    def __init__(self, max_entries: int = RENDER_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._version = None
+        self._entries: "OrderedDict[str, Tuple[bytes, str]]" = OrderedDict()
+
+    def get(self, version: int, key: str, build: Callable[[], Any],
+            weak: bool = False) -> Tuple[bytes, str]:
+        if version != self._version:
+            self._version = version
+            self._entries = OrderedDict()
+        entry = self._entries.get(key)
+        if entry is None:
+            body = render_json(build())
+            entry = self._entries[key] = (body, make_etag(body, weak=weak))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(key)
+        return entry
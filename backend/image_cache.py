@@ -0,0 +1,222 @@
+"""
+Resized copies of uploads in arbitrary (whitelisted) sizes
+
+    GET /api/img/<upload key>?w=&h=&fmt=&q=
+
+For layouts the fixed variant ladder doesn't fit, like the sidebar logo.
+Only the sizes and qualities below are rendered, so clients can't fill the
+cache by asking for every possible size. Renders run in a process pool and
+concurrent requests for the same rendition share one render. Results are
+kept in a disk cache with a byte budget, evicting the least recently used
+files first; the budget is per server process. Several workers may share
+the directory, so a file one of them evicts is re-rendered by the others
+when next asked for.
+"""
+
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import anyio
+
+from images import resize_image
+from storage import upload_storage
+from utils import get_file_type, upload_relative_path
+
+logger = logging.getLogger(__name__)
+
+IMAGE_CACHE_DIR = Path(os.environ.get("IMAGE_CACHE_DIR", Path(tempfile.gettempdir()) / "image_cache"))
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("IMAGE_CACHE_MAX_MB", "512")) * 1024 * 1024
+IMAGE_RESIZE_WORKERS = int(os.environ.get("IMAGE_RESIZE_WORKERS", "2"))
+
+# Logo and thumbnail sizes (1x and 2x) plus the variant ladder
+ALLOWED_SIZES = {32, 40, 48, 64, 80, 96, 128, 160, 192, 240, 320, 480, 640, 960, 1280, 1920}
+ALLOWED_QUALITIES = {50, 60, 70, 80, 90}
+FORMATS = {"webp": "image/webp", "jpeg": "image/jpeg", "png": "image/png"}
+
+@dataclass(frozen=True)
+class Rendition:
+    key: str
+    width: Optional[int]
+    height: Optional[int]
+    fmt: str
+    quality: Optional[int]
+
+    @classmethod
+    def parse(cls, filename: str, w: Optional[int], h: Optional[int], fmt: str,
+              q: Optional[int]) -> "Rendition":
+        """Raises ValueError for anything outside the whitelist"""
+        key = upload_relative_path(f"/uploads/{filename}")
+        if get_file_type(key)[1] != "image":
+            raise ValueError("Only images can be resized")
+        if w is None and h is None:
+            raise ValueError("Give a width (w), a height (h) or both")
+        for size in (w, h):
+            if size is not None and size not in ALLOWED_SIZES:
+                raise ValueError(f"Size must be one of {sorted(ALLOWED_SIZES)}")
+        if fmt not in FORMATS:
+            raise ValueError(f"Format must be one of {sorted(FORMATS)}")
+        if q is not None and (fmt == "png" or q not in ALLOWED_QUALITIES):
+            raise ValueError(f"Quality must be one of {sorted(ALLOWED_QUALITIES)} (not for png)")
+        return cls(key, w, h, fmt, q)
+
+    @property
+    def name(self) -> str:
+        """Cache filename; uploads never change, so neither does their rendition"""
+        digest = hashlib.blake2b(
+            f"{self.key}|{self.width}|{self.height}|{self.fmt}|{self.quality}".encode(), digest_size=16
+        ).hexdigest()
+        return f"{digest}.{self.fmt}"
+
+    @property
+    def media_type(self) -> str:
+        return FORMATS[self.fmt]
+
+class DiskLRUCache:
+    """Files in a directory, evicted least recently used first once they
+    take more than `max_bytes`. Recency is kept in memory and seeded from
+    file mtimes at startup."""
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+
+    def path(self, name: str) -> Path:
+        return self.directory / name[:2] / name
+
+    def load(self):
+        """Index files left by earlier runs; blocking"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        files = [
+            (path.stat().st_mtime, path.name, path.stat().st_size)
+            for path in self.directory.glob("*/*")
+            # Hidden files are renders in progress
+            if path.is_file() and not path.name.startswith(".")
+        ]
+        self._entries.clear()
+        self.size = 0
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self.size += size
+        self._evict()
+
+    def get(self, name: str) -> Optional[Path]:
+        if name not in self._entries:
+            return None
+        self._entries.move_to_end(name)
+        return self.path(name)
+
+    def discard(self, name: str):
+        """Forget a file that was deleted behind the cache's back"""
+        self.size -= self._entries.pop(name, 0)
+
+    def add(self, name: str, size: int) -> List[Path]:
+        """Record a file written at path(name); returns the files evicted
+        to make room, for the caller to delete"""
+        self.size += size - self._entries.pop(name, 0)
+        self._entries[name] = size
+        return self._evict()
+
+    def _evict(self) -> List[Path]:
+        evicted = []
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self.size -= size
+            evicted.append(self.path(name))
+        return evicted
+
+class ImageResizer:
+    """Renders Renditions into a DiskLRUCache in a process pool"""
+
+    def __init__(self, cache: DiskLRUCache, concurrency: int = IMAGE_RESIZE_WORKERS):
+        self.cache = cache
+        self.concurrency = max(1, concurrency)
+        self.executor: Optional[ProcessPoolExecutor] = None
+        # Renders in progress by cache name, awaited by every request for it
+        self._renders: Dict[str, asyncio.Future] = {}
+        self.renders = 0
+        self.hits = 0
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        # spawn keeps the children free of the parent's event loop and Mongo sockets
+        return ProcessPoolExecutor(
+            max_workers=self.concurrency,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    def _replace_executor(self, broken: ProcessPoolExecutor):
+        """Swap a pool whose process died for a new one; every render in it
+        fails, only the first replaces it"""
+        if self.executor is not broken:
+            return
+        logger.error("An image resize process died; restarting the process pool")
+        broken.shutdown(wait=False, cancel_futures=True)
+        self.executor = self._new_executor()
+
+    async def start(self):
+        await anyio.to_thread.run_sync(self.cache.load)
+        self.executor = self._new_executor()
+        logger.info(f"Image cache holds {self.cache.size // (1024 * 1024)} MB")
+
+    async def stop(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def get(self, rendition: Rendition) -> Path:
+        """Path of the rendered file, rendering it first if needed. Raises
+        FileNotFoundError when the upload doesn't exist."""
+        path = self.cache.get(rendition.name)
+        # Workers sharing the cache directory evict each other's files, so
+        # an indexed file may be gone; it is rendered again then
+        if path is not None and await anyio.to_thread.run_sync(path.is_file):
+            self.hits += 1
+            return path
+        if path is not None:
+            self.cache.discard(rendition.name)
+        return await self._single_flight(rendition.name, lambda: self._render(rendition))
+
+    async def _single_flight(self, name: str, render: Callable[[], Awaitable[Path]]) -> Path:
+        future = self._renders.get(name)
+        if future is None:
+            future = asyncio.ensure_future(render())
+            self._renders[name] = future
+            future.add_done_callback(lambda _: self._renders.pop(name, None))
+        # A client going away doesn't cancel the render for the others
+        return await asyncio.shield(future)
+
+    async def _render(self, rendition: Rendition) -> Path:
+        if not await upload_storage.exists(rendition.key):
+            raise FileNotFoundError(rendition.key)
+        target = self.cache.path(rendition.name)
+        await anyio.to_thread.run_sync(lambda: target.parent.mkdir(parents=True, exist_ok=True))
+        loop = asyncio.get_running_loop()
+        async with upload_storage.local_file(rendition.key) as source:
+            args = (str(source), str(target), rendition.width, rendition.height, rendition.fmt, rendition.quality)
+            # A process dying (perhaps in another render) breaks the pool for
+            # every render; the pool is replaced and this render tried once more
+            for retry in (False, True):
+                executor = self.executor
+                try:
+                    size = await loop.run_in_executor(executor, resize_image, *args)
+                    break
+                except BrokenProcessPool:
+                    self._replace_executor(executor)
+                    if retry:
+                        raise
+        self.renders += 1
+        evicted = self.cache.add(rendition.name, size)
+        if evicted:
+            await anyio.to_thread.run_sync(lambda: [path.unlink(missing_ok=True) for path in evicted])
+        return target
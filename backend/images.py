@@ -0,0 +1,143 @@
+import base64
+import io
+import logging
+import os
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# Fixed ladder of widths so clients can build a predictable srcset
+VARIANT_WIDTHS = (320, 640, 960, 1280, 1920)
+
+WEBP_QUALITY = 80
+JPEG_QUALITY = 82
+
+# Longest side of the inline placeholder, and of the copy the dominant color is taken from
+PLACEHOLDER_SIZE = 16
+PLACEHOLDER_QUALITY = 40
+COLOR_SAMPLE_SIZE = 64
+# EXIF orientations that swap width and height
+_TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+def _has_alpha(image: Image.Image) -> bool:
+    return image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+
+def _ladder_for(width: int) -> List[int]:
+    """Widths from the ladder that are smaller than the original (at least one)"""
+    widths = [w for w in VARIANT_WIDTHS if w < width]
+    return widths or [width]
+
+def _save(image: Image.Image, target: Path, fmt: str, quality: Optional[int] = None):
+    # Written under a hidden name and renamed, so a variant shared by several
+    # media items (same content) is never seen half-written
+    temp = target.with_name(f".{target.name}.{os.getpid()}")
+    if fmt == "webp":
+        image.save(temp, "WEBP", quality=quality or WEBP_QUALITY, method=4)
+    elif fmt == "jpeg":
+        image.save(temp, "JPEG", quality=quality or JPEG_QUALITY, optimize=True, progressive=True)
+    else:
+        image.save(temp, "PNG", optimize=True)
+    os.replace(temp, target)
+
+def generate_image_variants(file_path: Path) -> List[dict]:
+    """Write resized WebP and JPEG (PNG for transparent images) copies next to
+    the original and return one dict per variant: filename, width, height,
+    format and size in bytes. Animated images are left alone.
+
+    Variants that already exist (the same content was uploaded before) are
+    reused rather than encoded again."""
+    variants = []
+    with Image.open(file_path) as source:
+        if getattr(source, "is_animated", False):
+            return variants
+
+        image = ImageOps.exif_transpose(source)
+        alpha = _has_alpha(image)
+        image = image.convert("RGBA" if alpha else "RGB")
+        fallback_format = "png" if alpha else "jpeg"
+
+        for width in _ladder_for(image.width):
+            height = max(1, round(image.height * width / image.width))
+            resized = None
+
+            for fmt in ("webp", fallback_format):
+                ext = "jpg" if fmt == "jpeg" else fmt
+                filename = f"{file_path.stem}_{width}w.{ext}"
+                target = file_path.with_name(filename)
+                if not target.exists():
+                    if resized is None:
+                        resized = image if width == image.width else image.resize((width, height), Image.LANCZOS)
+                    _save(resized, target, fmt)
+
+                variants.append({
+                    "filename": filename,
+                    "width": width,
+                    "height": height,
+                    "format": fmt,
+                    "size": target.stat().st_size,
+                })
+
+    return variants
+
+def dominant_color(image: Image.Image) -> str:
+    """Most common color as #rrggbb: pixels are binned at 4 bits per channel
+    and the fullest bin is averaged. Transparent pixels don't count."""
+    pixels = np.asarray(image.convert("RGBA")).reshape(-1, 4)
+    opaque = pixels[pixels[:, 3] >= 128, :3]
+    if len(opaque) == 0:
+        opaque = pixels[:, :3]
+    bins = (opaque >> 4).astype(np.int32)
+    index = (bins[:, 0] << 8) | (bins[:, 1] << 4) | bins[:, 2]
+    r, g, b = opaque[index == np.bincount(index).argmax()].mean(axis=0).round().astype(int)
+    return f"#{r:02x}{g:02x}{b:02x}"
+
+def describe_image(file_path: Path) -> dict:
+    """Intrinsic width and height (as displayed, after EXIF rotation), a tiny
+    WebP placeholder as a data URI and the dominant color, so clients can lay
+    out and paint an image before loading it"""
+    with Image.open(file_path) as source:
+        width, height = source.size
+        if source.getexif().get(0x0112) in _TRANSPOSED_ORIENTATIONS:
+            width, height = height, width
+        # JPEGs are decoded at a fraction of their size, which is all a thumbnail needs
+        source.draft("RGB", (COLOR_SAMPLE_SIZE, COLOR_SAMPLE_SIZE))
+        image = ImageOps.exif_transpose(source)
+        image = image.convert("RGBA" if _has_alpha(image) else "RGB")
+        image.thumbnail((COLOR_SAMPLE_SIZE, COLOR_SAMPLE_SIZE), Image.BILINEAR)
+
+        placeholder = image.copy()
+        placeholder.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE), Image.LANCZOS)
+        buffer = io.BytesIO()
+        placeholder.save(buffer, "WEBP", quality=PLACEHOLDER_QUALITY)
+
+    return {
+        "width": width,
+        "height": height,
+        "placeholder": f"data:image/webp;base64,{base64.b64encode(buffer.getvalue()).decode()}",
+        "color": dominant_color(image),
+    }
+
+def process_image(file_path: str) -> dict:
+    """Entry point for the media job worker; runs in a child process"""
+    path = Path(file_path)
+    return {"variants": generate_image_variants(path), **describe_image(path)}
+
+def resize_image(source: str, target: str, width: Optional[int], height: Optional[int],
+                 fmt: str, quality: Optional[int] = None) -> int:
+    """Write a copy of `source` fitting within width x height (either may be
+    None) without upscaling, and return its size in bytes. Animated images
+    keep their first frame. Entry point for image_cache.ImageResizer; runs in
+    a child process."""
+    with Image.open(source) as original:
+        image = ImageOps.exif_transpose(original)
+        alpha = _has_alpha(image) and fmt != "jpeg"
+        image = image.convert("RGBA" if alpha else "RGB")
+        box = (min(width or image.width, image.width), min(height or image.height, image.height))
+        if box != image.size:
+            image = ImageOps.contain(image, box, Image.LANCZOS)
+        _save(image, Path(target), fmt, quality)
+    return Path(target).stat().st_size
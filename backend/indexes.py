@@ -0,0 +1,259 @@
+"""
+MongoDB indexes and query-plan verification
+
+Indexes are created idempotently at startup. To check that every query shape
+the routes use is served by an index, run against a database:
+
+    python indexes.py --check
+
+tests/test_indexes.py checks the same shapes against the indexes alone, on
+an in-memory Mongo.
+"""
+
+import asyncio
+import logging
+import sys
+from datetime import datetime
+from typing import Dict, Iterator, List, Set
+
+from pymongo import ASCENDING, IndexModel
+
+from media_store import EmbeddedMediaStore
+
+logger = logging.getLogger(__name__)
+
+# Finished (done or failed) media jobs are kept this long, for looking into
+# failures, then removed by Mongo's TTL monitor
+FINISHED_JOB_TTL_SECONDS = 7 * 24 * 3600
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    "projects": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("published", ASCENDING), ("order", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("order", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("featured", ASCENDING)]),
+        IndexModel([("updated_at", ASCENDING)]),
+        # Multikey indexes over the embedded media array
+        IndexModel([("media.id", ASCENDING)]),
+        IndexModel([("media.featured", ASCENDING)]),
+    ],
+    # Media collection layout (see media_store.py)
+    "media": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("project_id", ASCENDING), ("order", ASCENDING)]),
+        IndexModel([("featured", ASCENDING)]),
+    ],
+    "users": [
+        IndexModel([("username", ASCENDING)], unique=True),
+    ],
+    "media_jobs": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("status", ASCENDING), ("run_at", ASCENDING)]),
+        IndexModel([("status", ASCENDING), ("lease_expires_at", ASCENDING)]),
+        # Only set once a job is done or failed for good
+        IndexModel([("finished_at", ASCENDING)], expireAfterSeconds=FINISHED_JOB_TTL_SECONDS),
+    ],
+    "upload_sessions": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("updated_at", ASCENDING)]),
+    ],
+    # One document, but the media job finds it by the logo it processed
+    "settings": [
+        IndexModel([("logo_url", ASCENDING)]),
+    ],
+}
+
+async def ensure_indexes(db):
+    """Create any missing indexes; existing ones are left untouched"""
+    # Projects created before `order` was stored would sort as null and fall
+    # outside (order, id) cursor ranges
+    await db.projects.update_many({"order": {"$exists": False}}, {"$set": {"order": 0}})
+    # Jobs finished before finished_at was stored would never expire
+    await db.media_jobs.update_many(
+        {"status": {"$in": ["done", "failed"]}, "finished_at": {"$exists": False}},
+        [{"$set": {"finished_at": "$updated_at"}}]
+    )
+    for collection, indexes in INDEXES.items():
+        names = await db[collection].create_indexes(indexes)
+        logger.info(f"Indexes on {collection}: {', '.join(names)}")
+
+# ===== Query plan verification =====
+
+# Placeholder value for date comparisons in the shapes below
+_NOW = datetime.utcnow()
+
+def query_shapes(media_store: EmbeddedMediaStore) -> Dict[str, dict]:
+    """Every filtered query the app runs, as an explainable command"""
+    # Updates and deletes select documents the same way as a find with their
+    # filter, so they are listed as finds. Unfiltered reads (catalog loads, the
+    # single settings document, counting users) intentionally read whole collections.
+    shapes = {
+        "project by id": {"find": "projects", "filter": {"id": "x"}},
+        "project media item": {"find": "projects", "filter": {"id": "x", "media.id": "m"}},
+        "published project summaries": {
+            "aggregate": "projects",
+            "pipeline": media_store.summary_pipeline(
+                {"published": True, "$or": [{"order": {"$gt": 0}}, {"order": 0, "id": {"$gt": "x"}}]}, 101
+            ),
+            "cursor": {}
+        },
+        "all project summaries": {
+            "aggregate": "projects", "pipeline": media_store.summary_pipeline({}, 101), "cursor": {}
+        },
+        "featured media": {
+            "aggregate": media_store.featured_source, "pipeline": media_store.featured_pipeline(), "cursor": {}
+        },
+        "featured media sample": {
+            "aggregate": media_store.featured_source, "pipeline": media_store.featured_pipeline(100), "cursor": {}
+        },
+        "recently updated projects": {"find": "projects", "filter": {"updated_at": {"$gte": _NOW}}},
+        "project ids": {"distinct": "projects", "key": "id"},
+        "user by username": {"find": "users", "filter": {"username": "x"}},
+        "claimable media job": {
+            "find": "media_jobs",
+            "filter": {"$or": [
+                {"status": "pending", "run_at": {"$lte": _NOW}},
+                {"status": "running", "lease_expires_at": {"$lte": _NOW}},
+            ]},
+            "sort": {"run_at": 1},
+            "limit": 1,
+        },
+        "media job by id": {"find": "media_jobs", "filter": {"id": "x"}},
+        "finished media jobs to expire": {
+            "find": "media_jobs",
+            "filter": {"status": {"$in": ["done", "failed"]}, "finished_at": {"$exists": False}},
+        },
+        "upload session by id": {"find": "upload_sessions", "filter": {"id": "x", "project_id": "p"}},
+        "expired upload sessions": {"find": "upload_sessions", "filter": {"updated_at": {"$lt": _NOW}}},
+        "settings by logo": {"find": "settings", "filter": {"logo_url": "x"}},
+        "upload ref": {"find": "upload_refs", "filter": {"_id": "k", "deleting": {"$ne": True}}},
+        "released upload ref": {
+            "find": "upload_refs", "filter": {"_id": "k", "refs": {"$lte": 0}, "deleting": {"$ne": True}}
+        },
+        "used upload ref": {"find": "upload_refs", "filter": {"_id": "k", "refs": {"$gt": 0}}},
+        "backfill run": {"find": "backfill_runs", "filter": {"_id": "x"}},
+    }
+    if media_store.layout == "collection":
+        shapes.update({
+            "project media": {"find": "media", "filter": {"project_id": "x"}, "sort": {"order": 1}},
+            "media of projects": {"find": "media", "filter": {"project_id": {"$in": ["x", "y"]}}},
+            "media item": {"find": "media", "filter": {"id": "m", "project_id": "x"}},
+            "media by id": {"find": "media", "filter": {"id": {"$in": ["m", "n"]}}},
+            "last media of project": {
+                "find": "media", "filter": {"project_id": "x"}, "sort": {"order": -1}, "limit": 1
+            },
+        })
+    return shapes
+
+def _plan_stages(plan) -> Iterator[str]:
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _plan_stages(item)
+
+def winning_plan_stages(explain: dict) -> List[str]:
+    """Stages of every winning plan in an explain result, including those
+    nested inside aggregation stages"""
+    stages = []
+    def visit(node):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key == "winningPlan":
+                    stages.extend(_plan_stages(value))
+                else:
+                    visit(value)
+        elif isinstance(node, list):
+            for item in node:
+                visit(item)
+    visit(explain)
+    return stages
+
+# ----- without a query planner -----
+# mongomock has no explain, so tests check the shapes against the indexes
+# themselves: a query can use an index when the index's first field is one it
+# filters on (every branch of an $or), or, unfiltered, the field it sorts by
+
+def _filter_branches(query: dict) -> List[Set[str]]:
+    fields = {key for key in query if not key.startswith("$")}
+    branches = [fields]
+    for clause in query.get("$and", []):
+        branches = [branch | extra for branch in branches for extra in _filter_branches(clause)]
+    if "$or" in query:
+        branches = [branch | extra for branch in branches for clause in query["$or"]
+                    for extra in _filter_branches(clause)]
+    return branches
+
+def _served(leading_fields: Dict[str, Set[str]], collection: str, fields: Set[str]) -> bool:
+    return bool(fields & ({"_id"} | leading_fields.get(collection, set())))
+
+def _pipeline_served(leading_fields: Dict[str, Set[str]], collection: str, pipeline: List[dict]) -> bool:
+    """The first $match (or the $sort after an empty one), and every $lookup
+    and $unionWith pipeline"""
+    first = pipeline[0] if pipeline else {}
+    if "$match" in first:
+        sort = pipeline[1].get("$sort", {}) if len(pipeline) > 1 else {}
+        if not all(_served(leading_fields, collection, fields or set(list(sort)[:1]))
+                   for fields in _filter_branches(first["$match"])):
+            return False
+    for stage in pipeline:
+        lookup = stage.get("$lookup")
+        if lookup and not _served(leading_fields, lookup["from"], {lookup["foreignField"]}):
+            return False
+        union = stage.get("$unionWith")
+        if union and not _pipeline_served(leading_fields, union["coll"], union.get("pipeline", [])):
+            return False
+    return True
+
+async def unindexed_query_shapes(db, media_store: EmbeddedMediaStore) -> List[str]:
+    """Names of the query shapes no index of `db` can serve, judged from the
+    indexes alone (see above); `--check` asks the query planner instead"""
+    leading_fields: Dict[str, Set[str]] = {}
+    for collection in await db.list_collection_names():
+        for index in (await db[collection].index_information()).values():
+            leading_fields.setdefault(collection, set()).add(list(index["key"])[0][0])
+
+    unindexed = []
+    for name, command in query_shapes(media_store).items():
+        if "find" in command:
+            branches = _filter_branches(command["filter"])
+            sort = set(list(command.get("sort", {}))[:1])
+            if not all(_served(leading_fields, command["find"], fields or sort) for fields in branches):
+                unindexed.append(name)
+        elif "distinct" in command:
+            if not _served(leading_fields, command["distinct"], {command["key"]}):
+                unindexed.append(name)
+        elif not _pipeline_served(leading_fields, command["aggregate"], command["pipeline"]):
+            unindexed.append(name)
+    return unindexed
+
+async def verify_query_plans(db, media_store: EmbeddedMediaStore) -> List[str]:
+    """Names of the query shapes whose plan scans a whole collection"""
+    collscans = []
+    for name, command in query_shapes(media_store).items():
+        explain = await db.command("explain", command, verbosity="queryPlanner")
+        stages = winning_plan_stages(explain)
+        ok = "COLLSCAN" not in stages
+        print(f"{'ok  ' if ok else 'FAIL'} {name:<30} {' <- '.join(stages)}")
+        if not ok:
+            collscans.append(name)
+    return collscans
+
+async def main() -> bool:
+    from server import db, media_store
+    await ensure_indexes(db)
+    collscans = await verify_query_plans(db, media_store)
+    if collscans:
+        print(f"\n{len(collscans)} query shape(s) scan a whole collection: {', '.join(collscans)}")
+        return False
+    print(f"\nAll {len(query_shapes(media_store))} query shapes use an index ({media_store.layout} media)")
+    return True
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["--check"]:
+        print("Usage: python indexes.py --check")
+        sys.exit(2)
+    sys.exit(0 if asyncio.run(main()) else 1)
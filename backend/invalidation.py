@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Polling fallback for standalone Mongo (no change streams): how often to look
+# for writes made by other workers, i.e. the bound on how stale a worker can be
+POLL_INTERVAL_SECONDS = float(os.environ.get("CATALOG_POLL_SECONDS", "5"))
+# Tolerated clock difference between workers when comparing updated_at values
+CLOCK_SKEW_SECONDS = 5
+# Above this many changed projects a poll reloads them all in one query
+MAX_INDIVIDUAL_REFRESHES = 10
+# Change stream errors tolerated in a row (without the stream opening in
+# between) before switching to polling
+MAX_STREAM_FAILURES = 5
+
+WATCHED_COLLECTIONS = ["projects", "settings"]
+
+class CatalogSync:
+    """Keeps this worker's catalog in step with writes made by other workers
+    or replicas.
+
+    Uses a change stream on projects and settings when Mongo runs as a replica
+    set, and falls back to polling updated_at on a standalone server."""
+
+    def __init__(self, db, catalog, poll_interval: float = POLL_INTERVAL_SECONDS):
+        self.db = db
+        self.catalog = catalog
+        self.poll_interval = poll_interval
+        self.mode: Optional[str] = None
+        self.events = 0
+        self.last_lag_seconds: Optional[float] = None
+        self.max_lag_seconds = 0.0
+        self._lag_total = 0.0
+        self.last_event_at: Optional[datetime] = None
+        self._task: Optional[asyncio.Task] = None
+        # Change stream errors since the stream was last open
+        self._stream_failures = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> dict:
+        """Freshness metrics: lag is the time from a write being committed to
+        this worker's catalog reflecting it"""
+        return {
+            "mode": self.mode,
+            "events": self.events,
+            "last_lag_seconds": self.last_lag_seconds,
+            "max_lag_seconds": self.max_lag_seconds,
+            "avg_lag_seconds": self._lag_total / self.events if self.events else None,
+            "last_event_at": self.last_event_at,
+        }
+
+    def _record(self, written_at: Optional[datetime]):
+        now = datetime.now(timezone.utc)
+        self.events += 1
+        self.last_event_at = now
+        if written_at is None:
+            return
+        if written_at.tzinfo is None:
+            written_at = written_at.replace(tzinfo=timezone.utc)
+        lag = max((now - written_at).total_seconds(), 0.0)
+        self.last_lag_seconds = lag
+        self.max_lag_seconds = max(self.max_lag_seconds, lag)
+        self._lag_total += lag
+
+    async def _run(self):
+        while self._stream_failures < MAX_STREAM_FAILURES:
+            try:
+                await self._watch()
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                # Standalone servers don't support change streams at all
+                logger.info(f"Change streams unavailable ({e.code}), polling every {self.poll_interval}s")
+                break
+            except Exception as e:
+                self._stream_failures += 1
+                logger.warning(
+                    f"Catalog change stream failed ({self._stream_failures}/{MAX_STREAM_FAILURES}): {e}"
+                )
+                await asyncio.sleep(min(2 ** self._stream_failures, 30))
+        await self._poll()
+
+    async def _watch(self):
+        pipeline = [{"$match": {"ns.coll": {"$in": WATCHED_COLLECTIONS}}}]
+        async with self.db.watch(pipeline, full_document="updateLookup") as stream:
+            self.mode = "change_stream"
+            # Errors are only counted in a row; occasional ones over a long
+            # run don't add up to polling for good
+            self._stream_failures = 0
+            # Catch up on anything written before the stream was open
+            await self.catalog.load()
+
+            async for change in stream:
+                collection = change["ns"]["coll"]
+                document = change.get("fullDocument")
+                if collection == "settings":
+                    await self.catalog.refresh_settings()
+                elif document and "id" in document:
+                    await self.catalog.refresh_project(document["id"])
+                else:
+                    # Deletes only carry the _id; reload the (small) project set
+                    await self.catalog.refresh_projects()
+                self._record(change["clusterTime"].as_datetime())
+
+    async def _poll(self):
+        self.mode = "polling"
+        while True:
+            try:
+                await self._poll_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Catalog poll failed: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def _poll_once(self):
+        if not self.catalog.loaded:
+            await self.catalog.load()
+            return
+
+        ids = set(await self.db.projects.distinct("id"))
+        if ids != {p.id for p in self.catalog.all_projects()}:
+            # Projects were created or deleted elsewhere
+            await self.catalog.refresh_projects()
+            self._record(None)
+        else:
+            newest = max((p.updated_at for p in self.catalog.all_projects()), default=None)
+            query = {}
+            if newest is not None:
+                query = {"updated_at": {"$gte": newest - timedelta(seconds=CLOCK_SKEW_SECONDS)}}
+            changed = [
+                doc async for doc in self.db.projects.find(query, {"id": 1, "updated_at": 1})
+                if self.catalog.get_project(doc["id"]) is None
+                or self.catalog.get_project(doc["id"]).updated_at != doc.get("updated_at")
+            ]
+            if len(changed) > MAX_INDIVIDUAL_REFRESHES:
+                await self.catalog.refresh_projects()
+            else:
+                for doc in changed:
+                    await self.catalog.refresh_project(doc["id"])
+            for doc in changed:
+                self._record(doc.get("updated_at"))
+
+        settings = await self.db.settings.find_one({}, {"updated_at": 1})
+        if settings and settings.get("updated_at") != self.catalog.settings.updated_at:
+            await self.catalog.refresh_settings()
+            self._record(settings.get("updated_at"))
@@ -0,0 +1,329 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, List, Optional
+
+from pymongo import ReturnDocument
+
+from catalog import MEDIA_PREVIEW_FIELDS
+from images import process_image
+from media_store import EmbeddedMediaStore, media_store_for
+from content_store import delete_orphaned_variants
+from storage import upload_storage
+from utils import upload_relative_path, variants_with_urls
+from videos import VIDEO_PROCESSING, process_video
+
+logger = logging.getLogger(__name__)
+
+MEDIA_JOB_WORKERS = int(os.environ.get("MEDIA_JOB_WORKERS", "2"))
+MAX_ATTEMPTS = int(os.environ.get("MEDIA_JOB_MAX_ATTEMPTS", "5"))
+BACKOFF_BASE_SECONDS = 5
+BACKOFF_MAX_SECONDS = 600
+# A running job whose lease expired (worker crashed or was redeployed) is claimed again
+LEASE_SECONDS = 600
+# Running jobs extend their lease this often, so long video transcodes keep it
+LEASE_RENEW_SECONDS = LEASE_SECONDS / 3
+# Jobs running when a pool process died are requeued without using up an
+# attempt, as any of them may have caused it; a job caught in this many
+# crashes is failed like any other error instead (it is likely the cause)
+MAX_CRASHES = int(os.environ.get("MEDIA_JOB_MAX_CRASHES", "3"))
+POLL_INTERVAL_SECONDS = 2
+
+# Job kinds and the function run in the process pool for each of them.
+# Handlers take the path of a local copy of the upload and return a dict of
+# results; the variants and other files they write next to it are stored
+# with the original.
+JOB_HANDLERS = {
+    "image": process_image,
+    # Videos are served as uploaded when there is no ffmpeg
+    **({"video": partial(process_video, hls=not upload_storage.presigned_reads)} if VIDEO_PROCESSING else {}),
+}
+
+def backoff_delay(attempts: int) -> float:
+    """Exponential backoff between retries, capped"""
+    return min(BACKOFF_BASE_SECONDS * 2 ** max(attempts - 1, 0), BACKOFF_MAX_SECONDS)
+
+def new_media_job(kind: str, file_url: str, project_id: Optional[str] = None,
+                  media_id: Optional[str] = None) -> dict:
+    """Build a job document for an upload. A job with no project_id targets
+    the site logo in settings."""
+    now = datetime.utcnow()
+    return {
+        "id": str(uuid.uuid4()),
+        "kind": kind,
+        "file_url": file_url,
+        "project_id": project_id,
+        "media_id": media_id,
+        "status": "pending",
+        "attempts": 0,
+        "max_attempts": MAX_ATTEMPTS,
+        "run_at": now,
+        "last_error": None,
+        "created_at": now,
+        "updated_at": now,
+    }
+
+async def run_handler(executor: Optional[ProcessPoolExecutor], kind: str, file_url: str) -> dict:
+    """Run a job kind's handler in `executor` on a local copy of an upload
+    and store the files it derived next to the original"""
+    handler = JOB_HANDLERS.get(kind)
+    if handler is None:
+        raise ValueError(f"Unknown media job kind: {kind}")
+    key = upload_relative_path(file_url)
+    loop = asyncio.get_running_loop()
+    async with upload_storage.local_file(key) as file_path:
+        result = await loop.run_in_executor(executor, handler, str(file_path))
+        filenames = [v["filename"] for v in result.get("variants", [])] + result.get("files", [])
+        await upload_storage.save_derived(key, [file_path.with_name(name) for name in dict.fromkeys(filenames)])
+    return result
+
+def media_fields(result: dict, file_url: str) -> dict:
+    """Media item fields to set from a handler's result"""
+    fields = {
+        "variants": variants_with_urls(result.get("variants", []), file_url),
+        **{field: result[field] for field in MEDIA_PREVIEW_FIELDS if field in result},
+    }
+    if "poster" in result:
+        fields["poster"] = variants_with_urls([{"filename": result["poster"]}], file_url)[0]["url"]
+        fields["streams"] = variants_with_urls(result.get("streams", []), file_url)
+    return fields
+
+async def enqueue_media_jobs(db, jobs: List[dict]):
+    """Queue jobs built with new_media_job in one insert"""
+    if not jobs:
+        return
+    await db.media_jobs.insert_many(jobs)
+    if _worker is not None:
+        _worker.wake()
+
+async def enqueue_media_job(db, kind: str, file_url: str, project_id: Optional[str] = None,
+                            media_id: Optional[str] = None) -> dict:
+    """Queue a processing job for an upload"""
+    job = new_media_job(kind, file_url, project_id, media_id)
+    await enqueue_media_jobs(db, [job])
+    return job
+
+class MediaJobWorker:
+    """Claims jobs from the media_jobs collection and runs them in a process
+    pool so CPU-heavy work never blocks the event loop"""
+
+    def __init__(self, db, concurrency: int = MEDIA_JOB_WORKERS,
+                 on_change: Optional[Callable[[dict], Awaitable[None]]] = None,
+                 media_store: Optional[EmbeddedMediaStore] = None):
+        self.db = db
+        self.media_store = media_store or media_store_for(db)
+        # Called after a job changed a media item or the logo
+        self.on_change = on_change
+        self.jobs = db.media_jobs
+        self.concurrency = max(1, concurrency)
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self._tasks = []
+        self._wakeup = asyncio.Event()
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        # spawn keeps the children free of the parent's event loop and Mongo sockets
+        return ProcessPoolExecutor(
+            max_workers=self.concurrency,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    def _replace_executor(self, broken: ProcessPoolExecutor):
+        """Swap a pool whose process died (OOM kill, segfault) for a new one.
+        A broken pool fails everything submitted to it, so every job running
+        in it lands here; only the first one replaces it."""
+        if self.executor is not broken:
+            return
+        logger.error("A media job process died; restarting the process pool")
+        broken.shutdown(wait=False, cancel_futures=True)
+        self.executor = self._new_executor()
+
+    def start(self):
+        self.executor = self._new_executor()
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.concurrency)]
+        logger.info(f"Media job worker started with {self.concurrency} processes")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                job = await self._claim()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Could not claim media job: {e}")
+                job = None
+
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), POLL_INTERVAL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._execute(job)
+
+    async def _claim(self) -> Optional[dict]:
+        now = datetime.utcnow()
+        return await self.jobs.find_one_and_update(
+            {"$or": [
+                {"status": "pending", "run_at": {"$lte": now}},
+                {"status": "running", "lease_expires_at": {"$lte": now}},
+            ]},
+            {
+                "$set": {
+                    "status": "running",
+                    "lease_expires_at": now + timedelta(seconds=LEASE_SECONDS),
+                    "updated_at": now,
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("run_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def _execute(self, job: dict):
+        heartbeat = asyncio.create_task(self._renew_lease(job))
+        try:
+            if job["kind"] not in JOB_HANDLERS:
+                raise ValueError(f"Unknown media job kind: {job['kind']}")
+            await self._set_media_status(job, "processing")
+            executor = self.executor
+            try:
+                result = await run_handler(executor, job["kind"], job["file_url"])
+            except BrokenProcessPool as e:
+                self._replace_executor(executor)
+                await self._requeue_after_crash(job, e)
+                return
+            await self._apply_result(job, result)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self._fail(job, e)
+            return
+        finally:
+            heartbeat.cancel()
+
+        now = datetime.utcnow()
+        await self.jobs.update_one(
+            {"id": job["id"]},
+            {"$set": {"status": "done", "last_error": None, "updated_at": now, "finished_at": now}}
+        )
+
+    async def _renew_lease(self, job: dict):
+        while True:
+            await asyncio.sleep(LEASE_RENEW_SECONDS)
+            try:
+                await self.jobs.update_one(
+                    {"id": job["id"], "status": "running"},
+                    {"$set": {"lease_expires_at": datetime.utcnow() + timedelta(seconds=LEASE_SECONDS)}}
+                )
+            except Exception as e:
+                logger.warning(f"Could not renew the lease of media job {job['id']}: {e}")
+
+    async def _apply_result(self, job: dict, result: dict):
+        fields = media_fields(result, job["file_url"])
+        now = datetime.utcnow()
+
+        if job["project_id"] is None:
+            await self.db.settings.update_one(
+                {"logo_url": job["file_url"]},
+                {"$set": {"logo_variants": fields["variants"], "updated_at": now}}
+            )
+        else:
+            updated = await self.media_store.update(
+                job["project_id"], job["media_id"], {**fields, "status": "ready"}
+            )
+            if not updated:
+                # Media was deleted while the job ran; don't leave orphaned files
+                await delete_orphaned_variants(self.db, job["file_url"], fields["variants"])
+                return
+
+        if self.on_change:
+            await self.on_change(job)
+
+    async def _fail(self, job: dict, error: Exception):
+        now = datetime.utcnow()
+        if job["attempts"] >= job.get("max_attempts", MAX_ATTEMPTS):
+            logger.error(f"Media job {job['id']} failed permanently: {error}")
+            await self.jobs.update_one(
+                {"id": job["id"]},
+                {"$set": {"status": "failed", "last_error": str(error), "updated_at": now, "finished_at": now}}
+            )
+            await self._set_media_status(job, "failed")
+            return
+
+        delay = backoff_delay(job["attempts"])
+        logger.warning(f"Media job {job['id']} failed (attempt {job['attempts']}), retrying in {delay}s: {error}")
+        await self.jobs.update_one(
+            {"id": job["id"]},
+            {"$set": {
+                "status": "pending",
+                "run_at": now + timedelta(seconds=delay),
+                "last_error": str(error),
+                "updated_at": now,
+            }}
+        )
+
+    async def _requeue_after_crash(self, job: dict, error: Exception):
+        crashes = job.get("crashes", 0) + 1
+        if crashes >= MAX_CRASHES:
+            await self._fail(job, error)
+            return
+        logger.warning(f"Media job {job['id']} was running when its process died, requeued")
+        now = datetime.utcnow()
+        await self.jobs.update_one(
+            {"id": job["id"]},
+            {
+                "$set": {
+                    "status": "pending",
+                    "run_at": now,
+                    "last_error": "Process pool crashed",
+                    "updated_at": now,
+                },
+                # Give back the attempt _claim counted
+                "$inc": {"attempts": -1, "crashes": 1},
+            }
+        )
+
+    async def _set_media_status(self, job: dict, media_status: str):
+        if job["project_id"] is None:
+            return
+        # "processing" is passing, so it doesn't count as a change to the
+        # project: the catalog (and every ETag) is only refreshed for the
+        # result, not for the job starting as well
+        final = media_status != "processing"
+        await self.media_store.update(job["project_id"], job["media_id"], {"status": media_status}, touch=final)
+        if final and self.on_change:
+            await self.on_change(job)
+
+_worker: Optional[MediaJobWorker] = None
+
+def start_media_worker(db, **kwargs) -> MediaJobWorker:
+    global _worker
+    _worker = MediaJobWorker(db, **kwargs)
+    _worker.start()
+    return _worker
+
+async def stop_media_worker():
+    global _worker
+    if _worker is not None:
+        await _worker.stop()
+        _worker = None
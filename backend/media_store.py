@@ -0,0 +1,333 @@
+"""
+Where project media is stored
+
+Two layouts, chosen with MEDIA_LAYOUT:
+- "embedded" (default): media items live in each project's `media` array
+- "collection": one document per item in the `media` collection, keyed by
+  project_id, so per-item updates don't rewrite the whole project
+
+Either way projects are read with a `media` list, so API responses look the
+same. Switching to the collection layout is online: set MEDIA_LAYOUT=collection
+and run
+
+    python media_store.py migrate
+
+Until a project has been migrated its embedded items are still read, and the
+first write to it migrates it.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+
+from pymongo import DESCENDING, ReplaceOne, ReturnDocument, UpdateOne
+
+from catalog import MEDIA_PREVIEW_FIELDS, featured_images_pipeline, project_summary_pipeline
+
+logger = logging.getLogger(__name__)
+
+MEDIA_LAYOUT = os.environ.get("MEDIA_LAYOUT", "embedded")
+
+# A project whose embedded array keeps changing during migration is retried
+# this many times before giving up until its next write
+MAX_MIGRATION_ATTEMPTS = 5
+
+class EmbeddedMediaStore:
+    """Media items stored in the project document's `media` array"""
+
+    layout = "embedded"
+
+    def __init__(self, db):
+        self.db = db
+        self.projects = db.projects
+        # Collection the featured aggregation runs on
+        self.featured_source = "projects"
+
+    # ----- reads -----
+
+    async def attach(self, projects: List[dict]) -> List[dict]:
+        """Give project documents their `media` list, in place"""
+        for project in projects:
+            project.setdefault("media", [])
+        return projects
+
+    async def get(self, project_id: str, media_id: str) -> Optional[dict]:
+        project = await self.projects.find_one(
+            {"id": project_id, "media.id": media_id},
+            {"media.$": 1}
+        )
+        return project["media"][0] if project else None
+
+    async def next_order(self, project_id: str) -> int:
+        project = await self.projects.find_one({"id": project_id}, {"media.order": 1})
+        orders = [m.get("order", 0) for m in (project or {}).get("media", [])]
+        return max(orders, default=-1) + 1
+
+    def summary_pipeline(self, match: dict, limit: Optional[int] = None) -> List[dict]:
+        return project_summary_pipeline(match, limit)
+
+    def featured_pipeline(self, sample_size: Optional[int] = None) -> List[dict]:
+        return featured_images_pipeline(sample_size)
+
+    # ----- writes -----
+    # Each returns None/False when the project or item doesn't exist
+
+    async def add(self, project_id: str, items: List[dict]) -> bool:
+        update = await self.projects.update_one(
+            {"id": project_id},
+            {
+                "$push": {"media": {"$each": items}},
+                "$set": {"updated_at": datetime.utcnow()}
+            }
+        )
+        return update.matched_count > 0
+
+    async def delete(self, project_id: str, media_id: str) -> Optional[dict]:
+        """Remove an item, returning it"""
+        # Pull the media and get the removed item back in the same round trip
+        project = await self.projects.find_one_and_update(
+            {"id": project_id, "media.id": media_id},
+            {
+                "$pull": {"media": {"id": media_id}},
+                "$set": {"updated_at": datetime.utcnow()}
+            },
+            projection={"_id": 0, "media": {"$elemMatch": {"id": media_id}}},
+            return_document=ReturnDocument.BEFORE
+        )
+        return project["media"][0] if project else None
+
+    async def delete_all(self, project: dict) -> List[dict]:
+        """Items of a project that is being deleted, for removing their files"""
+        return project.get("media", [])
+
+    async def reorder(self, project_id: str, orders: Dict[str, int]) -> Optional[dict]:
+        """Set item orders; returns the updated project with its media"""
+        # Set each item's order in place via array filters, so media added or
+        # changed concurrently by another editor is left alone
+        update = {"updated_at": datetime.utcnow()}
+        array_filters = []
+        for i, (media_id, order) in enumerate(orders.items()):
+            update[f"media.$[m{i}].order"] = order
+            array_filters.append({f"m{i}.id": media_id})
+
+        return await self.projects.find_one_and_update(
+            {"id": project_id},
+            {"$set": update},
+            array_filters=array_filters or None,
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def update(self, project_id: str, media_id: str, fields: dict, touch: bool = True) -> bool:
+        """Set fields of one item; with touch=False the project's updated_at
+        is left alone, so catalogs don't pick the change up"""
+        update = {f"media.$.{key}": value for key, value in fields.items()}
+        if touch:
+            update["updated_at"] = datetime.utcnow()
+        result = await self.projects.update_one({"id": project_id, "media.id": media_id}, {"$set": update})
+        return result.matched_count > 0
+
+class CollectionMediaStore(EmbeddedMediaStore):
+    """Media items stored one per document in the `media` collection.
+
+    Writes also bump the project's updated_at, which keeps catalog sync,
+    polling and ETags working off the (now small) project documents."""
+
+    layout = "collection"
+
+    def __init__(self, db):
+        super().__init__(db)
+        self.media = db.media
+        self.featured_source = "media"
+        # Projects known to have no embedded array left
+        self._migrated: Set[str] = set()
+
+    # ----- reads -----
+
+    async def attach(self, projects: List[dict]) -> List[dict]:
+        if not projects:
+            return projects
+        by_project: Dict[str, List[dict]] = {}
+        cursor = self.media.find(
+            {"project_id": {"$in": [project["id"] for project in projects]}},
+            {"_id": 0}
+        ).sort("order", 1)
+        async for item in cursor:
+            by_project.setdefault(item.pop("project_id"), []).append(item)
+        for project in projects:
+            # Items of a project that isn't migrated yet are still embedded
+            project["media"] = project.get("media", []) + by_project.get(project["id"], [])
+        return projects
+
+    async def get(self, project_id: str, media_id: str) -> Optional[dict]:
+        item = await self.media.find_one(
+            {"id": media_id, "project_id": project_id}, {"_id": 0, "project_id": 0}
+        )
+        return item or await super().get(project_id, media_id)
+
+    async def next_order(self, project_id: str) -> int:
+        await self.migrate_project(project_id)
+        last = await self.media.find_one(
+            {"project_id": project_id}, {"order": 1}, sort=[("order", DESCENDING)]
+        )
+        return last.get("order", 0) + 1 if last else 0
+
+    def media_stages(self) -> List[dict]:
+        """Aggregation stages that fill in each project's `media` list"""
+        return [
+            {"$lookup": {"from": "media", "localField": "id", "foreignField": "project_id", "as": "_media"}},
+            {"$set": {"media": {"$concatArrays": [{"$ifNull": ["$media", []]}, "$_media"]}}},
+            {"$unset": "_media"},
+        ]
+
+    def summary_pipeline(self, match: dict, limit: Optional[int] = None) -> List[dict]:
+        return project_summary_pipeline(match, limit, media_stages=self.media_stages())
+
+    def featured_pipeline(self, sample_size: Optional[int] = None) -> List[dict]:
+        """Runs on the media collection: individually featured items, plus
+        the other items of featured projects. Items of projects that aren't
+        migrated yet are only in the catalog."""
+        pipeline = [
+            {"$match": {"featured": True}},
+            {"$unionWith": {"coll": "projects", "pipeline": [
+                {"$match": {"featured": True}},
+                {"$lookup": {"from": "media", "localField": "id", "foreignField": "project_id", "as": "media"}},
+                {"$unwind": "$media"},
+                {"$replaceRoot": {"newRoot": "$media"}},
+                {"$match": {"featured": {"$ne": True}}},
+            ]}},
+            {"$lookup": {"from": "projects", "localField": "project_id", "foreignField": "id", "as": "project"}},
+            {"$unwind": "$project"},
+            {"$project": {
+                "_id": 0,
+                "type": "$type",
+                "url": "$url",
+                "alt": {"$ifNull": ["$alt", ""]},
+                "variants": {"$ifNull": ["$variants", []]},
+                **{field: {"$ifNull": [f"${field}", None]} for field in MEDIA_PREVIEW_FIELDS},
+                "poster": {"$ifNull": ["$poster", None]},
+                "streams": {"$ifNull": ["$streams", []]},
+                "projectId": "$project.id",
+                "projectTitle": "$project.title"
+            }},
+        ]
+        if sample_size is not None:
+            pipeline.append({"$sample": {"size": sample_size}})
+        return pipeline
+
+    # ----- writes -----
+
+    async def _touch(self, project_id: str, **kwargs) -> Optional[dict]:
+        return await self.projects.find_one_and_update(
+            {"id": project_id},
+            {"$set": {"updated_at": datetime.utcnow()}},
+            **kwargs
+        )
+
+    async def add(self, project_id: str, items: List[dict]) -> bool:
+        if not await self.projects.find_one({"id": project_id}, {"_id": 1}):
+            return False
+        await self.migrate_project(project_id)
+        await self.media.insert_many([{**item, "project_id": project_id} for item in items])
+        if await self._touch(project_id, projection={"_id": 1}) is None:
+            # Deleted since the check, perhaps after its items were
+            # collected; these would be left behind
+            await self.media.delete_many({"id": {"$in": [item["id"] for item in items]}})
+            return False
+        return True
+
+    async def delete(self, project_id: str, media_id: str) -> Optional[dict]:
+        await self.migrate_project(project_id)
+        item = await self.media.find_one_and_delete(
+            {"id": media_id, "project_id": project_id},
+            projection={"_id": 0, "project_id": 0}
+        )
+        if item:
+            await self._touch(project_id, projection={"_id": 1})
+        return item
+
+    async def delete_all(self, project: dict) -> List[dict]:
+        items = await self.media.find({"project_id": project["id"]}, {"_id": 0}).to_list(None)
+        await self.media.delete_many({"project_id": project["id"]})
+        return project.get("media", []) + items
+
+    async def reorder(self, project_id: str, orders: Dict[str, int]) -> Optional[dict]:
+        await self.migrate_project(project_id)
+        if orders:
+            await self.media.bulk_write([
+                UpdateOne({"id": media_id, "project_id": project_id}, {"$set": {"order": order}})
+                for media_id, order in orders.items()
+            ], ordered=False)
+        project = await self._touch(project_id, return_document=ReturnDocument.AFTER)
+        if project:
+            await self.attach([project])
+        return project
+
+    async def update(self, project_id: str, media_id: str, fields: dict, touch: bool = True) -> bool:
+        await self.migrate_project(project_id)
+        update = await self.media.update_one({"id": media_id, "project_id": project_id}, {"$set": fields})
+        if update.matched_count == 0:
+            return False
+        if touch:
+            await self._touch(project_id, projection={"_id": 1})
+        return True
+
+    # ----- migration -----
+
+    async def migrate_project(self, project_id: str) -> int:
+        """Move a project's embedded items into the media collection; returns
+        how many were moved. Safe to run while other workers write to it."""
+        if project_id in self._migrated:
+            return 0
+        for _ in range(MAX_MIGRATION_ATTEMPTS):
+            project = await self.projects.find_one(
+                {"id": project_id, "media": {"$exists": True}}, {"media": 1}
+            )
+            if not project:
+                self._migrated.add(project_id)
+                return 0
+            items = project["media"]
+            if items:
+                # Replace rather than insert, so a retry overwrites older copies
+                await self.media.bulk_write([
+                    ReplaceOne({"id": item["id"]}, {**item, "project_id": project_id}, upsert=True)
+                    for item in items
+                ], ordered=False)
+            # Only drop the array if nobody changed it since it was copied
+            update = await self.projects.update_one(
+                {"id": project_id, "media": items},
+                {"$unset": {"media": ""}, "$set": {"updated_at": datetime.utcnow()}}
+            )
+            if update.modified_count:
+                self._migrated.add(project_id)
+                return len(items)
+        logger.warning(f"Project {project_id} media kept changing; will migrate on its next write")
+        return 0
+
+def media_store_for(db, layout: str = MEDIA_LAYOUT) -> EmbeddedMediaStore:
+    if layout == "collection":
+        return CollectionMediaStore(db)
+    if layout != "embedded":
+        raise ValueError(f"Unknown MEDIA_LAYOUT: {layout}")
+    return EmbeddedMediaStore(db)
+
+async def migrate(db):
+    store = CollectionMediaStore(db)
+    project_ids = await db.projects.distinct("id", {"media": {"$exists": True}})
+    print(f"Migrating media of {len(project_ids)} projects to the media collection")
+    moved = 0
+    for i, project_id in enumerate(project_ids, 1):
+        moved += await store.migrate_project(project_id)
+        print(f"[{i}/{len(project_ids)}] {project_id}")
+    remaining = await db.projects.count_documents({"media": {"$exists": True}})
+    print(f"Moved {moved} media items; {remaining} projects still have embedded media")
+    return remaining == 0
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["migrate"]:
+        print("Usage: python media_store.py migrate")
+        sys.exit(2)
+    from server import db
+    sys.exit(0 if asyncio.run(migrate(db)) else 1)
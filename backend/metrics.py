@@ -0,0 +1,257 @@
+"""
+Metrics in the Prometheus text format, served at /api/metrics
+
+- HTTP requests by method and route template (the path a route was declared
+  with, e.g. /api/projects/{project_id}, so cardinality stays bounded):
+  counts by status, a latency histogram and the number in flight
+- MongoDB commands by collection and command name: a latency histogram and
+  failures, from a pymongo command listener
+- Upload bytes received and upload/image bytes served, as counters; rate()
+  over them gives bytes per second
+
+Values are per server process, like the catalog; with several workers each
+one is scraped (or summed) separately. Recording a sample is a lock and a
+few dict operations, so it can run on every request and every command.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from pymongo import monitoring
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+MONGO_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Anything else is counted as OTHER, so junk methods can't add label values
+HTTP_METHODS = frozenset(("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"))
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in sorted(values):
+            yield f"{self.name}{_labels(self.label_names, labels)} {_number(value)}"
+
+class Gauge:
+    """Read when scraped: `collect` returns the current value by labels"""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...],
+                 collect: Callable[[], Dict[tuple, float]]):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.collect = collect
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        for labels, value in sorted(self.collect().items()):
+            yield f"{self.name}{_labels(self.label_names, labels)} {_number(value)}"
+
+class Histogram:
+    """Counts per bucket are kept uncumulated (one increment per sample) and
+    added up when rendered"""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...], buckets: Tuple[float, ...]):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [count per bucket (the last one is +Inf), sum]
+        self._series: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        for labels, counts, total in sorted(series, key=lambda s: s[0]):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                yield f"{self.name}_bucket{_labels(self.label_names, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.label_names, labels)} {_number(total)}"
+            yield f"{self.name}_count{_labels(self.label_names, labels)} {cumulative}"
+
+class Registry:
+    def __init__(self):
+        self.metrics: List = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> bytes:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return ("\n".join(lines) + "\n").encode()
+
+registry = Registry()
+
+# ===== HTTP =====
+
+def route_label(scope: Scope) -> str:
+    """Template of the route that handled the request: the route's path,
+    the prefix of a mounted app, or "unmatched" (404s, or not routed yet)"""
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    if "app_root_path" in scope:
+        # Set by Mount for the app it hands the request to
+        return scope["root_path"][len(scope["app_root_path"]):] or "/"
+    return "unmatched"
+
+# Scopes of the requests being handled, read when scraped, so the gauge
+# costs nothing per request beyond a dict insert and delete
+_active_requests: Dict[int, Scope] = {}
+
+def _in_flight() -> Dict[tuple, float]:
+    counts: Dict[tuple, float] = {}
+    for scope in list(_active_requests.values()):
+        key = (scope["method"] if scope["method"] in HTTP_METHODS else "OTHER", route_label(scope))
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+http_requests = registry.add(Counter(
+    "http_requests_total", "HTTP requests handled, by response status",
+    ("method", "route", "status")
+))
+http_request_duration = registry.add(Histogram(
+    "http_request_duration_seconds", "Time until the response was sent",
+    ("method", "route"), HTTP_BUCKETS
+))
+registry.add(Gauge(
+    "http_requests_in_flight", "HTTP requests being handled",
+    ("method", "route"), _in_flight
+))
+
+class MetricsMiddleware:
+    """Times every HTTP request and counts it by route and status. Added
+    last, so the time includes the other middleware."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500  # if the app fails before starting a response
+
+        async def send_with_status(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        key = id(scope)
+        _active_requests[key] = scope
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            duration = time.perf_counter() - start
+            del _active_requests[key]
+            method = scope["method"] if scope["method"] in HTTP_METHODS else "OTHER"
+            route = route_label(scope)
+            http_request_duration.observe(duration, method, route)
+            http_requests.inc(method, route, str(status))
+
+# ===== MongoDB =====
+
+mongo_command_duration = registry.add(Histogram(
+    "mongodb_command_duration_seconds", "MongoDB command round trips, by collection",
+    ("collection", "command"), MONGO_BUCKETS
+))
+mongo_command_failures = registry.add(Counter(
+    "mongodb_command_failures_total", "MongoDB commands that returned an error",
+    ("collection", "command")
+))
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Passed to the Mongo client in event_listeners. The events come from
+    the driver's threads; the collection is only in the started event, so
+    it is kept until the command finishes."""
+
+    def __init__(self):
+        self._collections: Dict[tuple, str] = {}
+
+    @staticmethod
+    def _collection(event: monitoring.CommandStartedEvent) -> str:
+        # {"find": "projects", ...}; getMore names it separately and
+        # database commands (e.g. ping) have none
+        target = event.command.get(event.command_name)
+        if isinstance(target, str):
+            return target
+        return event.command.get("collection", "")
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        self._collections[(event.request_id, event.connection_id)] = self._collection(event)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        collection = self._collections.pop((event.request_id, event.connection_id), "")
+        mongo_command_duration.observe(event.duration_micros / 1e6, collection, event.command_name)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        collection = self._collections.pop((event.request_id, event.connection_id), "")
+        mongo_command_duration.observe(event.duration_micros / 1e6, collection, event.command_name)
+        mongo_command_failures.inc(collection, event.command_name)
+
+# ===== Bytes =====
+
+upload_bytes_received = registry.add(Counter(
+    "upload_bytes_received_total", "Request body bytes of uploads, by upload kind",
+    ("kind",)
+))
+static_bytes_served = registry.add(Counter(
+    "static_bytes_served_total", "File bytes sent in responses, by source",
+    ("source",)
+))
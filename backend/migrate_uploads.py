@@ -0,0 +1,140 @@
+"""
+Move uploads from the flat uploads directory into the sharded layout
+
+    python migrate_uploads.py [--batch-size N]
+
+Files are moved first, then the URLs stored in Mongo are rewritten in batches.
+Both steps only pick up what is still in the old layout, so the command can be
+stopped and run again at any time. Old URLs keep working throughout, because
+the uploads route finds files in either layout.
+"""
+
+import argparse
+import asyncio
+import os
+import re
+from datetime import datetime
+from typing import List, Optional
+
+from pymongo import UpdateOne
+
+from utils import UPLOAD_DIR, shard_prefix
+
+DEFAULT_BATCH_SIZE = 100
+
+# URL of a file directly in the uploads directory
+FLAT_UPLOAD_URL = re.compile(r"^(?:/api)?/uploads/[^/]+$")
+
+def sharded_url(url: str) -> str:
+    base, filename = url.rsplit("/", 1)
+    return f"{base}/{shard_prefix(filename)}/{filename}"
+
+def rewrite_url(url: Optional[str]) -> Optional[str]:
+    return sharded_url(url) if url and FLAT_UPLOAD_URL.match(url) else url
+
+def rewrite_variants(variants: List[dict]) -> List[dict]:
+    return [{**variant, "url": rewrite_url(variant["url"])} for variant in variants]
+
+def needs_rewrite(media: dict) -> bool:
+    return any(
+        FLAT_UPLOAD_URL.match(url or "")
+        for url in [media.get("url")] + [v.get("url") for v in media.get("variants", [])]
+    )
+
+def move_files() -> int:
+    """Move every file of the flat layout into its shard directory"""
+    moved = 0
+    with os.scandir(UPLOAD_DIR) as entries:
+        for entry in entries:
+            # Hidden entries are in-progress uploads
+            if entry.name.startswith(".") or not entry.is_file(follow_symlinks=False):
+                continue
+            target = UPLOAD_DIR / shard_prefix(entry.name) / entry.name
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(entry.path, target)
+            moved += 1
+            if moved % 1000 == 0:
+                print(f"  moved {moved} files")
+    return moved
+
+async def rewrite_embedded_media(db, batch_size: int) -> int:
+    """Rewrite media URLs inside project documents, one batch of projects per
+    bulk write. Items are addressed by id, so concurrent edits are kept."""
+    flat = {"$regex": FLAT_UPLOAD_URL.pattern}
+    query = {"$or": [{"media.url": flat}, {"media.variants.url": flat}]}
+    rewritten = 0
+    while True:
+        projects = await db.projects.find(query, {"id": 1, "media": 1}).to_list(batch_size)
+        if not projects:
+            return rewritten
+        operations = []
+        for project in projects:
+            update = {"updated_at": datetime.utcnow()}
+            array_filters = []
+            for i, media in enumerate(m for m in project["media"] if needs_rewrite(m)):
+                update[f"media.$[m{i}].url"] = rewrite_url(media["url"])
+                update[f"media.$[m{i}].variants"] = rewrite_variants(media.get("variants", []))
+                array_filters.append({f"m{i}.id": media["id"]})
+            operations.append(
+                UpdateOne({"_id": project["_id"]}, {"$set": update}, array_filters=array_filters)
+            )
+        result = await db.projects.bulk_write(operations, ordered=False)
+        rewritten += len(projects)
+        print(f"  rewrote media URLs of {rewritten} projects")
+        if result.modified_count == 0:
+            # Nothing changed, so the same batch would come back forever
+            raise RuntimeError("Media URLs could not be rewritten")
+
+async def rewrite_media_collection(db, batch_size: int) -> int:
+    """Same for the media collection layout (see media_store.py)"""
+    flat = {"$regex": FLAT_UPLOAD_URL.pattern}
+    query = {"$or": [{"url": flat}, {"variants.url": flat}]}
+    rewritten = 0
+    while True:
+        items = await db.media.find(query, {"url": 1, "variants": 1, "project_id": 1}).to_list(batch_size)
+        if not items:
+            return rewritten
+        result = await db.media.bulk_write([
+            UpdateOne({"_id": item["_id"]}, {"$set": {
+                "url": rewrite_url(item["url"]),
+                "variants": rewrite_variants(item.get("variants", [])),
+            }})
+            for item in items
+        ], ordered=False)
+        # Lets every worker's catalog pick up the new URLs
+        await db.projects.update_many(
+            {"id": {"$in": list({item["project_id"] for item in items})}},
+            {"$set": {"updated_at": datetime.utcnow()}}
+        )
+        rewritten += len(items)
+        print(f"  rewrote {rewritten} media items")
+        if result.modified_count == 0:
+            raise RuntimeError("Media URLs could not be rewritten")
+
+async def rewrite_logo(db) -> bool:
+    settings = await db.settings.find_one({}, {"logo_url": 1, "logo_variants": 1})
+    logo = {"url": settings.get("logo_url"), "variants": settings.get("logo_variants", [])} if settings else {}
+    if not logo or not needs_rewrite(logo):
+        return False
+    await db.settings.update_one({"_id": settings["_id"]}, {"$set": {
+        "logo_url": rewrite_url(logo["url"]),
+        "logo_variants": rewrite_variants(logo["variants"]),
+        "updated_at": datetime.utcnow(),
+    }})
+    return True
+
+async def migrate(db, batch_size: int):
+    print(f"Moving files in {UPLOAD_DIR} into shard directories")
+    print(f"Moved {move_files()} files")
+    print("Rewriting media URLs")
+    projects = await rewrite_embedded_media(db, batch_size)
+    items = await rewrite_media_collection(db, batch_size)
+    logo = await rewrite_logo(db)
+    print(f"Rewrote URLs in {projects} projects, {items} media items{' and the logo' if logo else ''}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+    from server import db
+    asyncio.run(migrate(db, args.batch_size))
@@ -1,5 +1,5 @@
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from pydantic import BaseModel, Field, field_validator
+from typing import Dict, List, Optional
 from datetime import datetime
 import uuid
 
@@ -21,6 +21,19 @@ class Token(BaseModel):
     user: UserResponse
 
 # Media Models
+class MediaVariant(BaseModel):
+    url: str
+    width: int
+    height: int
+    format: str  # 'webp', 'jpeg' or 'png'
+    size: int  # bytes
+
+class VideoStream(BaseModel):
+    url: str
+    format: str  # 'hls' (master playlist), 'mp4' or 'webm'
+    height: Optional[int] = None  # short side of the frame; None for the HLS ladder
+    bitrate: Optional[int] = None  # video kbps
+
 class Media(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     type: str  # 'image' or 'video'
@@ -28,6 +41,45 @@ class Media(BaseModel):
     alt: str = ""
     order: int = 0
     featured: bool = False  # Individual media can be featured
+    variants: List[MediaVariant] = []  # Resized copies for srcset
+    status: str = "ready"  # 'pending', 'processing', 'ready' or 'failed'
+    # Filled in when an image is processed, for layout and first paint
+    width: Optional[int] = None
+    height: Optional[int] = None
+    placeholder: Optional[str] = None  # tiny blurred copy as a data URI
+    color: Optional[str] = None  # dominant color, '#rrggbb'
+    # Filled in when a video is processed
+    poster: Optional[str] = None  # still frame shown before playback
+    streams: List[VideoStream] = []  # transcoded renditions, HLS first
+
+class MediaUploadResult(BaseModel):
+    filename: str
+    media: Optional[Media] = None
+    error: Optional[str] = None
+
+# Resumable upload Models
+class ResumableUploadCreate(BaseModel):
+    filename: str
+    size: int  # total bytes
+
+class ResumableUpload(BaseModel):
+    id: str
+    project_id: str
+    filename: str
+    size: int
+    offset: int = 0  # bytes received so far
+    media: Optional[Media] = None  # set once the last chunk arrived
+
+# Direct-to-storage upload Models
+class DirectUploadCreate(BaseModel):
+    filename: str
+    size: int  # total bytes
+    sha256: str = Field(pattern=r"^[0-9a-f]{64}$")  # hex digest of the content
+
+class DirectUpload(BaseModel):
+    file_url: str
+    upload_url: Optional[str] = None  # PUT the file here with `headers`; None if already stored
+    headers: Dict[str, str] = {}
 
 # Project Models
 class ProjectCreate(BaseModel):
@@ -64,10 +116,32 @@ class Project(BaseModel):
     created_at: datetime
     updated_at: datetime
 
+    @field_validator("media")
+    @classmethod
+    def sort_media(cls, media: List[Media]) -> List[Media]:
+        # Media order is updated in place, so the stored array isn't sorted
+        return sorted(media, key=lambda m: m.order)
+
+class ProjectSummary(BaseModel):
+    """Project listing entry: no media array, just what a list needs"""
+    id: str
+    title: str
+    client: str
+    date: str
+    location: str
+    featured: bool
+    published: bool = True
+    order: int = 0
+    cover: Optional[Media] = None  # first image by order, else first media
+    media_count: int = 0
+    created_at: datetime
+    updated_at: datetime
+
 # Settings Models
 class SiteSettings(BaseModel):
     brand_name: str = "Your Name"
     logo_url: Optional[str] = None
+    logo_variants: List[MediaVariant] = []
     contact_email: str = ""
     contact_phone: str = ""
     instagram_url: str = "https://instagram.com"
@@ -1,31 +1,59 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, status
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Response, Header, Query, status
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
 from datetime import datetime, timedelta
 import os
+import hmac
 import logging
 import re
 from pathlib import Path
-from typing import List
+from typing import List, Optional
+import random
+import uuid
+import asyncio
+
+import anyio
 
 from models import (
     UserCreate, UserLogin, UserResponse, Token,
     ProjectCreate, ProjectUpdate, Project, Media, MediaReorder, ProjectReorder,
-    SiteSettings, SiteSettingsUpdate
+    ProjectSummary, SiteSettings, SiteSettingsUpdate, ResumableUploadCreate, ResumableUpload,
+    MediaUploadResult, DirectUploadCreate, DirectUpload
 )
 from auth import (
-    get_password_hash, verify_password, create_access_token, verify_token
+    get_password_hash_async, verify_password_async, create_access_token, verify_token,
+    client_ip, login_limits, login_throttle
+)
+from utils import (
+    create_project_slug, get_file_type, content_upload_url, upload_relative_path,
+    matches_magic_bytes, UploadTooLarge, PARTIAL_UPLOAD_DIR, MAX_UPLOAD_SIZES, MAGIC_HEADER_SIZE
+)
+from catalog import Catalog, after_cursor_filter, decode_cursor, encode_cursor, sort_key, paginate
+from invalidation import CatalogSync
+from static_files import CORSStaticFiles, CountedFileResponse, StorageRedirect, IMMUTABLE_CACHE_CONTROL
+from http_cache import RenderCache, conditional_response, render_json, json_response, make_etag, is_not_modified
+from upload_stream import (
+    SavedUpload, partial_upload_digests, stream_uploads, stream_single_upload, write_body_at_offset
 )
-from utils import save_upload_file, delete_upload_file, create_project_slug
+from jobs import (
+    JOB_HANDLERS, new_media_job, enqueue_media_job, enqueue_media_jobs, start_media_worker, stop_media_worker
+)
+from indexes import ensure_indexes
+from media_store import media_store_for
+from content_store import commit_upload, commit_uploads, release_media
+from storage import upload_storage
+from image_cache import DiskLRUCache, ImageResizer, Rendition, IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsMiddleware, MongoCommandMetrics, registry
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[MongoCommandMetrics()])
 # Handle different DB_NAME variable formats (graceful fallback)
 db_name = os.environ.get('DB_NAME') or os.environ.get('db_name') or os.environ.get('db-name') or 'photography_portfolio'
 print(f"[INFO] Using database: {db_name}")
@@ -35,25 +63,33 @@ db = client[db_name]
 users_collection = db.users
 projects_collection = db.projects
 settings_collection = db.settings
+upload_sessions_collection = db.upload_sessions
+
+# Embedded media arrays or the media collection, per MEDIA_LAYOUT
+media_store = media_store_for(db)
+
+# Public reads are served from this in-process snapshot once it is loaded
+catalog = Catalog(db, media_store)
+# Applies writes made by other workers/replicas to this worker's catalog
+catalog_sync = CatalogSync(db, catalog)
+# Rendered public responses with their ETags, per catalog version
+render_cache = RenderCache()
+# Uploads resized on demand by /api/img
+image_resizer = ImageResizer(DiskLRUCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES))
 
-# Create the main app without a prefix
-app = FastAPI()
+# Create the main app without a prefix; responses of routes returning
+# models are encoded with orjson
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
-# Mount uploads directory BEFORE api routes with /api prefix
-class CORSStaticFiles(StaticFiles):
-    async def get_response(self, path: str, scope):
-        response = await super().get_response(path, scope)
-        response.headers["Access-Control-Allow-Origin"] = "*"
-        response.headers["Cross-Origin-Resource-Policy"] = "cross-origin"
-        return response
-
-# Mount uploads directory using relative path
-uploads_dir = Path(__file__).parent / "uploads"
-uploads_dir.mkdir(exist_ok=True, parents=True)
-app.mount("/api/uploads", CORSStaticFiles(directory=str(uploads_dir)), name="uploads")
+# Uploads are served from the local uploads directory, or redirected to the
+# bucket holding them (see storage.py)
+if upload_storage.name == "local":
+    app.mount("/api/uploads", CORSStaticFiles(directory=str(upload_storage.root)), name="uploads")
+else:
+    app.mount("/api/uploads", StorageRedirect(upload_storage), name="uploads")
 
 # Configure logging
 logging.basicConfig(
@@ -65,7 +101,7 @@ logger = logging.getLogger(__name__)
 # ===== Authentication Routes =====
 
 @api_router.post("/auth/register", response_model=dict)
-async def register(user: UserCreate):
+async def register(user: UserCreate, request: Request):
     # Check if any user exists
     existing_users = await users_collection.count_documents({})
     if existing_users > 0:
@@ -82,7 +118,7 @@ async def register(user: UserCreate):
         )
     
     # Create user
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await get_password_hash_async(user.password, client_ip(request))
     user_doc = {
         "username": user.username,
         "password": hashed_password,
@@ -93,13 +129,30 @@ async def register(user: UserCreate):
     return {"message": "User created successfully", "user": {"username": user.username}}
 
 @api_router.post("/auth/login", response_model=Token)
-async def login(user: UserLogin):
+async def login(user: UserLogin, request: Request):
+    # Failed logins are throttled per address and per username from an address
+    ip = client_ip(request)
+    limits = login_limits(ip, user.username)
+    retry_after = login_throttle.retry_after(limits)
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many failed logins, try again later",
+            headers={"Retry-After": str(retry_after)}
+        )
+    # The attempt counts as failed until the password checks out, so
+    # concurrent attempts can't get past the limits while they wait
+    (ip_key, _), (user_key, _) = limits
+    login_throttle.fail(ip_key, user_key)
+    
     db_user = await users_collection.find_one({"username": user.username})
-    if not db_user or not verify_password(user.password, db_user["password"]):
+    if not await verify_password_async(user.password, db_user["password"] if db_user else None, ip):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password"
         )
+    login_throttle.clear(user_key)
+    login_throttle.forgive(ip_key)
     
     access_token = create_access_token(
         data={"sub": user.username},
@@ -114,46 +167,101 @@ async def login(user: UserLogin):
 
 # ===== Project Routes =====
 
-@api_router.get("/projects", response_model=List[Project])
-async def get_projects():
-    # Only return published projects for public view, sorted by order field
-    projects = await projects_collection.find({"published": True}).sort("order", 1).to_list(100)
-    return [Project(**project) for project in projects]
+# Projects per page of the project lists unless ?limit= says otherwise
+PROJECTS_PAGE_SIZE = 100
+
+def next_page_headers(request: Request, next_cursor: Optional[str]) -> dict:
+    """X-Next-Cursor / Link headers pointing at the following page"""
+    if not next_cursor:
+        return {}
+    next_url = request.url.include_query_params(cursor=next_cursor)
+    return {"X-Next-Cursor": next_cursor, "Link": f'<{next_url}>; rel="next"'}
+
+async def find_project_summaries(match: dict, cursor: Optional[str], limit: int):
+    """One page of summaries straight from Mongo, plus the next page's cursor"""
+    if cursor:
+        match = {**match, **after_cursor_filter(decode_cursor(cursor))}
+    docs = await projects_collection.aggregate(media_store.summary_pipeline(match, limit + 1)).to_list(None)
+    page = [ProjectSummary(**doc) for doc in docs[:limit]]
+    next_cursor = encode_cursor(sort_key(page[-1])) if len(docs) > limit else None
+    return page, next_cursor
+
+@api_router.get("/projects", response_model=List[ProjectSummary])
+async def get_projects(
+    request: Request,
+    limit: int = Query(PROJECTS_PAGE_SIZE, ge=1, le=500),
+    cursor: Optional[str] = None
+):
+    # Only published projects for public view, ordered by (order, id); full
+    # media arrays are only returned by GET /projects/{id}
+    try:
+        if catalog.loaded:
+            page, next_cursor = paginate(catalog.project_summaries(), cursor, limit)
+            if cursor is None and limit == PROJECTS_PAGE_SIZE:
+                body, etag = render_cache.get(catalog.version, "projects", lambda: page)
+            else:
+                # Any cursor and limit can be asked for, so other pages
+                # aren't cached
+                body = render_json(page)
+                etag = make_etag(body)
+        else:
+            page, next_cursor = await find_project_summaries({"published": True}, cursor, limit)
+            body = render_json(page)
+            etag = make_etag(body)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return conditional_response(request, body, etag, headers=next_page_headers(request, next_cursor))
 
-@api_router.get("/admin/projects", response_model=List[Project])
-async def get_all_projects(username: str = Depends(verify_token)):
-    # Admin can see all projects including drafts, sorted by order field
-    projects = await projects_collection.find().sort("order", 1).to_list(100)
-    return [Project(**project) for project in projects]
+@api_router.get("/admin/projects", response_model=List[ProjectSummary])
+async def get_all_projects(
+    request: Request,
+    limit: int = Query(PROJECTS_PAGE_SIZE, ge=1, le=500),
+    cursor: Optional[str] = None,
+    username: str = Depends(verify_token)
+):
+    # Admin can see all projects including drafts, read from Mongo so edits
+    # show up immediately
+    try:
+        page, next_cursor = await find_project_summaries({}, cursor, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return json_response(page, headers=next_page_headers(request, next_cursor))
 
 
-@api_router.put("/projects/reorder")
+@api_router.put("/projects/reorder", response_model=List[ProjectSummary])
 async def reorder_projects(
     reorder: ProjectReorder,
     username: str = Depends(verify_token)
 ):
-    # Update order for each project
-    for item in reorder.project_order:
-        await projects_collection.update_one(
-            {"id": item["id"]},
-            {
-                "$set": {
-                    "order": item["order"],
-                    "updated_at": datetime.utcnow()
-                }
-            }
-        )
+    # Update every project's order in one round trip
+    now = datetime.utcnow()
+    operations = [
+        UpdateOne({"id": item["id"]}, {"$set": {"order": item["order"], "updated_at": now}})
+        for item in reorder.project_order
+    ]
+    if operations:
+        await projects_collection.bulk_write(operations, ordered=False)
+    
+    await catalog.refresh_projects()
     
     # Return updated projects list
-    projects = await projects_collection.find().sort("order", 1).to_list(100)
-    return [Project(**project) for project in projects]
+    return json_response(catalog.project_summaries(published_only=False))
 
 @api_router.get("/projects/{project_id}", response_model=Project)
-async def get_project(project_id: str):
+async def get_project(project_id: str, request: Request):
+    if catalog.loaded:
+        project = catalog.get_project(project_id)
+        if not project:
+            raise HTTPException(status_code=404, detail="Project not found")
+        body, etag = render_cache.get(catalog.version, f"project:{project_id}", lambda: project)
+        return conditional_response(request, body, etag)
+    
     project = await projects_collection.find_one({"id": project_id})
     if not project:
         raise HTTPException(status_code=404, detail="Project not found")
-    return Project(**project)
+    await media_store.attach([project])
+    body = render_json(Project(**project))
+    return conditional_response(request, body, make_etag(body))
 
 @api_router.post("/projects", response_model=Project)
 async def create_project(
@@ -175,14 +283,18 @@ async def create_project(
         "date": project.date,
         "location": project.location,
         "description": project.description,
-        "media": [],
         "featured": project.featured,
         "published": project.published if hasattr(project, 'published') else True,
+        "order": project.order,
         "created_at": datetime.utcnow(),
         "updated_at": datetime.utcnow()
     }
+    if media_store.layout == "embedded":
+        # The collection layout keeps items out of the project document
+        project_doc["media"] = []
     
     await projects_collection.insert_one(project_doc)
+    await catalog.refresh_project(project_id)
     return Project(**project_doc)
 
 @api_router.put("/projects/{project_id}", response_model=Project)
@@ -203,7 +315,10 @@ async def update_project(
         {"$set": update_data}
     )
     
+    await catalog.refresh_project(project_id)
+    
     updated_project = await projects_collection.find_one({"id": project_id})
+    await media_store.attach([updated_project])
     return Project(**updated_project)
 
 @api_router.delete("/projects/{project_id}")
@@ -211,84 +326,366 @@ async def delete_project(
     project_id: str,
     username: str = Depends(verify_token)
 ):
-    project = await projects_collection.find_one({"id": project_id})
+    # Removed before its media is collected, so media added meanwhile is
+    # either collected below or refused for the missing project
+    project = await projects_collection.find_one_and_delete({"id": project_id})
     if not project:
         raise HTTPException(status_code=404, detail="Project not found")
     
-    # Delete all media files
-    for media in project.get("media", []):
-        delete_upload_file(media["url"])
+    # Delete media files no other project uses
+    for media in await media_store.delete_all(project):
+        await release_media(db, media)
     
-    await projects_collection.delete_one({"id": project_id})
+    await catalog.refresh_project(project_id)
     return {"message": "Project deleted successfully"}
 
 # ===== Media Routes =====
 
+# Files per batch upload request, and how many of them are finalized on disk at once
+MAX_BATCH_FILES = 100
+BATCH_UPLOAD_CONCURRENCY = 4
+
+async def add_media_to_project(project_id: str, uploads: List[SavedUpload]) -> List[Media]:
+    """Append stored uploads to a project's media in one write and queue
+    their processing"""
+    next_order = await media_store.next_order(project_id)
+    
+    # Images are resized and videos transcoded by the media job worker; the
+    # original is served until then
+    media_items = [
+        Media(
+            type=upload.file_type,
+            url=upload.file_url,
+            alt=upload.original_filename,
+            order=next_order + i,
+            status="pending" if upload.file_type in JOB_HANDLERS else "ready"
+        )
+        for i, upload in enumerate(uploads)
+    ]
+    if not media_items:
+        return []
+    
+    # Identical files are stored once and shared by reference
+    await commit_uploads(db, uploads)
+    if not await media_store.add(project_id, [media.dict() for media in media_items]):
+        # The project was deleted meanwhile
+        for upload in uploads:
+            await release_media(db, {"url": upload.file_url})
+        raise HTTPException(status_code=404, detail="Project not found")
+    await catalog.refresh_project(project_id)
+    
+    await enqueue_media_jobs(db, [
+        new_media_job(media.type, media.url, project_id=project_id, media_id=media.id)
+        for media in media_items if media.type in JOB_HANDLERS
+    ])
+    
+    return media_items
+
 @api_router.post("/projects/{project_id}/media", response_model=Media)
 async def upload_media(
     project_id: str,
-    file: UploadFile = File(...),
+    request: Request,
     username: str = Depends(verify_token)
 ):
-    project = await projects_collection.find_one({"id": project_id})
-    if not project:
+    if not await projects_collection.find_one({"id": project_id}, {"_id": 1}):
         raise HTTPException(status_code=404, detail="Project not found")
     
+    # The multipart body is streamed to disk as it arrives
     try:
-        file_url, file_type = await save_upload_file(file)
+        upload = await stream_single_upload(request)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     
-    # Get current max order
-    current_media = project.get("media", [])
-    max_order = max([m.get("order", 0) for m in current_media], default=-1)
+    media_items = await add_media_to_project(project_id, [upload])
+    return media_items[0]
+
+@api_router.post("/projects/{project_id}/media/batch", response_model=List[MediaUploadResult])
+async def upload_media_batch(
+    project_id: str,
+    request: Request,
+    username: str = Depends(verify_token)
+):
+    if not await projects_collection.find_one({"id": project_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Project not found")
     
-    media = Media(
-        type=file_type,
-        url=file_url,
-        alt=file.filename,
-        order=max_order + 1
-    )
+    try:
+        uploads = await stream_uploads(
+            request, max_files=MAX_BATCH_FILES, concurrency=BATCH_UPLOAD_CONCURRENCY
+        )
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
-    await projects_collection.update_one(
-        {"id": project_id},
+    # One write for all accepted files
+    media_items = iter(await add_media_to_project(project_id, [u for u in uploads if not u.error]))
+    
+    # Per-file results in request order so partial failures are visible
+    return [
+        MediaUploadResult(filename=u.original_filename, error=str(u.error))
+        if u.error else
+        MediaUploadResult(filename=u.original_filename, media=next(media_items))
+        for u in uploads
+    ]
+
+# ===== Resumable Upload Routes =====
+# init (POST) -> send chunks (PATCH with Upload-Offset) -> the last chunk
+# creates the media. GET reports the offset to resume from after a failure.
+
+RESUMABLE_UPLOAD_TTL = timedelta(hours=24)
+# How long a PATCH may hold an upload before another one can take over
+RESUMABLE_UPLOAD_LOCK = timedelta(minutes=10)
+
+def partial_upload_path(upload_id: str) -> Path:
+    return PARTIAL_UPLOAD_DIR / upload_id
+
+def check_declared_upload(filename: str, size: int):
+    """(extension, type) of an upload announced before its bytes are sent"""
+    try:
+        file_ext, file_type = get_file_type(filename)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if size <= 0:
+        raise HTTPException(status_code=400, detail="Upload size must be positive")
+    if size > MAX_UPLOAD_SIZES[file_type]:
+        raise HTTPException(status_code=413, detail="File exceeds the maximum allowed size")
+    return file_ext, file_type
+
+async def discard_upload_session(session: dict):
+    partial_upload_digests.discard(session["id"])
+    await upload_sessions_collection.delete_one({"id": session["id"]})
+    await anyio.to_thread.run_sync(lambda: partial_upload_path(session["id"]).unlink(missing_ok=True))
+
+@api_router.post("/projects/{project_id}/uploads", response_model=ResumableUpload)
+async def create_resumable_upload(
+    project_id: str,
+    upload: ResumableUploadCreate,
+    username: str = Depends(verify_token)
+):
+    if not await projects_collection.find_one({"id": project_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Project not found")
+    
+    file_ext, file_type = check_declared_upload(upload.filename, upload.size)
+    
+    # Drop sessions abandoned long ago
+    expired = await upload_sessions_collection.find(
+        {"updated_at": {"$lt": datetime.utcnow() - RESUMABLE_UPLOAD_TTL}}
+    ).to_list(100)
+    for session in expired:
+        await discard_upload_session(session)
+    
+    session = {
+        "id": str(uuid.uuid4()),
+        "project_id": project_id,
+        "filename": upload.filename,
+        "file_ext": file_ext,
+        "file_type": file_type,
+        "size": upload.size,
+        "offset": 0,
+        "locked_until": None,
+        "created_at": datetime.utcnow(),
+        "updated_at": datetime.utcnow()
+    }
+    await anyio.to_thread.run_sync(partial_upload_path(session["id"]).touch)
+    await upload_sessions_collection.insert_one(session)
+    return ResumableUpload(**session)
+
+@api_router.get("/projects/{project_id}/uploads/{upload_id}", response_model=ResumableUpload)
+async def get_resumable_upload(
+    project_id: str,
+    upload_id: str,
+    username: str = Depends(verify_token)
+):
+    session = await upload_sessions_collection.find_one({"id": upload_id, "project_id": project_id})
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return ResumableUpload(**session)
+
+@api_router.patch("/projects/{project_id}/uploads/{upload_id}", response_model=ResumableUpload)
+async def append_resumable_upload(
+    project_id: str,
+    upload_id: str,
+    request: Request,
+    upload_offset: int = Header(...),
+    username: str = Depends(verify_token)
+):
+    # Take the upload only if the client resumes from the offset we have,
+    # so two PATCHes can never write the same range
+    now = datetime.utcnow()
+    session = await upload_sessions_collection.find_one_and_update(
         {
-            "$push": {"media": media.dict()},
-            "$set": {"updated_at": datetime.utcnow()}
-        }
+            "id": upload_id,
+            "project_id": project_id,
+            "offset": upload_offset,
+            "$or": [{"locked_until": None}, {"locked_until": {"$lt": now}}]
+        },
+        {"$set": {"locked_until": now + RESUMABLE_UPLOAD_LOCK}}
     )
+    if not session:
+        current = await upload_sessions_collection.find_one({"id": upload_id, "project_id": project_id})
+        if not current:
+            raise HTTPException(status_code=404, detail="Upload not found")
+        raise HTTPException(
+            status_code=409,
+            detail=f"Upload offset mismatch, resume from {current['offset']}",
+            headers={"Upload-Offset": str(current["offset"])}
+        )
+    
+    try:
+        # The content hash is updated as the chunk is written, so the
+        # finished file needn't be read again
+        digest = await partial_upload_digests.resume(upload_id, partial_upload_path(upload_id), upload_offset)
+        written = await write_body_at_offset(
+            request,
+            partial_upload_path(upload_id),
+            upload_offset,
+            max_bytes=session["size"] - upload_offset,
+            file_ext=session["file_ext"],
+            digest=digest
+        )
+    except UploadTooLarge as e:
+        await upload_sessions_collection.update_one({"id": upload_id}, {"$set": {"locked_until": None}})
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        await upload_sessions_collection.update_one({"id": upload_id}, {"$set": {"locked_until": None}})
+        raise HTTPException(status_code=400, detail=str(e))
     
-    return media
+    session["offset"] = upload_offset + written
+    partial_upload_digests.store(upload_id, session["offset"], digest)
+    await upload_sessions_collection.update_one(
+        {"id": upload_id},
+        {"$set": {"offset": session["offset"], "locked_until": None, "updated_at": datetime.utcnow()}}
+    )
+    
+    if session["offset"] < session["size"]:
+        return ResumableUpload(**session)
+    
+    # Last chunk: the partial file already is the complete upload, and its
+    # hash is complete too; it is committed to the content-addressed store
+    if not await projects_collection.find_one({"id": project_id}, {"_id": 1}):
+        await discard_upload_session(session)
+        raise HTTPException(status_code=404, detail="Project not found")
+    
+    partial_upload_digests.discard(upload_id)
+    await upload_sessions_collection.delete_one({"id": upload_id})
+    
+    upload = SavedUpload(
+        original_filename=session["filename"],
+        file_url=content_upload_url(digest.hexdigest(), session["file_ext"]),
+        file_type=session["file_type"],
+        size=session["size"],
+        temp_path=partial_upload_path(upload_id)
+    )
+    session["media"] = (await add_media_to_project(project_id, [upload]))[0]
+    return ResumableUpload(**session)
 
-@api_router.delete("/projects/{project_id}/media/{media_id}")
-async def delete_media(
+@api_router.delete("/projects/{project_id}/uploads/{upload_id}")
+async def cancel_resumable_upload(
     project_id: str,
-    media_id: str,
+    upload_id: str,
     username: str = Depends(verify_token)
 ):
-    project = await projects_collection.find_one({"id": project_id})
-    if not project:
+    session = await upload_sessions_collection.find_one({"id": upload_id, "project_id": project_id})
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    await discard_upload_session(session)
+    return {"message": "Upload cancelled"}
+
+# ===== Direct Upload Routes =====
+# With an object store the admin UI PUTs files straight into the bucket:
+# announce (POST, returns a presigned URL) -> PUT to the bucket -> complete
+# (POST, creates the media). Files are keyed by their SHA-256, which the
+# bucket verifies, so content that is already stored isn't sent again.
+
+@api_router.post("/projects/{project_id}/direct-uploads", response_model=DirectUpload)
+async def create_direct_upload(
+    project_id: str,
+    upload: DirectUploadCreate,
+    username: str = Depends(verify_token)
+):
+    if not upload_storage.direct_uploads:
+        # The client falls back to uploading through the API
+        raise HTTPException(status_code=501, detail="Uploads are stored by the API")
+    if not await projects_collection.find_one({"id": project_id}, {"_id": 1}):
         raise HTTPException(status_code=404, detail="Project not found")
     
-    # Find and delete media
-    media_item = None
-    for media in project.get("media", []):
-        if media["id"] == media_id:
-            media_item = media
-            break
+    file_ext, _ = check_declared_upload(upload.filename, upload.size)
+    file_url = content_upload_url(upload.sha256, file_ext)
+    key = upload_relative_path(file_url)
+    if await upload_storage.exists(key):
+        return DirectUpload(file_url=file_url)
+    upload_url, headers = upload_storage.presigned_upload(key, upload.size, upload.sha256)
+    return DirectUpload(file_url=file_url, upload_url=upload_url, headers=headers)
+
+@api_router.post("/projects/{project_id}/direct-uploads/complete", response_model=Media)
+async def complete_direct_upload(
+    project_id: str,
+    upload: DirectUploadCreate,
+    username: str = Depends(verify_token)
+):
+    if not upload_storage.direct_uploads:
+        raise HTTPException(status_code=501, detail="Uploads are stored by the API")
+    if not await projects_collection.find_one({"id": project_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Project not found")
     
-    if not media_item:
+    file_ext, file_type = check_declared_upload(upload.filename, upload.size)
+    file_url = content_upload_url(upload.sha256, file_ext)
+    key = upload_relative_path(file_url)
+    
+    # The bucket checked length and hash; the type is checked here, reading
+    # only the first bytes of the object
+    size = await upload_storage.size(key)
+    if size is None:
+        raise HTTPException(status_code=400, detail="File has not been uploaded")
+    if size != upload.size:
+        raise HTTPException(status_code=400, detail="Uploaded file size does not match")
+    if not matches_magic_bytes(file_ext, await upload_storage.read_head(key, MAGIC_HEADER_SIZE)):
+        raise HTTPException(status_code=400, detail=f"File content does not match its {file_ext} extension")
+    
+    saved = SavedUpload(
+        original_filename=upload.filename,
+        file_url=file_url,
+        file_type=file_type,
+        size=size
+    )
+    try:
+        media_items = await add_media_to_project(project_id, [saved])
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return media_items[0]
+
+@api_router.get("/projects/{project_id}/media/{media_id}", response_model=Media)
+async def get_media(
+    project_id: str,
+    media_id: str,
+    username: str = Depends(verify_token)
+):
+    # Lets the admin UI poll the processing status of a fresh upload
+    media = await media_store.get(project_id, media_id)
+    if not media:
         raise HTTPException(status_code=404, detail="Media not found")
+    return json_response(Media(**media))
+
+async def media_not_found(project_id: str) -> HTTPException:
+    """404 for a media update that matched nothing, naming what was missing"""
+    if await projects_collection.count_documents({"id": project_id}, limit=1):
+        return HTTPException(status_code=404, detail="Media not found")
+    return HTTPException(status_code=404, detail="Project not found")
+
+@api_router.delete("/projects/{project_id}/media/{media_id}")
+async def delete_media(
+    project_id: str,
+    media_id: str,
+    username: str = Depends(verify_token)
+):
+    media = await media_store.delete(project_id, media_id)
+    if not media:
+        raise await media_not_found(project_id)
     
-    delete_upload_file(media_item["url"])
-    
-    await projects_collection.update_one(
-        {"id": project_id},
-        {
-            "$pull": {"media": {"id": media_id}},
-            "$set": {"updated_at": datetime.utcnow()}
-        }
-    )
+    await release_media(db, media)
+    await catalog.refresh_project(project_id)
     
     return {"message": "Media deleted successfully"}
 
@@ -298,32 +695,16 @@ async def reorder_media(
     reorder: MediaReorder,
     username: str = Depends(verify_token)
 ):
-    project = await projects_collection.find_one({"id": project_id})
+    # Only the given items' orders change, so media added or changed
+    # concurrently by another editor is left alone
+    project = await media_store.reorder(
+        project_id, {item["id"]: item["order"] for item in reorder.media_order}
+    )
     if not project:
         raise HTTPException(status_code=404, detail="Project not found")
+    await catalog.refresh_project(project_id)
     
-    # Update order for each media item
-    media_list = project.get("media", [])
-    for item in reorder.media_order:
-        for media in media_list:
-            if media["id"] == item["id"]:
-                media["order"] = item["order"]
-    
-    # Sort by order
-    media_list.sort(key=lambda x: x.get("order", 0))
-    
-    await projects_collection.update_one(
-        {"id": project_id},
-        {
-            "$set": {
-                "media": media_list,
-                "updated_at": datetime.utcnow()
-            }
-        }
-    )
-    
-    updated_project = await projects_collection.find_one({"id": project_id})
-    return Project(**updated_project)
+    return Project(**project)
 
 
 @api_router.put("/projects/{project_id}/media/{media_id}/featured")
@@ -333,71 +714,130 @@ async def toggle_media_featured(
     featured: bool,
     username: str = Depends(verify_token)
 ):
-    project = await projects_collection.find_one({"id": project_id})
-    if not project:
-        raise HTTPException(status_code=404, detail="Project not found")
-    
     # Update featured status for specific media
-    media_list = project.get("media", [])
-    media_found = False
-    for media in media_list:
-        if media["id"] == media_id:
-            media["featured"] = featured
-            media_found = True
-            break
-    
-    if not media_found:
-        raise HTTPException(status_code=404, detail="Media not found")
-    
-    await projects_collection.update_one(
-        {"id": project_id},
-        {
-            "$set": {
-                "media": media_list,
-                "updated_at": datetime.utcnow()
-            }
-        }
-    )
+    if not await media_store.update(project_id, media_id, {"featured": featured}):
+        raise await media_not_found(project_id)
+    await catalog.refresh_project(project_id)
     
     return {"message": "Media featured status updated", "featured": featured}
 
 # ===== Featured Images Route =====
 
+# Featured media per response, so the payload stays bounded as the archive grows
+FEATURED_DEFAULT_LIMIT = 100
+FEATURED_MAX_LIMIT = 500
+
 @api_router.get("/featured")
-async def get_featured_images():
-    import random
-    
-    # Get all projects (published and unpublished for flexibility)
-    projects = await projects_collection.find().to_list(100)
-    
-    featured_images = []
-    for project in projects:
-        for media in project.get("media", []):
-            # Include media if it's individually featured OR if project is featured
-            if media.get("featured", False) or project.get("featured", False):
-                featured_images.append({
-                    "type": media["type"],
-                    "url": media["url"],
-                    "alt": media["alt"],
-                    "projectId": project["id"],
-                    "projectTitle": project["title"]
-                })
-    
-    # Randomize the order
-    random.shuffle(featured_images)
-    
-    return featured_images
+async def get_featured_images(
+    request: Request,
+    limit: int = Query(FEATURED_DEFAULT_LIMIT, ge=1, le=FEATURED_MAX_LIMIT),
+    seed: Optional[int] = None
+):
+    # Random sample of featured media (all of it, shuffled, if there are fewer
+    # than `limit`). The same seed returns the same selection and order.
+    rng = random.Random(seed) if seed is not None else random
+    
+    if catalog.loaded:
+        featured = catalog.featured_images()
+        selection = rng.sample(featured, min(limit, len(featured)))
+    elif seed is None:
+        # Mongo samples for us; only the needed fields leave the server
+        selection = await db[media_store.featured_source].aggregate(
+            media_store.featured_pipeline(limit)
+        ).to_list(None)
+    else:
+        featured = await db[media_store.featured_source].aggregate(
+            media_store.featured_pipeline()
+        ).to_list(None)
+        selection = rng.sample(featured, min(limit, len(featured)))
+    
+    body = render_json(selection)
+    if catalog.loaded and seed is None:
+        # The ETag covers the featured set, not this particular sample, hence
+        # weak: a client that has a sample of this set keeps it
+        _, set_etag = render_cache.get(catalog.version, "featured", catalog.featured_images, weak=True)
+        etag = f'{set_etag[:-1]}-{limit}"'
+    else:
+        etag = make_etag(body, weak=seed is None)
+    
+    return conditional_response(request, body, etag)
+
+# ===== Bootstrap Route =====
+
+@api_router.get("/bootstrap")
+async def get_bootstrap(request: Request):
+    # Everything the public site needs for its first render in one response:
+    # the settings, every published project summary and the featured media.
+    # Featured media come in catalog order, up to the featured route's
+    # default limit, for clients to shuffle; the payload is the same for
+    # every visitor, so it can be cached and inlined into the HTML shell at
+    # build time.
+    if catalog.loaded:
+        body, etag = render_cache.get(catalog.version, "bootstrap", lambda: {
+            "settings": catalog.settings,
+            "projects": catalog.project_summaries(),
+            "featured": catalog.featured_images()[:FEATURED_DEFAULT_LIMIT],
+        })
+        return conditional_response(request, body, etag)
+    
+    settings, projects, featured = await asyncio.gather(
+        read_settings(),
+        projects_collection.aggregate(media_store.summary_pipeline({"published": True})).to_list(None),
+        db[media_store.featured_source].aggregate(media_store.featured_pipeline()).to_list(FEATURED_DEFAULT_LIMIT),
+    )
+    body = render_json({
+        "settings": settings,
+        "projects": [ProjectSummary(**doc) for doc in projects],
+        "featured": featured,
+    })
+    return conditional_response(request, body, make_etag(body))
+
+# ===== Image Resizing Route =====
+
+@api_router.get("/img/{filename:path}")
+async def get_resized_image(
+    filename: str,
+    request: Request,
+    w: Optional[int] = None,
+    h: Optional[int] = None,
+    fmt: str = "webp",
+    q: Optional[int] = None
+):
+    # Any upload image at a whitelisted size, e.g. /api/img/ab/cd/abcd....jpg?h=64
+    try:
+        rendition = Rendition.parse(filename, w, h, fmt, q)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    headers = {
+        "ETag": f'"{rendition.name.split(".")[0]}"',
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+        "Access-Control-Allow-Origin": "*",
+        "Cross-Origin-Resource-Policy": "cross-origin",
+    }
+    if is_not_modified(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    try:
+        path = await image_resizer.get(rendition)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return CountedFileResponse(path, source="img", media_type=rendition.media_type, headers=headers)
 
 # ===== Settings Routes =====
 
-@api_router.get("/settings", response_model=SiteSettings)
-async def get_settings():
+async def read_settings() -> SiteSettings:
     settings = await settings_collection.find_one({})
-    if not settings:
-        # Return default settings
-        default_settings = SiteSettings()
-        return default_settings
-    return SiteSettings(**settings)
+    # Default settings until the admin saves some
+    return SiteSettings(**settings) if settings else SiteSettings()
+
+@api_router.get("/settings", response_model=SiteSettings)
+async def get_settings(request: Request):
+    if catalog.loaded:
+        body, etag = render_cache.get(catalog.version, "settings", lambda: catalog.settings)
+        return conditional_response(request, body, etag)
+    
+    body = render_json(await read_settings())
+    return conditional_response(request, body, make_etag(body))
 
 @api_router.put("/settings", response_model=SiteSettings)
 async def update_settings(
@@ -417,29 +857,55 @@ async def update_settings(
     else:
         settings_doc = SiteSettings(**update_data).dict()
         await settings_collection.insert_one(settings_doc)
+    await catalog.refresh_settings()
     
     updated_settings = await settings_collection.find_one({})
     return SiteSettings(**updated_settings)
 
 @api_router.post("/settings/logo", response_model=dict)
 async def upload_logo(
-    file: UploadFile = File(...),
+    request: Request,
     username: str = Depends(verify_token)
 ):
     try:
-        file_url, file_type = await save_upload_file(file)
+        upload = await stream_single_upload(request)
+        file_url, file_type = upload.file_url, upload.file_type
+        await commit_upload(db, upload)
         
-        # Update settings with logo URL
-        await settings_collection.update_one(
+        # Update settings with logo URL; variants are filled in by the media job worker
+        previous = await settings_collection.find_one_and_update(
             {},
-            {"$set": {"logo_url": file_url, "updated_at": datetime.utcnow()}},
+            {"$set": {
+                "logo_url": file_url,
+                "logo_variants": [],
+                "updated_at": datetime.utcnow()
+            }},
+            projection={"logo_url": 1, "logo_variants": 1},
             upsert=True
         )
+        await catalog.refresh_settings()
+        if previous and previous.get("logo_url"):
+            await release_media(db, {"url": previous["logo_url"], "variants": previous.get("logo_variants", [])})
+        
+        if file_type == "image":
+            await enqueue_media_job(db, "image", file_url)
         
         return {"logo_url": file_url}
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+@api_router.get("/admin/catalog")
+async def get_catalog_status(username: str = Depends(verify_token)):
+    # Freshness of this worker's in-process catalog
+    return {
+        "loaded": catalog.loaded,
+        "version": catalog.version,
+        "projects": len(catalog.all_projects()),
+        "sync": catalog_sync.stats()
+    }
+
 # ===== Health Check =====
 
 @api_router.get("/")
@@ -450,6 +916,16 @@ async def root():
 async def health_check():
     return {"status": "healthy"}
 
+# Scraped by Prometheus. Public unless METRICS_TOKEN is set, then only with
+# that bearer token; set it wherever the API is reachable from outside
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+@api_router.get("/metrics", include_in_schema=False)
+async def get_metrics(authorization: Optional[str] = Header(None)):
+    if METRICS_TOKEN and not hmac.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return Response(content=registry.render(), media_type=METRICS_CONTENT_TYPE)
+
 # Include the router in the main app
 app.include_router(api_router)
 
@@ -463,6 +939,7 @@ if cors_origins == '*':
         allow_origins=["*"],
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=["X-Next-Cursor", "Link"],
     )
     print("[INFO] CORS: Allowing all origins (*)")
 else:
@@ -475,9 +952,39 @@ else:
         allow_origins=origins_list,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=["X-Next-Cursor", "Link"],
     )
     print(f"[INFO] CORS: Allowing specific origins: {origins_list}")
 
+# Added last so it is the outermost middleware: request times for
+# /api/metrics include CORS and error handling
+app.add_middleware(MetricsMiddleware)
+
+async def refresh_catalog_after_job(job: dict):
+    if job["project_id"] is None:
+        await catalog.refresh_settings()
+    else:
+        await catalog.refresh_project(job["project_id"])
+
+@app.on_event("startup")
+async def start_background_workers():
+    try:
+        await ensure_indexes(db)
+    except Exception as e:
+        # e.g. duplicate usernames blocking a unique index; queries still work, just slower
+        logger.error(f"Could not create indexes: {e}")
+    try:
+        await catalog.load()
+    except Exception as e:
+        # Public routes fall back to querying Mongo directly
+        logger.error(f"Could not load catalog: {e}")
+    catalog_sync.start()
+    start_media_worker(db, media_store=media_store, on_change=refresh_catalog_after_job)
+    await image_resizer.start()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await stop_media_worker()
+    await image_resizer.stop()
+    await catalog_sync.stop()
     client.close()
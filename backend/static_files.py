@@ -0,0 +1,216 @@
+import hashlib
+import mimetypes
+import os
+import re
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import Optional, Tuple
+
+import anyio
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from starlette.responses import FileResponse, RedirectResponse, Response
+from starlette.types import Receive, Scope, Send
+
+from metrics import static_bytes_served
+from utils import upload_path_candidates
+
+# Upload filenames are unique and never rewritten, so they can be cached forever
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# HLS files written by the video job; .ts would otherwise be guessed as a Qt
+# translation file
+mimetypes.add_type("application/vnd.apple.mpegurl", ".m3u8")
+mimetypes.add_type("video/mp2t", ".ts")
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single-range `Range` header into inclusive (start, end).
+
+    Returns None when the header should be ignored (malformed or several
+    ranges, so the full file is sent) and raises ValueError when the range
+    can't be satisfied."""
+    match = _RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # Suffix range: the last N bytes
+        length = int(end)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+class CountedFileResponse(FileResponse):
+    """FileResponse that adds the bytes it sent to static_bytes_served"""
+
+    def __init__(self, path, source: str, **kwargs):
+        super().__init__(path, **kwargs)
+        self.source = source
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await super().__call__(scope, receive, send)
+        if scope["method"].upper() != "HEAD":
+            static_bytes_served.inc(self.source, amount=int(self.headers["content-length"]))
+
+class RangeFileResponse(CountedFileResponse):
+    """FileResponse that can send one byte range of the file (206).
+
+    Zero-copy (the kernel copying the file to the socket) needs the ASGI
+    server to offer it: whole files and ranges go through the zerocopysend
+    extension, or whole files through pathsend, when the server lists them.
+    Uvicorn, which the app is deployed with (Procfile, nixpacks.toml,
+    Dockerfile), offers neither and gives the app no access to the socket,
+    so there every file is read in chunks in a worker thread and written by
+    the server. With STORAGE_BACKEND=s3, file bytes don't pass through the
+    API at all."""
+
+    chunk_size = 256 * 1024
+
+    def __init__(self, path, stat_result: os.stat_result, byte_range: Optional[Tuple[int, int]] = None,
+                 **kwargs):
+        super().__init__(path, source="uploads", stat_result=stat_result, **kwargs)
+        self.byte_range = byte_range
+        self.headers["accept-ranges"] = "bytes"
+        if byte_range is not None:
+            start, end = byte_range
+            self.status_code = 206
+            self.headers["content-range"] = f"bytes {start}-{end}/{stat_result.st_size}"
+            self.headers["content-length"] = str(end - start + 1)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        zero_copy = "http.response.zerocopysend" in scope.get("extensions", {})
+        if scope["method"].upper() == "HEAD" or self.stat_result.st_size == 0 or (
+            self.byte_range is None and not zero_copy
+        ):
+            # Starlette sends whole files (with pathsend when offered)
+            await super().__call__(scope, receive, send)
+            return
+
+        start, end = self.byte_range or (0, self.stat_result.st_size - 1)
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            if zero_copy:
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": file.wrapped,
+                    "offset": start,
+                    "count": end - start + 1,
+                })
+                static_bytes_served.inc(self.source, amount=end - start + 1)
+                return
+            await file.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = await file.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+        if remaining > 0:
+            # File shrank underneath us; end the response
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        static_bytes_served.inc(self.source, amount=end - start + 1 - remaining)
+
+class CORSStaticFiles(StaticFiles):
+    """Serves uploads with CORS headers, immutable caching, stable ETags and
+    byte-range support (so <video> seeking doesn't refetch whole files).
+
+    Files are found in either the flat or the sharded layout, so URLs keep
+    working while migrate_uploads.py moves files and rewrites them."""
+
+    def lookup_path(self, path: str) -> Tuple[str, Optional[os.stat_result]]:
+        for candidate in upload_path_candidates(path):
+            full_path, stat_result = super().lookup_path(candidate)
+            if stat_result is not None:
+                return full_path, stat_result
+        return "", None
+
+    async def get_response(self, path: str, scope):
+        # Hidden entries (e.g. .partial resumable uploads) are not public
+        if any(part.startswith(".") for part in Path(path).parts):
+            raise StarletteHTTPException(status_code=404)
+        response = await super().get_response(path, scope)
+        response.headers["Access-Control-Allow-Origin"] = "*"
+        response.headers["Cross-Origin-Resource-Policy"] = "cross-origin"
+        return response
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope,
+                      status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        size = stat_result.st_size
+        # Names never get reused, so name + size identifies the content on
+        # every replica regardless of when the file was written there
+        etag = '"{}"'.format(
+            hashlib.md5(f"{Path(full_path).name}-{size}".encode(), usedforsecurity=False).hexdigest()
+        )
+        headers = {"etag": etag, "cache-control": IMMUTABLE_CACHE_CONTROL}
+
+        byte_range = None
+        range_header = request_headers.get("range")
+        if range_header and status_code == 200 and self._if_range_matches(request_headers, etag, stat_result):
+            try:
+                byte_range = parse_range(range_header, size)
+            except ValueError:
+                return Response(
+                    status_code=416,
+                    headers={"content-range": f"bytes */{size}", **headers}
+                )
+
+        response = RangeFileResponse(
+            full_path, stat_result=stat_result, byte_range=byte_range,
+            status_code=status_code, headers=headers
+        )
+        if byte_range is None and self.is_not_modified(response.headers, request_headers):
+            return Response(status_code=304, headers={
+                k: v for k, v in response.headers.items()
+                if k in ("etag", "last-modified", "cache-control", "accept-ranges")
+            })
+        return response
+
+    @staticmethod
+    def _if_range_matches(request_headers: Headers, etag: str, stat_result: os.stat_result) -> bool:
+        """A range is only honoured if If-Range (when sent) still matches"""
+        if_range = request_headers.get("if-range")
+        if not if_range:
+            return True
+        if if_range.startswith('"') or if_range.startswith("W/"):
+            return if_range == etag
+        try:
+            return int(parsedate_to_datetime(if_range).timestamp()) >= int(stat_result.st_mtime)
+        except (TypeError, ValueError):
+            return False
+
+class StorageRedirect(StaticFiles):
+    """Takes the place of CORSStaticFiles when uploads are kept in an object
+    store (see storage.py): each upload URL redirects to the object, so file
+    bytes never pass through the API"""
+
+    def __init__(self, storage):
+        super().__init__(directory=None, check_dir=False)
+        self.storage = storage
+
+    async def get_response(self, path: str, scope) -> Response:
+        if scope["method"] not in ("GET", "HEAD"):
+            raise StarletteHTTPException(status_code=405)
+        parts = Path(path).parts
+        if path == "." or any(part.startswith(".") for part in parts):
+            raise StarletteHTTPException(status_code=404)
+        return RedirectResponse(
+            self.storage.read_url("/".join(parts)),
+            status_code=302,
+            headers={
+                # Presigned URLs expire, so the redirect is only reused for a while
+                "cache-control": f"public, max-age={self.storage.read_url_max_age}",
+                "access-control-allow-origin": "*",
+            },
+        )
@@ -0,0 +1,334 @@
+"""
+Where upload files are kept
+
+Chosen with STORAGE_BACKEND:
+- "local" (default): the uploads directory next to this file, served by the
+  /api/uploads static mount. Lost on redeploys and not shared by replicas.
+- "s3": an S3-compatible bucket (AWS S3, MinIO, R2, ...). /api/uploads/<key>
+  redirects to the object and the admin UI uploads straight to the bucket
+  with presigned URLs, so media bytes don't pass through the API.
+
+Files are addressed by their key below the uploads root, e.g. ab/cd/abcd....jpg
+(see utils.upload_relative_path). Media URLs are /api/uploads/<key> with either
+backend, so switching doesn't touch Mongo. Files already on local disk are
+copied into the bucket with
+
+    python storage.py sync
+
+S3 settings: S3_BUCKET, S3_ENDPOINT_URL (anything but AWS), S3_REGION,
+S3_PUBLIC_URL (base URL when objects are publicly readable, e.g. through a
+CDN; reads are presigned otherwise) and the usual AWS_ACCESS_KEY_ID /
+AWS_SECRET_ACCESS_KEY. For uploads from the admin UI the bucket's CORS rules
+must allow PUT from the frontend's origin with the Content-Type and
+x-amz-checksum-sha256 headers.
+"""
+
+import asyncio
+import base64
+import mimetypes
+import os
+import shutil
+import sys
+import tempfile
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import anyio
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from static_files import IMMUTABLE_CACHE_CONTROL
+from utils import UPLOAD_DIR, sharded_relative_path, upload_path_candidates
+
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "local")
+
+# Files larger than one part are transferred in parts, several at a time
+MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+MULTIPART_CONCURRENCY = 4
+PRESIGNED_UPLOAD_SECONDS = 15 * 60
+PRESIGNED_READ_SECONDS = int(os.environ.get("S3_PRESIGNED_READ_SECONDS", "3600"))
+# Objects removed per DeleteObjects request (the S3 maximum)
+DELETE_BATCH_SIZE = 1000
+
+def content_type_for(key: str) -> str:
+    return mimetypes.guess_type(key)[0] or "application/octet-stream"
+
+class LocalStorage:
+    """Files in the uploads directory of this container"""
+
+    name = "local"
+    # Clients send files through the upload routes
+    direct_uploads = False
+
+    def __init__(self, root: Path = UPLOAD_DIR):
+        self.root = root
+
+    def path(self, key: str) -> Path:
+        """Path of a key on disk, in either the flat or the sharded layout"""
+        candidates = [self.root / relative for relative in upload_path_candidates(key)]
+        return next((path for path in candidates if path.exists()), candidates[0])
+
+    def read_url(self, key: str) -> Optional[str]:
+        """Where clients read a file; None when the uploads route serves it"""
+        return None
+
+    # Whether read_url is signed per file, so relative URLs inside a file
+    # (HLS playlists) don't resolve
+    presigned_reads = False
+
+    # ----- reads -----
+
+    async def exists(self, key: str) -> bool:
+        return await anyio.to_thread.run_sync(lambda: self.path(key).exists())
+
+    async def size(self, key: str) -> Optional[int]:
+        def stat():
+            path = self.path(key)
+            return path.stat().st_size if path.exists() else None
+        return await anyio.to_thread.run_sync(stat)
+
+    async def read_head(self, key: str, length: int) -> bytes:
+        def read():
+            with open(self.path(key), "rb") as f:
+                return f.read(length)
+        return await anyio.to_thread.run_sync(read)
+
+    @asynccontextmanager
+    async def local_file(self, key: str) -> AsyncIterator[Path]:
+        """A path on disk holding the file, for processing it"""
+        yield self.path(key)
+
+    # ----- writes -----
+
+    async def save(self, temp_path: Path, key: str):
+        """Move a finished upload into storage; the temporary file is
+        consumed. Content-addressed keys hold the same bytes whoever wrote
+        them, so an existing file is kept."""
+        def place():
+            path = self.path(key)
+            if path.exists():
+                temp_path.unlink(missing_ok=True)
+                return
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(temp_path, path)
+        await anyio.to_thread.run_sync(place)
+
+    async def save_derived(self, key: str, files: List[Path]):
+        """Store files derived from `key` (written next to its local_file)
+        under the same directory"""
+        def place():
+            directory = self.path(key).parent
+            for file in files:
+                if file.parent != directory:
+                    os.replace(file, directory / file.name)
+        await anyio.to_thread.run_sync(place)
+
+    async def delete(self, key: str):
+        await anyio.to_thread.run_sync(lambda: self.path(key).unlink(missing_ok=True))
+
+    async def delete_with_derived(self, key: str):
+        """Delete a file and everything derived from it, which shares its
+        name as the filename prefix"""
+        def delete():
+            path = self.path(key)
+            for derived in path.parent.glob(f"{path.stem}_*"):
+                derived.unlink(missing_ok=True)
+            path.unlink(missing_ok=True)
+        await anyio.to_thread.run_sync(delete)
+
+class S3Storage:
+    """Objects in an S3-compatible bucket, keyed like the sharded uploads
+    directory. boto3 is blocking, so every call runs in a worker thread."""
+
+    name = "s3"
+    direct_uploads = True
+
+    def __init__(self, bucket: str, endpoint_url: Optional[str] = None, region: Optional[str] = None,
+                 public_url: Optional[str] = None):
+        self.bucket = bucket
+        self.public_url = public_url.rstrip("/") if public_url else None
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            region_name=region,
+            config=Config(
+                # Presigned URLs must sign the checksum and length headers
+                signature_version="s3v4",
+                # MinIO and most other stores don't do virtual-hosted buckets
+                s3={"addressing_style": "path" if endpoint_url else "auto"},
+                max_pool_connections=MULTIPART_CONCURRENCY * 4,
+            ),
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=MULTIPART_CHUNK_SIZE,
+            multipart_chunksize=MULTIPART_CHUNK_SIZE,
+            max_concurrency=MULTIPART_CONCURRENCY,
+        )
+
+    @staticmethod
+    def object_key(key: str) -> str:
+        """Files of the flat layout are stored under their sharded key"""
+        return key if "/" in key else sharded_relative_path(key)
+
+    def read_url(self, key: str) -> Optional[str]:
+        key = self.object_key(key)
+        if self.public_url:
+            return f"{self.public_url}/{key}"
+        return self.client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket, "Key": key}, ExpiresIn=PRESIGNED_READ_SECONDS
+        )
+
+    @property
+    def presigned_reads(self) -> bool:
+        return self.public_url is None
+
+    # How long clients may reuse a redirect to read_url
+    @property
+    def read_url_max_age(self) -> int:
+        return 24 * 3600 if self.public_url else PRESIGNED_READ_SECONDS // 2
+
+    def presigned_upload(self, key: str, size: int, sha256: str) -> Tuple[str, Dict[str, str]]:
+        """URL and headers for a client to PUT a file straight into the
+        bucket. The length and SHA-256 are signed, so the bucket rejects any
+        other content for this key."""
+        headers = {
+            "Content-Type": content_type_for(key),
+            "x-amz-checksum-sha256": base64.b64encode(bytes.fromhex(sha256)).decode(),
+        }
+        url = self.client.generate_presigned_url(
+            "put_object",
+            Params={
+                "Bucket": self.bucket,
+                "Key": self.object_key(key),
+                "ContentLength": size,
+                "ContentType": headers["Content-Type"],
+                "ChecksumSHA256": headers["x-amz-checksum-sha256"],
+            },
+            ExpiresIn=PRESIGNED_UPLOAD_SECONDS,
+        )
+        return url, headers
+
+    # ----- reads -----
+
+    def _head(self, key: str) -> Optional[dict]:
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    async def exists(self, key: str) -> bool:
+        return await anyio.to_thread.run_sync(self._head, key) is not None
+
+    async def size(self, key: str) -> Optional[int]:
+        head = await anyio.to_thread.run_sync(self._head, key)
+        return head["ContentLength"] if head else None
+
+    async def read_head(self, key: str, length: int) -> bytes:
+        def read():
+            response = self.client.get_object(
+                Bucket=self.bucket, Key=self.object_key(key), Range=f"bytes=0-{length - 1}"
+            )
+            return response["Body"].read()
+        return await anyio.to_thread.run_sync(read)
+
+    @asynccontextmanager
+    async def local_file(self, key: str) -> AsyncIterator[Path]:
+        directory = Path(await anyio.to_thread.run_sync(tempfile.mkdtemp))
+        try:
+            path = directory / key.rsplit("/", 1)[-1]
+            await anyio.to_thread.run_sync(lambda: self.client.download_file(
+                self.bucket, self.object_key(key), str(path), Config=self.transfer_config
+            ))
+            yield path
+        finally:
+            await anyio.to_thread.run_sync(shutil.rmtree, directory, True)
+
+    # ----- writes -----
+
+    def _upload(self, path: Path, key: str):
+        self.client.upload_file(
+            str(path), self.bucket, key,
+            ExtraArgs={"ContentType": content_type_for(key), "CacheControl": IMMUTABLE_CACHE_CONTROL},
+            Config=self.transfer_config,
+        )
+
+    async def save(self, temp_path: Path, key: str):
+        if not await self.exists(key):
+            await anyio.to_thread.run_sync(self._upload, temp_path, self.object_key(key))
+        await anyio.to_thread.run_sync(lambda: temp_path.unlink(missing_ok=True))
+
+    async def save_derived(self, key: str, files: List[Path]):
+        directory = self.object_key(key).rsplit("/", 1)[0]
+        await asyncio.gather(*(
+            anyio.to_thread.run_sync(self._upload, file, f"{directory}/{file.name}") for file in files
+        ))
+
+    async def delete(self, key: str):
+        await anyio.to_thread.run_sync(lambda: self.client.delete_object(
+            Bucket=self.bucket, Key=self.object_key(key)
+        ))
+
+    async def delete_with_derived(self, key: str):
+        key = self.object_key(key)
+        def delete():
+            keys = [key]
+            pages = self.client.get_paginator("list_objects_v2").paginate(
+                Bucket=self.bucket, Prefix=f"{os.path.splitext(key)[0]}_"
+            )
+            for page in pages:
+                keys.extend(item["Key"] for item in page.get("Contents", []))
+            for start in range(0, len(keys), DELETE_BATCH_SIZE):
+                self.client.delete_objects(Bucket=self.bucket, Delete={
+                    "Objects": [{"Key": k} for k in keys[start:start + DELETE_BATCH_SIZE]],
+                    "Quiet": True,
+                })
+        await anyio.to_thread.run_sync(delete)
+
+def s3_storage_from_env() -> S3Storage:
+    bucket = os.environ.get("S3_BUCKET")
+    if not bucket:
+        raise ValueError("STORAGE_BACKEND=s3 needs S3_BUCKET")
+    return S3Storage(
+        bucket,
+        endpoint_url=os.environ.get("S3_ENDPOINT_URL") or None,
+        region=os.environ.get("S3_REGION") or None,
+        public_url=os.environ.get("S3_PUBLIC_URL") or None,
+    )
+
+def storage_for(backend: str = STORAGE_BACKEND):
+    if backend == "s3":
+        return s3_storage_from_env()
+    if backend != "local":
+        raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+    return LocalStorage()
+
+upload_storage = storage_for()
+
+def sync(storage: S3Storage) -> int:
+    """Copy every file of the local uploads directory into the bucket;
+    returns how many were uploaded. Objects already there are skipped, so it
+    can be run again after an interruption."""
+    uploaded = 0
+    for path in sorted(UPLOAD_DIR.rglob("*")):
+        relative = path.relative_to(UPLOAD_DIR)
+        # Hidden entries are in-progress uploads
+        if not path.is_file() or any(part.startswith(".") for part in relative.parts):
+            continue
+        key = storage.object_key(relative.as_posix())
+        if storage._head(key) is None:
+            storage._upload(path, key)
+            uploaded += 1
+            print(f"  uploaded {key}")
+    return uploaded
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["sync"]:
+        print("Usage: python storage.py sync")
+        sys.exit(2)
+    print(f"Copying {UPLOAD_DIR} into the bucket")
+    print(f"Uploaded {sync(s3_storage_from_env())} files")
@@ -0,0 +1,340 @@
+import asyncio
+import hashlib
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+import anyio
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import MultipartParser, parse_options_header
+from starlette.requests import ClientDisconnect, Request
+
+from metrics import upload_bytes_received
+from utils import (
+    PARTIAL_UPLOAD_DIR, MAX_UPLOAD_SIZES, MAGIC_HEADER_SIZE, UploadTooLarge,
+    get_file_type, matches_magic_bytes, content_upload_url
+)
+
+# Bytes buffered in memory before a write is handed to a worker thread
+FLUSH_SIZE = 256 * 1024
+# Allowance for multipart boundaries and part headers when checking Content-Length
+MULTIPART_OVERHEAD = 64 * 1024
+# Resumable uploads whose running hash is kept, least recently written dropped first
+PARTIAL_DIGESTS_MAX_ENTRIES = 10000
+
+@dataclass
+class SavedUpload:
+    original_filename: str
+    # Content-addressed URL the file gets once committed (content_store.commit_upload)
+    file_url: Optional[str] = None
+    file_type: Optional[str] = None
+    size: int = 0
+    error: Optional[ValueError] = None
+    # Where the file is until it is committed
+    temp_path: Optional[Path] = None
+
+class UploadWriter:
+    """Writes one uploaded file to a temporary file without blocking the
+    event loop, hashing it on the way.
+
+    The type is taken from the extension and confirmed against the magic bytes
+    of the first chunk before anything is written; the per-type size limit is
+    enforced as data arrives."""
+
+    def __init__(self, original_filename: str):
+        self.original_filename = original_filename
+        self.file_ext, self.file_type = get_file_type(original_filename)
+        self.max_size = MAX_UPLOAD_SIZES[self.file_type]
+        self.path = PARTIAL_UPLOAD_DIR / f"{uuid.uuid4().hex}{self.file_ext}"
+        self.size = 0
+        self._buffer = bytearray()
+        self._file = None
+        self._hash = hashlib.sha256()
+
+    async def write(self, data: bytes):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise UploadTooLarge(
+                f"File exceeds the {self.max_size // (1024 * 1024)} MB limit for {self.file_type}s"
+            )
+        self._buffer += data
+
+        if self._file is None:
+            if len(self._buffer) < MAGIC_HEADER_SIZE:
+                return
+            await self._open()
+
+        if len(self._buffer) >= FLUSH_SIZE:
+            await self._flush()
+
+    async def close(self) -> SavedUpload:
+        if self._file is None:
+            # Files shorter than the magic header
+            await self._open()
+        await self._flush()
+        await anyio.to_thread.run_sync(self._file.close)
+        self._file = None
+        return SavedUpload(
+            original_filename=self.original_filename,
+            file_url=content_upload_url(self._hash.hexdigest(), self.file_ext),
+            file_type=self.file_type,
+            size=self.size,
+            temp_path=self.path,
+        )
+
+    async def abort(self):
+        if self._file is not None:
+            await anyio.to_thread.run_sync(self._file.close)
+            self._file = None
+        await anyio.to_thread.run_sync(partial(self.path.unlink, missing_ok=True))
+
+    async def _open(self):
+        if not matches_magic_bytes(self.file_ext, bytes(self._buffer[:MAGIC_HEADER_SIZE])):
+            raise ValueError(f"File content does not match its {self.file_ext} extension")
+        self._file = await anyio.to_thread.run_sync(self.path.open, "wb")
+
+    def _write(self, data: bytes):
+        self._file.write(data)
+        self._hash.update(data)
+
+    async def _flush(self):
+        if self._buffer:
+            data, self._buffer = bytes(self._buffer), bytearray()
+            await anyio.to_thread.run_sync(self._write, data)
+
+async def stream_uploads(request: Request, max_files: int = 1,
+                         concurrency: int = 1) -> List[SavedUpload]:
+    """Parse a multipart/form-data body straight from the request stream and
+    write each file part to a temporary file, to be committed by the caller.
+
+    Unlike UploadFile this never spools the body to a temporary file first.
+    Rejected files are returned with `error` set; for single-file uploads the
+    body is not read any further once the file is rejected."""
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise ValueError("Expected a multipart/form-data body")
+
+    content_length = request.headers.get("content-length")
+    max_body = max(MAX_UPLOAD_SIZES.values()) * max_files + MULTIPART_OVERHEAD
+    if content_length and content_length.isdigit() and int(content_length) > max_body:
+        raise UploadTooLarge("Upload exceeds the maximum allowed size")
+
+    events = []
+    header_field = bytearray()
+    header_value = bytearray()
+    headers = {}
+
+    def on_header_field(data: bytes, start: int, end: int):
+        header_field.extend(data[start:end])
+
+    def on_header_value(data: bytes, start: int, end: int):
+        header_value.extend(data[start:end])
+
+    def on_header_end():
+        headers[bytes(header_field).lower()] = bytes(header_value)
+        header_field.clear()
+        header_value.clear()
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": lambda: headers.clear(),
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": lambda: events.append(("headers", dict(headers))),
+        "on_part_data": lambda data, start, end: events.append(("data", data[start:end])),
+        "on_part_end": lambda: events.append(("end", None)),
+    })
+
+    # Finished parts are flushed and closed in the background, up to
+    # `concurrency` at a time, while the next part keeps streaming in
+    limiter = asyncio.Semaphore(concurrency)
+    results: List[Union[SavedUpload, asyncio.Task]] = []
+    writer: Optional[UploadWriter] = None
+    stop_on_error = max_files == 1
+
+    async def reject(filename: str, error: ValueError):
+        nonlocal writer
+        if writer is not None:
+            await writer.abort()
+            writer = None
+        results.append(SavedUpload(original_filename=filename, error=error))
+
+    async def finish(part: UploadWriter) -> SavedUpload:
+        try:
+            return await part.close()
+        except ValueError as e:
+            await part.abort()
+            return SavedUpload(original_filename=part.original_filename, error=e)
+        except BaseException:
+            await part.abort()
+            raise
+        finally:
+            limiter.release()
+
+    try:
+        async for chunk in request.stream():
+            upload_bytes_received.inc("multipart", amount=len(chunk))
+            try:
+                parser.write(chunk)
+            except MultipartParseError:
+                raise ValueError("Invalid multipart body")
+
+            for event, data in events:
+                if event == "headers":
+                    _, disposition = parse_options_header(data.get(b"content-disposition", b""))
+                    filename = disposition.get(b"filename")
+                    if filename is None:
+                        # Plain form field, ignored
+                        continue
+                    filename = filename.decode("utf-8", "replace")
+                    if len(results) >= max_files:
+                        raise ValueError(f"Too many files (max {max_files})")
+                    try:
+                        writer = UploadWriter(filename)
+                    except ValueError as e:
+                        await reject(filename, e)
+                elif event == "data" and writer is not None:
+                    try:
+                        await writer.write(data)
+                    except ValueError as e:
+                        await reject(writer.original_filename, e)
+                elif event == "end" and writer is not None:
+                    await limiter.acquire()
+                    results.append(asyncio.create_task(finish(writer)))
+                    writer = None
+            events.clear()
+
+            # Rejections are recorded directly, accepted files as tasks
+            if stop_on_error and results and isinstance(results[-1], SavedUpload):
+                break
+
+        results = [await r if isinstance(r, asyncio.Task) else r for r in results]
+    except BaseException:
+        if writer is not None:
+            await writer.abort()
+        for result in results:
+            if isinstance(result, asyncio.Task):
+                result.cancel()
+        for result in await asyncio.gather(
+            *[r for r in results if isinstance(r, asyncio.Task)], return_exceptions=True
+        ):
+            if isinstance(result, SavedUpload) and result.temp_path:
+                await anyio.to_thread.run_sync(partial(result.temp_path.unlink, missing_ok=True))
+        raise
+
+    if writer is not None:
+        # Body ended in the middle of a file part
+        await reject(writer.original_filename, ValueError("Upload was truncated"))
+
+    return results
+
+async def stream_single_upload(request: Request) -> SavedUpload:
+    """Stream the one file of a multipart body to disk, raising ValueError
+    (UploadTooLarge for size violations) if it is rejected"""
+    results = await stream_uploads(request, max_files=1)
+    if not results:
+        raise ValueError("No file in upload")
+    if results[0].error:
+        raise results[0].error
+    return results[0]
+
+class PartialUploadDigests:
+    """SHA-256 of the bytes each resumable upload has so far, carried from
+    one PATCH to the next, so the finished file's content address is known
+    without reading it again.
+
+    hashlib state can't be stored outside the process, so it is kept here.
+    A PATCH that lands on another worker, or after a restart, hashes the
+    part already on disk once and carries on from there."""
+
+    def __init__(self, max_entries: int = PARTIAL_DIGESTS_MAX_ENTRIES):
+        self.max_entries = max_entries
+        # upload id -> (bytes hashed, hash of them)
+        self._entries: "OrderedDict[str, Tuple[int, hashlib._Hash]]" = OrderedDict()
+
+    async def resume(self, upload_id: str, path: Path, offset: int) -> "hashlib._Hash":
+        """Hash of the first `offset` bytes of the upload, to be updated with
+        what follows and handed back with store(). It is a copy, so a failed
+        PATCH leaves the stored one as it was."""
+        entry = self._entries.get(upload_id)
+        if entry is not None and entry[0] == offset:
+            return entry[1].copy()
+
+        def hash_prefix():
+            digest = hashlib.sha256()
+            remaining = offset
+            with open(path, "rb") as f:
+                while remaining > 0:
+                    chunk = f.read(min(FLUSH_SIZE * 4, remaining))
+                    if not chunk:
+                        raise ValueError("Partial upload is shorter than its offset")
+                    digest.update(chunk)
+                    remaining -= len(chunk)
+            return digest
+        return await anyio.to_thread.run_sync(hash_prefix)
+
+    def store(self, upload_id: str, offset: int, digest: "hashlib._Hash"):
+        self._entries.pop(upload_id, None)
+        self._entries[upload_id] = (offset, digest)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def discard(self, upload_id: str):
+        self._entries.pop(upload_id, None)
+
+partial_upload_digests = PartialUploadDigests()
+
+async def write_body_at_offset(request: Request, path: Path, offset: int, max_bytes: int,
+                               file_ext: Optional[str] = None,
+                               digest: Optional["hashlib._Hash"] = None) -> int:
+    """Write a raw request body into a partial upload at `offset` and return
+    the number of bytes written, updating `digest` (if given) with them.
+
+    If the client disconnects, whatever arrived is kept so the upload can
+    resume from there. A body longer than `max_bytes`, or whose first bytes
+    don't match `file_ext` (checked when writing from offset 0), raises
+    ValueError and leaves the file as it was (but not `digest`)."""
+    check_magic = file_ext is not None and offset == 0
+    written = 0
+    buffer = bytearray()
+    fh = await anyio.to_thread.run_sync(path.open, "r+b")
+
+    def write(data: bytes):
+        fh.write(data)
+        if digest is not None:
+            digest.update(data)
+
+    try:
+        await anyio.to_thread.run_sync(fh.seek, offset)
+        try:
+            async for chunk in request.stream():
+                upload_bytes_received.inc("resumable", amount=len(chunk))
+                written += len(chunk)
+                if written > max_bytes:
+                    raise UploadTooLarge("Chunk goes past the declared upload size")
+                buffer += chunk
+                if check_magic and len(buffer) >= MAGIC_HEADER_SIZE:
+                    if not matches_magic_bytes(file_ext, bytes(buffer[:MAGIC_HEADER_SIZE])):
+                        raise ValueError(f"File content does not match its {file_ext} extension")
+                    check_magic = False
+                if len(buffer) >= FLUSH_SIZE:
+                    data, buffer = bytes(buffer), bytearray()
+                    await anyio.to_thread.run_sync(write, data)
+        except ClientDisconnect:
+            if check_magic:
+                # Not enough bytes arrived to verify the file type; start over
+                return 0
+        if check_magic and not matches_magic_bytes(file_ext, bytes(buffer)):
+            raise ValueError(f"File content does not match its {file_ext} extension")
+        if buffer:
+            await anyio.to_thread.run_sync(write, bytes(buffer))
+    except ValueError:
+        await anyio.to_thread.run_sync(fh.truncate, offset)
+        raise
+    finally:
+        await anyio.to_thread.run_sync(fh.close)
+    return written
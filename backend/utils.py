@@ -1,55 +1,127 @@
+import hashlib
 import os
-import uuid
-from datetime import datetime
-from fastapi import UploadFile
+import re
 from pathlib import Path
-import shutil
+from typing import List
 
 # Use relative path that works both locally and on Railway
 UPLOAD_DIR = Path(__file__).parent / "uploads"
 UPLOAD_DIR.mkdir(exist_ok=True, parents=True)
 
+# Chunks of resumable uploads in progress; never served by the static mount
+PARTIAL_UPLOAD_DIR = UPLOAD_DIR / ".partial"
+PARTIAL_UPLOAD_DIR.mkdir(exist_ok=True)
+
 ALLOWED_IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
 ALLOWED_VIDEO_EXTENSIONS = {".mp4", ".mov", ".avi", ".webm"}
 
+# Per-type upload size limits in bytes
+MAX_UPLOAD_SIZES = {
+    "image": int(os.environ.get("MAX_IMAGE_UPLOAD_MB", "50")) * 1024 * 1024,
+    "video": int(os.environ.get("MAX_VIDEO_UPLOAD_MB", "1024")) * 1024 * 1024,
+}
+
+# Accepted file signatures per extension: each signature is a list of
+# (offset, bytes) pairs that must all match
+_ISO_MEDIA = [[(4, b"ftyp")], [(4, b"moov")], [(4, b"mdat")], [(4, b"wide")], [(4, b"free")]]
+MAGIC_SIGNATURES = {
+    ".jpg": [[(0, b"\xff\xd8\xff")]],
+    ".jpeg": [[(0, b"\xff\xd8\xff")]],
+    ".png": [[(0, b"\x89PNG\r\n\x1a\n")]],
+    ".gif": [[(0, b"GIF87a")], [(0, b"GIF89a")]],
+    ".webp": [[(0, b"RIFF"), (8, b"WEBP")]],
+    ".mp4": _ISO_MEDIA,
+    ".mov": _ISO_MEDIA,
+    ".avi": [[(0, b"RIFF"), (8, b"AVI ")]],
+    ".webm": [[(0, b"\x1a\x45\xdf\xa3")]],
+}
+# Bytes needed to check any of the signatures above
+MAGIC_HEADER_SIZE = 12
+
+# Uploads are stored by the SHA-256 of their content, sharded by its first
+# two bytes: uploads/ab/cd/abcd....jpg
+_CONTENT_ADDRESSED_RE = re.compile(r"^([0-9a-f]{2})/([0-9a-f]{2})/(\1\2[0-9a-f]{60})\.[a-z0-9]+$")
+# Suffix of variant filenames, e.g. _640w in abcd..._640w.webp
+_VARIANT_SUFFIX_RE = re.compile(r"_\d+w$")
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+class UploadTooLarge(ValueError):
+    pass
+
 def create_project_slug(title: str) -> str:
     """Create URL-friendly slug from title"""
     slug = title.lower().replace(" ", "-")
     slug = "".join(c for c in slug if c.isalnum() or c == "-")
     return slug
 
-async def save_upload_file(file: UploadFile) -> tuple[str, str]:
-    """Save uploaded file and return (file_path, file_type)"""
-    file_ext = Path(file.filename).suffix.lower()
+def get_file_type(filename: str) -> tuple[str, str]:
+    """Return (extension, file_type) for an upload or raise ValueError"""
+    file_ext = Path(filename or "").suffix.lower()
     
-    # Determine file type
     if file_ext in ALLOWED_IMAGE_EXTENSIONS:
-        file_type = "image"
-    elif file_ext in ALLOWED_VIDEO_EXTENSIONS:
-        file_type = "video"
-    else:
-        raise ValueError(f"Unsupported file type: {file_ext}")
-    
-    # Generate unique filename
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    unique_id = str(uuid.uuid4())[:8]
-    filename = f"{timestamp}_{unique_id}{file_ext}"
-    file_path = UPLOAD_DIR / filename
-    
-    # Save file
-    with file_path.open("wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    
-    # Return relative URL path with /api prefix
-    return f"/api/uploads/{filename}", file_type
+        return file_ext, "image"
+    if file_ext in ALLOWED_VIDEO_EXTENSIONS:
+        return file_ext, "video"
+    raise ValueError(f"Unsupported file type: {file_ext}")
 
-def delete_upload_file(url: str):
-    """Delete uploaded file"""
+def matches_magic_bytes(file_ext: str, head: bytes) -> bool:
+    """Check the first bytes of an upload against the signature of its extension"""
+    return any(
+        all(head[offset:offset + len(magic)] == magic for offset, magic in signature)
+        for signature in MAGIC_SIGNATURES[file_ext]
+    )
+
+def content_upload_url(digest: str, file_ext: str) -> str:
+    """URL of the content-addressed upload with this SHA-256 hex digest"""
+    return f"/api/uploads/{digest[:2]}/{digest[2:4]}/{digest}{file_ext}"
+
+def upload_relative_path(url: str) -> str:
+    """Path of an upload URL below the uploads directory, e.g. ab/cd/abcd....jpg"""
+    # Handle both /uploads/ and /api/uploads/ paths
+    relative = url.split("/uploads/", 1)[-1]
+    parts = relative.split("/")
+    if any(part in ("", "..") or part.startswith(".") for part in parts):
+        raise ValueError(f"Invalid upload URL: {url}")
+    return relative
+
+def shard_prefix(filename: str) -> str:
+    """Two-level directory an upload is stored in, e.g. ab/cd.
+
+    Content-addressed files use their own hash; older, randomly named files
+    a hash of their name. Variants share the prefix of their original."""
+    stem = _VARIANT_SUFFIX_RE.sub("", Path(filename).stem)
+    key = stem if _SHA256_RE.match(stem) else hashlib.sha256(stem.encode()).hexdigest()
+    return f"{key[:2]}/{key[2:4]}"
+
+def sharded_relative_path(relative: str) -> str:
+    """Where an upload lives in the sharded layout"""
+    filename = relative.rsplit("/", 1)[-1]
+    return f"{shard_prefix(filename)}/{filename}"
+
+def upload_path_candidates(relative: str) -> List[str]:
+    """Relative paths an upload may be found at: older uploads sit directly
+    in the uploads directory until migrate_uploads.py moves them into shards"""
+    filename = relative.rsplit("/", 1)[-1]
+    sharded = sharded_relative_path(filename)
+    if relative == filename:
+        return [relative, sharded]
+    if relative == sharded:
+        return [relative, filename]
+    return [relative]
+
+def is_content_addressed(url: str) -> bool:
+    """Whether an upload is stored by content hash (and may be shared), as
+    opposed to older uploads with unique random names"""
     try:
-        # Handle both /uploads/ and /api/uploads/ paths
-        filename = url.split("/")[-1]
-        file_path = UPLOAD_DIR / filename
-        if file_path.exists():
-            file_path.unlink()
-    except Exception as e:
-        print(f"Error deleting file: {e}")
+        return _CONTENT_ADDRESSED_RE.match(upload_relative_path(url)) is not None
+    except ValueError:
+        return False
+
+def variants_with_urls(variants: List[dict], original_url: str) -> List[dict]:
+    """Turn variants produced by images.generate_image_variants (written next
+    to the original) into {url, width, height, format, size} dicts"""
+    base_url = original_url.rsplit("/", 1)[0]
+    return [
+        {"url": f"{base_url}/{v['filename']}", **{k: val for k, val in v.items() if k != "filename"}}
+        for v in variants
+    ]
@@ -0,0 +1,194 @@
+"""
+Video processing for the media job worker
+
+An uploaded video gets a poster frame, H.264 MP4 renditions at a few
+bitrates, a VP9 WebM rendition and an HLS package cut from the MP4s, all
+written next to the original with its name as prefix (so they are deleted
+with it):
+
+    <stem>_poster.jpg
+    <stem>_360p.mp4, <stem>_720p.mp4 ...     progressive, moov atom first
+    <stem>_720p.webm
+    <stem>_hls.m3u8                          master playlist
+    <stem>_hls_720p.m3u8, <stem>_hls_720p_00000.ts ...
+
+Files that already exist (the same content was uploaded before) are kept
+rather than encoded again, and each file is written under a hidden name and
+renamed, so one that is being served is never replaced or seen half-written.
+The HLS package is left out when relative URLs in its playlists wouldn't
+resolve (see process_video).
+
+Needs ffmpeg and ffprobe on PATH; without them videos are served as uploaded.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+from images import describe_image
+
+# Rungs by the short side of the frame, with their H.264 video bitrate in kbps
+VIDEO_LADDER = ((360, 800), (720, 2500), (1080, 5000))
+WEBM_MAX_SIZE = 720
+AUDIO_BITRATE_KBPS = 128
+# Keyframes are forced at the same times in every rendition, so HLS segments
+# line up and players can switch between renditions at segment boundaries
+KEYFRAME_SECONDS = 2
+HLS_SEGMENT_SECONDS = 4
+FFMPEG_TIMEOUT_SECONDS = int(os.environ.get("FFMPEG_TIMEOUT_SECONDS", "3600"))
+
+VIDEO_PROCESSING = (
+    os.environ.get("VIDEO_PROCESSING", "1") != "0"
+    and shutil.which("ffmpeg") is not None
+    and shutil.which("ffprobe") is not None
+)
+
+def _run(args: List[str]) -> bytes:
+    result = subprocess.run(args, capture_output=True, timeout=FFMPEG_TIMEOUT_SECONDS)
+    if result.returncode != 0:
+        raise RuntimeError(f"{args[0]} failed: {result.stderr.decode(errors='replace')[-500:]}")
+    return result.stdout
+
+def _ffmpeg(*args: str) -> bytes:
+    return _run(["ffmpeg", "-y", "-v", "error", *args])
+
+def probe(path: Path) -> dict:
+    """Displayed width and height (after rotation), duration in seconds and
+    whether there is an audio track"""
+    info = json.loads(_run([
+        "ffprobe", "-v", "error", "-show_streams", "-show_format", "-of", "json", str(path)
+    ]))
+    streams = info.get("streams", [])
+    video = next((s for s in streams if s["codec_type"] == "video"), None)
+    if video is None:
+        raise ValueError("File has no video stream")
+    width, height = video["width"], video["height"]
+    rotation = next(
+        (int(data["rotation"]) for data in video.get("side_data_list", []) if "rotation" in data),
+        int(video.get("tags", {}).get("rotate", 0))
+    )
+    if abs(rotation) % 180 == 90:
+        width, height = height, width
+    return {
+        "width": width,
+        "height": height,
+        "duration": float(info.get("format", {}).get("duration") or video.get("duration") or 0),
+        "audio": any(s["codec_type"] == "audio" for s in streams),
+    }
+
+def ladder_for(width: int, height: int) -> List[Tuple[int, int]]:
+    """Rungs no larger than the video (at least the smallest one)"""
+    short_side = min(width, height)
+    rungs = [(size, bitrate) for size, bitrate in VIDEO_LADDER if size <= short_side]
+    return rungs or [(short_side - short_side % 2, VIDEO_LADDER[0][1])]
+
+def _scale(width: int, height: int, size: int) -> str:
+    # Short side to `size`; -2 keeps the other side even, as the encoders need
+    return f"scale=-2:{size}" if width >= height else f"scale={size}:-2"
+
+def _output_size(path: Path) -> Tuple[int, int]:
+    info = probe(path)
+    return info["width"], info["height"]
+
+def _write_once(target: Path, write: Callable[[Path], None]):
+    """Have `write` create the file at a temporary path (with the same
+    extension, which ffmpeg goes by) and rename it to `target`; nothing is
+    done when `target` already exists"""
+    if target.exists():
+        return
+    temp = target.with_name(f".{os.getpid()}.{target.name}")
+    try:
+        write(temp)
+        os.replace(temp, target)
+    finally:
+        temp.unlink(missing_ok=True)
+
+def process_video(file_path: str, hls: bool = True) -> dict:
+    """Entry point for the media job worker; runs in a child process.
+    Returns the poster, the streams and every file written, plus the
+    preview fields images get.
+
+    Playlists name their variants and segments relative to themselves, so
+    `hls` is False when uploads are read through presigned URLs: players
+    resolve those names against the signed URL they were redirected to,
+    without its signature."""
+    source = Path(file_path)
+    info = probe(source)
+    width, height = info["width"], info["height"]
+
+    def output(suffix: str) -> Path:
+        return source.with_name(f"{source.stem}_{suffix}")
+
+    poster = output("poster.jpg")
+    _write_once(poster, lambda path: _ffmpeg(
+        "-ss", f"{min(1.0, info['duration'] / 2):.3f}", "-i", str(source),
+        "-frames:v", "1", "-q:v", "3", str(path)
+    ))
+
+    audio_map = ["-map", "0:a:0"] if info["audio"] else []
+    keyframes = ["-force_key_frames", f"expr:gte(t,n_forced*{KEYFRAME_SECONDS})"]
+    mp4s = []
+    for size, bitrate in ladder_for(width, height):
+        target = output(f"{size}p.mp4")
+        _write_once(target, lambda path: _ffmpeg(
+            "-i", str(source), "-map", "0:v:0", *audio_map,
+            "-vf", _scale(width, height, size),
+            "-c:v", "libx264", "-preset", "veryfast", "-profile:v", "high", "-pix_fmt", "yuv420p",
+            "-b:v", f"{bitrate}k", "-maxrate", f"{bitrate * 3 // 2}k", "-bufsize", f"{bitrate * 2}k",
+            *keyframes,
+            "-c:a", "aac", "-b:a", f"{AUDIO_BITRATE_KBPS}k",
+            "-movflags", "+faststart", str(path)
+        ))
+        mp4s.append((size, bitrate, target))
+
+    webm_size, webm_bitrate, _ = max((m for m in mp4s if m[0] <= WEBM_MAX_SIZE), default=mp4s[0])
+    webm = output(f"{webm_size}p.webm")
+    _write_once(webm, lambda path: _ffmpeg(
+        "-i", str(source), "-map", "0:v:0", *audio_map,
+        "-vf", _scale(width, height, webm_size),
+        "-c:v", "libvpx-vp9", "-b:v", f"{webm_bitrate}k", "-deadline", "good", "-cpu-used", "4",
+        "-row-mt", "1",
+        "-c:a", "libopus", "-b:a", f"{AUDIO_BITRATE_KBPS}k", str(path)
+    ))
+
+    streams = []
+    if hls:
+        # HLS: the MP4s cut into segments without re-encoding, plus a master
+        # playlist listing them. A playlist is only renamed into place once
+        # its segments are written.
+        master = output("hls.m3u8")
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3"]
+        for size, bitrate, mp4 in mp4s:
+            playlist = output(f"hls_{size}p.m3u8")
+            _write_once(playlist, lambda path: _ffmpeg(
+                "-i", str(mp4), "-c", "copy", "-f", "hls",
+                "-hls_time", str(HLS_SEGMENT_SECONDS), "-hls_playlist_type", "vod",
+                "-hls_segment_filename", str(output(f"hls_{size}p_%05d.ts")), str(path)
+            ))
+            rendition_width, rendition_height = _output_size(mp4)
+            lines.append(
+                f"#EXT-X-STREAM-INF:BANDWIDTH={(bitrate + AUDIO_BITRATE_KBPS) * 1000},"
+                f"RESOLUTION={rendition_width}x{rendition_height}"
+            )
+            lines.append(playlist.name)
+        _write_once(master, lambda path: path.write_text("\n".join(lines) + "\n"))
+        streams.append({"filename": master.name, "format": "hls", "height": None, "bitrate": None})
+
+    files = sorted(path.name for path in source.parent.glob(f"{source.stem}_*"))
+    streams += [
+        {"filename": mp4.name, "format": "mp4", "height": size, "bitrate": bitrate}
+        for size, bitrate, mp4 in mp4s
+    ]
+    streams.append({"filename": webm.name, "format": "webm", "height": webm_size, "bitrate": webm_bitrate})
+    return {
+        "variants": [],
+        "files": files,
+        "poster": poster.name,
+        "streams": streams,
+        **describe_image(poster),
+        "width": width,
+        "height": height,
+    }
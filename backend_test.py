@@ -8,6 +8,10 @@ import requests
 import json
 import sys
 import os
+import hashlib
+import struct
+import uuid
+import zlib
 from datetime import datetime
 
 # Get backend URL from frontend .env file
@@ -50,6 +54,37 @@ class TestResults:
         print(f"{'='*60}")
         return len(self.errors) == 0
 
+def make_png(width=96, height=96):
+    """A solid PNG in a color picked at random, so every run uploads new content"""
+    color = os.urandom(3)
+    rows = b"".join(b"\x00" + color * width for _ in range(height))
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows))
+            + chunk(b"IEND", b""))
+
+def create_scratch_project(token, title):
+    """A project for one test to upload into; deleted by the test"""
+    headers = {"Authorization": f"Bearer {token}"}
+    response = requests.post(f"{API_URL}/projects", json={"title": title}, headers=headers, timeout=10)
+    response.raise_for_status()
+    return response.json()["id"]
+
+def upload_file(token, project_id, filename, data, content_type="image/png"):
+    headers = {"Authorization": f"Bearer {token}"}
+    return requests.post(
+        f"{API_URL}/projects/{project_id}/media",
+        files={"file": (filename, data, content_type)},
+        headers=headers,
+        timeout=30
+    )
+
+def delete_project(token, project_id):
+    headers = {"Authorization": f"Bearer {token}"}
+    return requests.delete(f"{API_URL}/projects/{project_id}", headers=headers, timeout=10)
+
 def test_health_check(results):
     """Test 1: Health Check"""
     try:
@@ -572,6 +607,351 @@ def test_settings_persistence(results):
         results.log_fail("Settings Persistence", f"Error: {str(e)}")
     return False
 
+def test_metrics(results):
+    """Test 17: Metrics Export"""
+    try:
+        token = os.environ.get("METRICS_TOKEN")
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        response = requests.get(f"{API_URL}/metrics", headers=headers, timeout=10)
+        
+        if response.status_code == 200:
+            if not response.headers.get("content-type", "").startswith("text/plain; version=0.0.4"):
+                results.log_fail("Metrics", f"Unexpected content type: {response.headers.get('content-type')}")
+                return False
+            
+            # The requests made by the earlier tests are counted by route template
+            expected_lines = [
+                '# TYPE http_request_duration_seconds histogram',
+                'http_requests_total{method="GET",route="/api/health",status="200"}',
+                'http_request_duration_seconds_bucket{method="GET",route="/api/projects/{project_id}",le="+Inf"}',
+                'http_requests_in_flight{method="GET",route="/api/metrics"} 1',
+                '# TYPE mongodb_command_duration_seconds histogram',
+                'mongodb_command_duration_seconds_count{collection="users",command="find"}',
+            ]
+            missing = [line for line in expected_lines if line not in response.text]
+            if missing:
+                results.log_fail("Metrics", f"Missing from the export: {missing}")
+                return False
+            results.log_pass("Metrics - Routes and Mongo Commands Exported")
+            return True
+        else:
+            results.log_fail("Metrics", f"Status code: {response.status_code}, Response: {response.text}")
+    except Exception as e:
+        results.log_fail("Metrics", f"Error: {str(e)}")
+    return False
+
+def test_upload_content_check(results, token):
+    """Test 18: Uploads Are Checked Against Their Extension"""
+    if not token:
+        results.log_fail("Upload Content Check", "No authentication token available")
+        return False
+    
+    project_id = None
+    try:
+        project_id = create_scratch_project(token, "Upload Content Check")
+        
+        # Text under a .png name is refused before it is stored
+        response = upload_file(token, project_id, "fake.png", b"definitely not an image " * 20)
+        if response.status_code != 400 or "does not match" not in response.json().get("detail", ""):
+            results.log_fail("Upload Content Check", f"Expected 400 for a fake PNG, got {response.status_code}: {response.text}")
+            return False
+        
+        response = upload_file(token, project_id, "real.png", make_png())
+        if response.status_code != 200 or response.json().get("type") != "image":
+            results.log_fail("Upload Content Check", f"Real PNG rejected: {response.status_code}: {response.text}")
+            return False
+        
+        media = requests.get(f"{API_URL}/projects/{project_id}", timeout=10).json()["media"]
+        if len(media) != 1:
+            results.log_fail("Upload Content Check", f"Expected only the real PNG in the project, got {len(media)} items")
+            return False
+        results.log_pass("Upload Content Check - Fake PNG Rejected, Real PNG Stored")
+        return True
+    except Exception as e:
+        results.log_fail("Upload Content Check", f"Error: {str(e)}")
+    finally:
+        if project_id:
+            delete_project(token, project_id)
+    return False
+
+def test_resumable_upload(results, token):
+    """Test 19: Resumable Upload"""
+    if not token:
+        results.log_fail("Resumable Upload", "No authentication token available")
+        return False
+    
+    project_id = None
+    try:
+        headers = {"Authorization": f"Bearer {token}"}
+        project_id = create_scratch_project(token, "Resumable Upload")
+        data = make_png()
+        half = len(data) // 2
+        
+        response = requests.post(
+            f"{API_URL}/projects/{project_id}/uploads",
+            json={"filename": "resumed.png", "size": len(data)},
+            headers=headers,
+            timeout=10
+        )
+        if response.status_code != 200:
+            results.log_fail("Resumable Upload", f"Create - Status code: {response.status_code}, Response: {response.text}")
+            return False
+        upload_url = f"{API_URL}/projects/{project_id}/uploads/{response.json()['id']}"
+        
+        response = requests.patch(upload_url, data=data[:half], headers={**headers, "Upload-Offset": "0"}, timeout=10)
+        if response.status_code != 200 or response.json()["offset"] != half:
+            results.log_fail("Resumable Upload", f"First chunk - Status code: {response.status_code}, Response: {response.text}")
+            return False
+        
+        # Resending from the wrong offset is refused with the offset to resume from
+        response = requests.patch(upload_url, data=data[:half], headers={**headers, "Upload-Offset": "0"}, timeout=10)
+        if response.status_code != 409 or response.headers.get("Upload-Offset") != str(half):
+            results.log_fail("Resumable Upload", f"Expected 409 with Upload-Offset {half}, got {response.status_code} {response.headers.get('Upload-Offset')}")
+            return False
+        
+        response = requests.get(upload_url, headers=headers, timeout=10)
+        if response.status_code != 200 or response.json()["offset"] != half:
+            results.log_fail("Resumable Upload", f"Status - Status code: {response.status_code}, Response: {response.text}")
+            return False
+        
+        response = requests.patch(upload_url, data=data[half:], headers={**headers, "Upload-Offset": str(half)}, timeout=10)
+        media = response.json().get("media") if response.status_code == 200 else None
+        if not media:
+            results.log_fail("Resumable Upload", f"Last chunk - Status code: {response.status_code}, Response: {response.text}")
+            return False
+        
+        # The file is named by the hash of the whole upload, and holds it
+        digest = hashlib.sha256(data).hexdigest()
+        if not media["url"].endswith(f"/{digest}.png"):
+            results.log_fail("Resumable Upload", f"URL does not name the content hash {digest}: {media['url']}")
+            return False
+        file_response = requests.get(f"{BASE_URL}{media['url']}", timeout=10)
+        if file_response.status_code != 200 or file_response.content != data:
+            results.log_fail("Resumable Upload", f"Stored file differs - Status code: {file_response.status_code}")
+            return False
+        results.log_pass("Resumable Upload - Chunks, Offset Conflict and Content Hash")
+        return True
+    except Exception as e:
+        results.log_fail("Resumable Upload", f"Error: {str(e)}")
+    finally:
+        if project_id:
+            delete_project(token, project_id)
+    return False
+
+def test_shared_upload_deletion(results, token):
+    """Test 20: Shared Uploads Are Kept Until Their Last User Is Deleted"""
+    if not token:
+        results.log_fail("Shared Upload Deletion", "No authentication token available")
+        return False
+    
+    project_ids = []
+    try:
+        data = make_png()
+        urls = []
+        for title in ("Shared Upload A", "Shared Upload B"):
+            project_ids.append(create_scratch_project(token, title))
+            response = upload_file(token, project_ids[-1], "shared.png", data)
+            if response.status_code != 200:
+                results.log_fail("Shared Upload Deletion", f"Upload - Status code: {response.status_code}, Response: {response.text}")
+                return False
+            urls.append(response.json()["url"])
+        
+        # The same bytes are stored once
+        if urls[0] != urls[1]:
+            results.log_fail("Shared Upload Deletion", f"Same content stored under two URLs: {urls}")
+            return False
+        file_url = f"{BASE_URL}{urls[0]}"
+        
+        delete_project(token, project_ids.pop(0)).raise_for_status()
+        # An object store answers with a redirect to the object
+        response = requests.get(file_url, allow_redirects=False, timeout=10)
+        if response.status_code not in (200, 302):
+            results.log_fail("Shared Upload Deletion", f"File gone while still used: {response.status_code}")
+            return False
+        
+        delete_project(token, project_ids.pop(0)).raise_for_status()
+        response = requests.get(file_url, allow_redirects=False, timeout=10)
+        if response.status_code == 302:
+            results.log_pass("Shared Upload Deletion - Kept While Used (object store, removal not checked)")
+            return True
+        if response.status_code != 404:
+            results.log_fail("Shared Upload Deletion", f"File kept after its last user was deleted: {response.status_code}")
+            return False
+        results.log_pass("Shared Upload Deletion - Kept While Used, Removed After")
+        return True
+    except Exception as e:
+        results.log_fail("Shared Upload Deletion", f"Error: {str(e)}")
+    finally:
+        for project_id in project_ids:
+            delete_project(token, project_id)
+    return False
+
+def test_cursor_pagination(results, token):
+    """Test 21: Cursor Pagination"""
+    if not token:
+        results.log_fail("Cursor Pagination", "No authentication token available")
+        return False
+    
+    project_ids = []
+    try:
+        headers = {"Authorization": f"Bearer {token}"}
+        for i in range(3):
+            project_ids.append(create_scratch_project(token, f"Pagination {i}"))
+        
+        # Follow X-Next-Cursor two projects at a time, on the public list
+        # (new projects are published) and the admin one
+        for path, list_headers in (("/projects", {}), ("/admin/projects", headers)):
+            seen = []
+            cursor = None
+            while True:
+                params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+                response = requests.get(f"{API_URL}{path}", params=params, headers=list_headers, timeout=10)
+                if response.status_code != 200 or len(response.json()) > 2:
+                    results.log_fail("Cursor Pagination", f"{path} - Status code: {response.status_code}, Response: {response.text}")
+                    return False
+                seen.extend(project["id"] for project in response.json())
+                cursor = response.headers.get("X-Next-Cursor")
+                if not cursor:
+                    break
+                if 'rel="next"' not in response.headers.get("Link", ""):
+                    results.log_fail("Cursor Pagination", f"{path} - X-Next-Cursor without a Link header: {response.headers}")
+                    return False
+            
+            if len(seen) != len(set(seen)) or not set(project_ids) <= set(seen):
+                results.log_fail("Cursor Pagination", f"{path} - Pages repeat or miss projects: {seen}")
+                return False
+        
+        response = requests.get(f"{API_URL}/projects", params={"cursor": "not-a-cursor"}, timeout=10)
+        if response.status_code != 400:
+            results.log_fail("Cursor Pagination", f"Expected 400 for a bad cursor, got {response.status_code}")
+            return False
+        results.log_pass("Cursor Pagination - Pages Cover Every Project Once")
+        return True
+    except Exception as e:
+        results.log_fail("Cursor Pagination", f"Error: {str(e)}")
+    finally:
+        for project_id in project_ids:
+            delete_project(token, project_id)
+    return False
+
+def test_conditional_get(results):
+    """Test 22: Conditional GET"""
+    try:
+        for path in ("/projects", "/settings", "/bootstrap"):
+            response = requests.get(f"{API_URL}{path}", timeout=10)
+            etag = response.headers.get("ETag")
+            if response.status_code != 200 or not etag:
+                results.log_fail("Conditional GET", f"{path} - Status code: {response.status_code}, ETag: {etag}")
+                return False
+            
+            response = requests.get(f"{API_URL}{path}", headers={"If-None-Match": etag}, timeout=10)
+            if response.status_code != 304 or response.content:
+                results.log_fail("Conditional GET", f"{path} - Expected an empty 304, got {response.status_code}")
+                return False
+            
+            response = requests.get(f"{API_URL}{path}", headers={"If-None-Match": '"stale"'}, timeout=10)
+            if response.status_code != 200:
+                results.log_fail("Conditional GET", f"{path} - Expected 200 for a stale ETag, got {response.status_code}")
+                return False
+        results.log_pass("Conditional GET - 304 for Matching ETags")
+        return True
+    except Exception as e:
+        results.log_fail("Conditional GET", f"Error: {str(e)}")
+    return False
+
+def test_login_throttle_and_token_cache(results, token):
+    """Test 23: Login Throttle and Token Checks"""
+    try:
+        # An unknown username, so the admin's own counter is untouched; the
+        # failures still count towards this address's limit of 20 per 15
+        # minutes unless the server trusts X-Forwarded-For
+        username = f"throttle-{uuid.uuid4().hex[:8]}"
+        headers = {"X-Forwarded-For": f"10.{os.urandom(1)[0]}.{os.urandom(1)[0]}.{os.urandom(1)[0]}"}
+        login_data = {"username": username, "password": "wrong-password"}
+        for attempt in range(5):
+            response = requests.post(f"{API_URL}/auth/login", json=login_data, headers=headers, timeout=10)
+            if response.status_code != 401:
+                results.log_fail("Login Throttle", f"Attempt {attempt + 1} - Expected 401, got {response.status_code}")
+                return False
+        
+        response = requests.post(f"{API_URL}/auth/login", json=login_data, headers=headers, timeout=10)
+        if response.status_code != 429 or not response.headers.get("Retry-After"):
+            results.log_fail("Login Throttle", f"Expected 429 with Retry-After, got {response.status_code}")
+            return False
+        
+        # Another username from the same address isn't locked out
+        response = requests.post(f"{API_URL}/auth/login", json={"username": "admin", "password": "admin123"},
+                                 headers=headers, timeout=10)
+        if response.status_code != 200:
+            results.log_fail("Login Throttle", f"Admin locked out by another username: {response.status_code}")
+            return False
+        results.log_pass("Login Throttle - 429 After 5 Failures for One Username")
+    except Exception as e:
+        results.log_fail("Login Throttle", f"Error: {str(e)}")
+        return False
+    
+    if not token:
+        results.log_fail("Token Checks", "No authentication token available")
+        return False
+    try:
+        # Verified tokens are cached; a changed signature must still fail
+        for _ in range(2):
+            response = requests.get(f"{API_URL}/admin/projects", headers={"Authorization": f"Bearer {token}"}, timeout=10)
+            if response.status_code != 200:
+                results.log_fail("Token Checks", f"Valid token refused: {response.status_code}")
+                return False
+        
+        tampered = token[:-2] + ("AA" if token[-2:] != "AA" else "BB")
+        response = requests.get(f"{API_URL}/admin/projects", headers={"Authorization": f"Bearer {tampered}"}, timeout=10)
+        if response.status_code != 401:
+            results.log_fail("Token Checks", f"Expected 401 for a tampered token, got {response.status_code}")
+            return False
+        results.log_pass("Token Checks - Valid Token Reused, Tampered Token Refused")
+        return True
+    except Exception as e:
+        results.log_fail("Token Checks", f"Error: {str(e)}")
+    return False
+
+def test_resized_images(results, token):
+    """Test 24: Resized Images"""
+    if not token:
+        results.log_fail("Resized Images", "No authentication token available")
+        return False
+    
+    project_id = None
+    try:
+        project_id = create_scratch_project(token, "Resized Images")
+        response = upload_file(token, project_id, "resize.png", make_png())
+        if response.status_code != 200:
+            results.log_fail("Resized Images", f"Upload - Status code: {response.status_code}, Response: {response.text}")
+            return False
+        image_url = f"{API_URL}/img/{response.json()['url'].split('/uploads/', 1)[1]}"
+        
+        response = requests.get(image_url, params={"h": 64}, timeout=30)
+        if response.status_code != 200 or response.headers.get("content-type") != "image/webp":
+            results.log_fail("Resized Images", f"h=64 - Status code: {response.status_code}, Type: {response.headers.get('content-type')}")
+            return False
+        
+        # Only whitelisted sizes are rendered
+        for params in ({"h": 65}, {"w": 5000}, {}):
+            response = requests.get(image_url, params=params, timeout=10)
+            if response.status_code != 400:
+                results.log_fail("Resized Images", f"Expected 400 for {params}, got {response.status_code}")
+                return False
+        
+        response = requests.get(f"{API_URL}/img/00/00/{'0' * 64}.png", params={"h": 64}, timeout=10)
+        if response.status_code != 404:
+            results.log_fail("Resized Images", f"Expected 404 for a missing upload, got {response.status_code}")
+            return False
+        results.log_pass("Resized Images - Whitelisted Sizes Only")
+        return True
+    except Exception as e:
+        results.log_fail("Resized Images", f"Error: {str(e)}")
+    finally:
+        if project_id:
+            delete_project(token, project_id)
+    return False
+
 def main():
     print("🚀 Starting Photography Portfolio Backend API Tests")
     print(f"Backend URL: {BASE_URL}")
@@ -630,6 +1010,30 @@ def main():
     # Test 16: Verify Settings Persistence
     test_settings_persistence(results)
     
+    # Test 17: Metrics Export
+    test_metrics(results)
+    
+    # Test 18: Uploads Are Checked Against Their Extension
+    test_upload_content_check(results, token)
+    
+    # Test 19: Resumable Upload
+    test_resumable_upload(results, token)
+    
+    # Test 20: Shared Uploads Are Kept Until Their Last User Is Deleted
+    test_shared_upload_deletion(results, token)
+    
+    # Test 21: Cursor Pagination
+    test_cursor_pagination(results, token)
+    
+    # Test 22: Conditional GET
+    test_conditional_get(results)
+    
+    # Test 23: Login Throttle and Token Checks
+    test_login_throttle_and_token_cache(results, token)
+    
+    # Test 24: Resized Images
+    test_resized_images(results, token)
+    
     # Final Summary
     success = results.summary()
     return success
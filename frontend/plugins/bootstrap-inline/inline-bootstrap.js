@@ -0,0 +1,44 @@
+// inline-bootstrap.js
+// Inlines GET /api/bootstrap into build/index.html after the build, so the
+// public site renders settings, projects and featured media without waiting
+// for the API. Enabled with INLINE_BOOTSTRAP=true. The app fetches a fresh
+// copy after its first render anyway, so a failed fetch only logs a warning.
+
+const fs = require('fs');
+const path = require('path');
+require('dotenv').config();
+
+const INDEX_HTML = path.resolve(__dirname, '../../build/index.html');
+const SCRIPT_ID = 'bootstrap-data';
+
+// The JSON must not be able to close the <script> element it sits in
+const escapeForScript = (json) => json.replace(/</g, '\\u003c');
+
+async function inlineBootstrap() {
+  if (process.env.INLINE_BOOTSTRAP !== 'true') {
+    return;
+  }
+
+  const url = `${process.env.REACT_APP_BACKEND_URL}/api/bootstrap`;
+  let payload;
+  try {
+    const response = await fetch(url);
+    if (!response.ok) {
+      throw new Error(`HTTP ${response.status}`);
+    }
+    payload = JSON.stringify(await response.json());
+  } catch (error) {
+    console.warn(`[Bootstrap Inline] Could not fetch ${url}, index.html left as is: ${error.message}`);
+    return;
+  }
+
+  const tag = `<script id="${SCRIPT_ID}" type="application/json">${escapeForScript(payload)}</script>`;
+  const html = fs.readFileSync(INDEX_HTML, 'utf8')
+    // From an earlier run over the same build
+    .replace(new RegExp(`<script id="${SCRIPT_ID}"[^>]*>[\\s\\S]*?</script>`), '')
+    .replace('</head>', () => `${tag}</head>`);
+  fs.writeFileSync(INDEX_HTML, html);
+  console.log(`[Bootstrap Inline] Inlined ${payload.length} bytes from ${url}`);
+}
+
+inlineBootstrap();
@@ -1,13 +1,16 @@
 import React, { useState, useEffect } from 'react';
 import { Link, useLocation } from 'react-router-dom';
 import { Menu, X } from 'lucide-react';
-import { projectAPI, settingsAPI } from '../services/api';
+import { bootstrapAPI } from '../services/api';
+import { resizedImage } from '../lib/utils';
 
 const Sidebar = ({ onInfoClick, isMobileMenuOpen, setIsMobileMenuOpen }) => {
   const location = useLocation();
-  const [projects, setProjects] = useState([]);
-  const [loading, setLoading] = useState(true);
-  const [settings, setSettings] = useState({ brand_name: 'Your Name', logo_url: '' });
+  // Rendered right away from the copy inlined at build time, if any
+  const inlined = bootstrapAPI.getInlined();
+  const [projects, setProjects] = useState(inlined?.projects || []);
+  const [loading, setLoading] = useState(!inlined);
+  const [settings, setSettings] = useState(inlined?.settings || { brand_name: 'Your Name', logo_url: '' });
 
   useEffect(() => {
     loadData();
@@ -15,12 +18,9 @@ const Sidebar = ({ onInfoClick, isMobileMenuOpen, setIsMobileMenuOpen }) => {
 
   const loadData = async () => {
     try {
-      const [projectsData, settingsData] = await Promise.all([
-        projectAPI.getAll(),
-        settingsAPI.get()
-      ]);
-      setProjects(projectsData);
-      setSettings(settingsData);
+      const data = await bootstrapAPI.get();
+      setProjects(data.projects);
+      setSettings(data.settings);
     } catch (error) {
       console.error('Error loading data:', error);
     } finally {
@@ -52,7 +52,7 @@ const Sidebar = ({ onInfoClick, isMobileMenuOpen, setIsMobileMenuOpen }) => {
         <Link to="/" onClick={() => setIsMobileMenuOpen(false)}>
           {settings.logo_url ? (
             <img 
-              src={`${process.env.REACT_APP_BACKEND_URL}${settings.logo_url}`} 
+              {...resizedImage(settings.logo_url, 32)}
               alt={settings.brand_name}
               className="h-8 object-contain"
             />
@@ -77,7 +77,7 @@ const Sidebar = ({ onInfoClick, isMobileMenuOpen, setIsMobileMenuOpen }) => {
           <Link to="/" className="block mb-12">
             {settings.logo_url ? (
               <img 
-                src={`${process.env.REACT_APP_BACKEND_URL}${settings.logo_url}`} 
+                {...resizedImage(settings.logo_url, 48)}
                 alt={settings.brand_name}
                 className="h-12 object-contain"
               />
@@ -129,7 +129,7 @@ const Sidebar = ({ onInfoClick, isMobileMenuOpen, setIsMobileMenuOpen }) => {
           <Link to="/" className="block mb-8">
             {settings.logo_url ? (
               <img 
-                src={`${process.env.REACT_APP_BACKEND_URL}${settings.logo_url}`} 
+                {...resizedImage(settings.logo_url, 40)}
                 alt={settings.brand_name}
                 className="h-10 object-contain"
               />
@@ -188,7 +188,7 @@ const Sidebar = ({ onInfoClick, isMobileMenuOpen, setIsMobileMenuOpen }) => {
           <div className="flex items-center justify-between p-6">
             {settings.logo_url ? (
               <img 
-                src={`${process.env.REACT_APP_BACKEND_URL}${settings.logo_url}`} 
+                {...resizedImage(settings.logo_url, 32)}
                 alt={settings.brand_name}
                 className="h-8 object-contain"
               />
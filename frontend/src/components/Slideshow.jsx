@@ -1,6 +1,85 @@
 import React, { useState, useEffect } from 'react';
 import { ChevronLeft, ChevronRight } from 'lucide-react';
 
+// Intrinsic size, dominant color and a blurred placeholder from the API, so
+// a slide has its final shape and rough look before the image arrives
+const placeholderProps = (media) => ({
+  width: media.width || undefined,
+  height: media.height || undefined,
+  onLoad: (e) => {
+    e.currentTarget.style.backgroundImage = 'none';
+    e.currentTarget.style.backgroundColor = 'transparent';
+  },
+  style: {
+    backgroundColor: media.color || undefined,
+    backgroundImage: media.placeholder ? `url(${media.placeholder})` : undefined,
+    backgroundSize: 'cover',
+    userSelect: 'none',
+    pointerEvents: 'none',
+  },
+});
+
+// Displayed width of a slide: the whole screen on mobile, the slideshow
+// column less its padding on tablet (lg) and desktop (xl)
+const SLIDE_SIZES = '(min-width: 1280px) 56vw, (min-width: 1024px) 45vw, 100vw';
+
+// The resized copies the media job wrote (media.variants) as srcSet
+// candidates: WebP for browsers that take it, JPEG or PNG otherwise. The
+// original stays the largest candidate when its width is known.
+const SlideImage = ({ media, className }) => {
+  const backendUrl = (url) => `${process.env.REACT_APP_BACKEND_URL}${url}`;
+  const original = media.width ? [`${backendUrl(media.url)} ${media.width}w`] : [];
+  const srcSet = (formats) => {
+    const candidates = (media.variants || [])
+      .filter((variant) => formats.includes(variant.format) && variant.width < (media.width || Infinity))
+      .map((variant) => `${backendUrl(variant.url)} ${variant.width}w`);
+    return candidates.length ? [...candidates, ...original].join(', ') : undefined;
+  };
+  const webp = srcSet(['webp']);
+
+  const image = (
+    <img
+      src={backendUrl(media.url)}
+      srcSet={srcSet(['jpeg', 'png'])}
+      sizes={SLIDE_SIZES}
+      alt={media.alt}
+      className={className}
+      {...placeholderProps(media)}
+    />
+  );
+  if (!webp) return image;
+  return (
+    <picture className="contents">
+      <source type="image/webp" srcSet={webp} sizes={SLIDE_SIZES} />
+      {image}
+    </picture>
+  );
+};
+
+const STREAM_TYPES = {
+  hls: 'application/vnd.apple.mpegurl',
+  webm: 'video/webm',
+  mp4: 'video/mp4',
+};
+
+// Transcoded renditions in the order browsers should try them: HLS (played
+// natively by Safari and mobile browsers), then WebM, then the largest MP4
+// up to 720p, then the original upload
+const videoSources = (media) => {
+  const streams = media.streams || [];
+  const mp4 = streams
+    .filter((stream) => stream.format === 'mp4' && stream.height <= 720)
+    .sort((a, b) => b.height - a.height)[0];
+  return [
+    ...streams.filter((stream) => stream.format === 'hls' || stream.format === 'webm'),
+    ...(mp4 ? [mp4] : []),
+    { url: media.url },
+  ].map((stream) => ({
+    src: `${process.env.REACT_APP_BACKEND_URL}${stream.url}`,
+    type: STREAM_TYPES[stream.format],
+  }));
+};
+
 const Slideshow = ({ media, projectInfo }) => {
   const [currentIndex, setCurrentIndex] = useState(0);
   const [cursorSide, setCursorSide] = useState('left');
@@ -98,22 +177,27 @@ const Slideshow = ({ media, projectInfo }) => {
             style={{ cursor: currentMedia.type === 'video' ? 'default' : (isMobile ? 'default' : 'none'), height: '70vh', width: '100vw' }}
           >
             {currentMedia.type === 'image' ? (
-              <img
-                src={`${process.env.REACT_APP_BACKEND_URL}${currentMedia.url}`}
-                alt={currentMedia.alt}
+              <SlideImage
+                key={currentMedia.url}
+                media={currentMedia}
                 className="w-auto h-auto max-h-full max-w-full object-contain"
-                style={{ userSelect: 'none', pointerEvents: 'none' }}
               />
             ) : (
               <video
-                src={`${process.env.REACT_APP_BACKEND_URL}${currentMedia.url}`}
+                key={currentMedia.url}
+                poster={currentMedia.poster ? `${process.env.REACT_APP_BACKEND_URL}${currentMedia.poster}` : undefined}
                 className="w-auto h-auto max-h-full max-w-full object-contain"
                 autoPlay
                 muted
                 loop
                 controls
+                playsInline
                 style={{ userSelect: 'none' }}
-              />
+              >
+                {videoSources(currentMedia).map((source) => (
+                  <source key={source.src} src={source.src} type={source.type} />
+                ))}
+              </video>
             )}
           </div>
 
@@ -224,22 +308,27 @@ const Slideshow = ({ media, projectInfo }) => {
               {/* Image */}
               <div className="flex items-center justify-center" style={{ flex: '1' }}>
                 {currentMedia.type === 'image' ? (
-                  <img
-                    src={`${process.env.REACT_APP_BACKEND_URL}${currentMedia.url}`}
-                    alt={currentMedia.alt}
+                  <SlideImage
+                    key={currentMedia.url}
+                    media={currentMedia}
                     className="w-auto object-contain max-h-[70vh] max-w-full"
-                    style={{ userSelect: 'none', pointerEvents: 'none' }}
                   />
                 ) : (
                   <video
-                    src={`${process.env.REACT_APP_BACKEND_URL}${currentMedia.url}`}
+                    key={currentMedia.url}
+                    poster={currentMedia.poster ? `${process.env.REACT_APP_BACKEND_URL}${currentMedia.poster}` : undefined}
                     className="w-auto object-contain max-h-[70vh] max-w-full"
                     autoPlay
                     muted
                     loop
                     controls
+                    playsInline
                     style={{ userSelect: 'none' }}
-                  />
+                  >
+                    {videoSources(currentMedia).map((source) => (
+                      <source key={source.src} src={source.src} type={source.type} />
+                    ))}
+                  </video>
                 )}
               </div>
 
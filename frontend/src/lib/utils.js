@@ -4,3 +4,10 @@ import { twMerge } from "tailwind-merge"
 export function cn(...inputs) {
   return twMerge(clsx(inputs));
 }
+
+// An upload resized by the backend (/api/img), at 1x and 2x for srcSet.
+// Heights must be ones the backend allows (see backend/image_cache.py).
+export function resizedImage(url, height) {
+  const resized = (h) => `${process.env.REACT_APP_BACKEND_URL}${url.replace('/api/uploads/', '/api/img/')}?h=${h}`;
+  return { src: resized(height), srcSet: `${resized(height)} 1x, ${resized(height * 2)} 2x` };
+}
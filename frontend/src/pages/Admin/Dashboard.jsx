@@ -160,7 +160,7 @@ const Dashboard = () => {
                               {project.client} • {project.date} • {project.location}
                             </p>
                             <p className="text-sm text-gray-400 mt-1">
-                              {project.media.length} media items
+                              {project.media_count} media items
                               {project.featured && ' • Featured'}
                               {!project.published && ' • DRAFT'}
                             </p>
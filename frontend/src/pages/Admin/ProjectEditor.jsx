@@ -10,6 +10,8 @@ import { ArrowLeft, Upload, Trash2, Image as ImageIcon, Video, Star, GripVertica
 import { toast } from '../../hooks/use-toast';
 import { DragDropContext, Droppable, Draggable } from '@hello-pangea/dnd';
 
+const RESUMABLE_UPLOAD_THRESHOLD = 20 * 1024 * 1024;
+
 const ProjectEditor = () => {
   const { id } = useParams();
   const navigate = useNavigate();
@@ -90,9 +92,57 @@ const ProjectEditor = () => {
 
     setUploading(true);
 
-    for (const file of files) {
+    // Large videos go through the resumable protocol so a dropped connection
+    // doesn't restart them (and so they are never read into memory whole to
+    // be hashed for a direct upload)
+    const isLargeVideo = (file) => file.type.startsWith('video/') && file.size > RESUMABLE_UPLOAD_THRESHOLD;
+
+    // With a storage bucket the other files go straight into it; otherwise
+    // they are uploaded through the API below
+    const remaining = files.filter(isLargeVideo);
+    let direct = true;
+    for (const file of files.filter(file => !isLargeVideo(file))) {
+      if (!direct) {
+        remaining.push(file);
+        continue;
+      }
+      let newMedia;
+      try {
+        newMedia = await mediaAPI.uploadDirect(projectId, file);
+      } catch (error) {
+        toast({ title: 'Error', description: `Failed to upload ${file.name}`, variant: 'destructive' });
+        continue;
+      }
+      if (newMedia === null) {
+        direct = false;
+        remaining.push(file);
+        continue;
+      }
+      setMedia(prev => [...prev, newMedia]);
+      toast({ title: 'Success', description: `${file.name} uploaded` });
+    }
+
+    const batchFiles = remaining.filter(file => !isLargeVideo(file));
+
+    if (batchFiles.length > 0) {
+      try {
+        const results = await mediaAPI.uploadBatch(projectId, batchFiles);
+        const uploaded = results.filter(result => result.media).map(result => result.media);
+        setMedia(prev => [...prev, ...uploaded]);
+        if (uploaded.length > 0) {
+          toast({ title: 'Success', description: `${uploaded.length} file(s) uploaded` });
+        }
+        results.filter(result => result.error).forEach(result => {
+          toast({ title: 'Error', description: `Failed to upload ${result.filename}: ${result.error}`, variant: 'destructive' });
+        });
+      } catch (error) {
+        toast({ title: 'Error', description: 'Failed to upload files', variant: 'destructive' });
+      }
+    }
+
+    for (const file of remaining.filter(isLargeVideo)) {
       try {
-        const newMedia = await mediaAPI.upload(projectId, file);
+        const newMedia = await mediaAPI.uploadResumable(projectId, file);
         setMedia(prev => [...prev, newMedia]);
         toast({ title: 'Success', description: `${file.name} uploaded` });
       } catch (error) {
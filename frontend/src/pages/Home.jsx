@@ -1,10 +1,30 @@
 import React, { useState, useEffect } from 'react';
 import Slideshow from '../components/Slideshow';
-import { featuredAPI } from '../services/api';
+import { bootstrapAPI } from '../services/api';
+
+const shuffle = (items) => {
+  const shuffled = [...items];
+  for (let i = shuffled.length - 1; i > 0; i--) {
+    const j = Math.floor(Math.random() * (i + 1));
+    [shuffled[i], shuffled[j]] = [shuffled[j], shuffled[i]];
+  }
+  return shuffled;
+};
+
+// A fresh copy of the same media keeps the order already on screen
+const inSameOrder = (current, fresh) => {
+  const byUrl = new Map(fresh.map((item) => [item.url, item]));
+  if (current.length !== fresh.length || !current.every((item) => byUrl.has(item.url))) {
+    return shuffle(fresh);
+  }
+  return current.map((item) => byUrl.get(item.url));
+};
 
 const Home = () => {
-  const [featuredImages, setFeaturedImages] = useState([]);
-  const [loading, setLoading] = useState(true);
+  const [featuredImages, setFeaturedImages] = useState(
+    () => shuffle(bootstrapAPI.getInlined()?.featured || [])
+  );
+  const [loading, setLoading] = useState(!bootstrapAPI.getInlined());
 
   useEffect(() => {
     loadFeaturedImages();
@@ -12,8 +32,8 @@ const Home = () => {
 
   const loadFeaturedImages = async () => {
     try {
-      const data = await featuredAPI.getAll();
-      setFeaturedImages(data);
+      const data = await bootstrapAPI.get();
+      setFeaturedImages((current) => inSameOrder(current, data.featured));
     } catch (error) {
       console.error('Error loading featured images:', error);
     } finally {
@@ -45,16 +45,22 @@ export const authAPI = {
   },
 };
 
+// Project lists are paginated; follow X-Next-Cursor until the last page
+const getAllPages = async (url) => {
+  const items = [];
+  let cursor = null;
+  do {
+    const response = await api.get(url, { params: cursor ? { cursor } : {} });
+    items.push(...response.data);
+    cursor = response.headers['x-next-cursor'];
+  } while (cursor);
+  return items;
+};
+
 export const projectAPI = {
-  getAll: async () => {
-    const response = await api.get('/projects');
-    return response.data;
-  },
+  getAll: async () => getAllPages('/projects'),
 
-  getAllAdmin: async () => {
-    const response = await api.get('/admin/projects');
-    return response.data;
-  },
+  getAllAdmin: async () => getAllPages('/admin/projects'),
 
   getById: async (id) => {
     const response = await api.get(`/projects/${id}`);
@@ -84,6 +90,16 @@ export const projectAPI = {
   },
 };
 
+// Reads the whole file into memory, so large videos are sent with
+// uploadResumable instead of uploadDirect
+const sha256Hex = async (file) => {
+  const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+  return Array.from(new Uint8Array(digest)).map((b) => b.toString(16).padStart(2, '0')).join('');
+};
+
+// Cleared once the backend says it stores uploads itself
+let directUploadsEnabled = true;
+
 export const mediaAPI = {
   upload: async (projectId, file) => {
     const formData = new FormData();
@@ -94,6 +110,80 @@ export const mediaAPI = {
     return response.data;
   },
 
+  // Many files in one request; returns [{ filename, media, error }] per file
+  uploadBatch: async (projectId, files) => {
+    const formData = new FormData();
+    files.forEach((file) => formData.append('files', file));
+    const response = await api.post(`/projects/${projectId}/media/batch`, formData, {
+      headers: { 'Content-Type': 'multipart/form-data' },
+    });
+    return response.data;
+  },
+
+  // Chunked upload that resumes from the last acknowledged offset when a
+  // chunk fails, instead of starting the whole file over
+  uploadResumable: async (projectId, file, { chunkSize = 8 * 1024 * 1024, maxRetries = 5 } = {}) => {
+    const { data: session } = await api.post(`/projects/${projectId}/uploads`, {
+      filename: file.name,
+      size: file.size,
+    });
+    const url = `/projects/${projectId}/uploads/${session.id}`;
+    let offset = session.offset;
+    let retries = 0;
+
+    while (offset < file.size) {
+      try {
+        const { data } = await api.patch(url, file.slice(offset, offset + chunkSize), {
+          headers: {
+            'Content-Type': 'application/offset+octet-stream',
+            'Upload-Offset': offset,
+          },
+        });
+        offset = data.offset;
+        retries = 0;
+        if (data.media) {
+          return data.media;
+        }
+      } catch (error) {
+        if (retries >= maxRetries || (error.response && error.response.status < 500 && error.response.status !== 409)) {
+          throw error;
+        }
+        retries += 1;
+        await new Promise((resolve) => setTimeout(resolve, 1000 * 2 ** retries));
+        const { data } = await api.get(url);
+        offset = data.offset;
+      }
+    }
+    throw new Error('Upload finished without creating media');
+  },
+
+  // Straight into the storage bucket, the API only signs the upload and
+  // records the media. Resolves to null when the backend has no bucket, so
+  // the caller can upload through the API instead.
+  uploadDirect: async (projectId, file) => {
+    if (!directUploadsEnabled) {
+      return null;
+    }
+    const upload = { filename: file.name, size: file.size, sha256: await sha256Hex(file) };
+    let target;
+    try {
+      ({ data: target } = await api.post(`/projects/${projectId}/direct-uploads`, upload));
+    } catch (error) {
+      if (error.response && error.response.status === 501) {
+        directUploadsEnabled = false;
+        return null;
+      }
+      throw error;
+    }
+    // Content the bucket already has isn't sent again
+    if (target.upload_url) {
+      // Plain axios, so the bucket doesn't get our Authorization header
+      await axios.put(target.upload_url, file, { headers: target.headers });
+    }
+    const response = await api.post(`/projects/${projectId}/direct-uploads/complete`, upload);
+    return response.data;
+  },
+
   delete: async (projectId, mediaId) => {
     const response = await api.delete(`/projects/${projectId}/media/${mediaId}`);
     return response.data;
@@ -112,6 +202,38 @@ export const mediaAPI = {
   },
 };
 
+// Settings, published projects and featured media in one request. Callers
+// that ask while a request is in flight share it. A copy may be inlined into
+// index.html at build time (plugins/bootstrap-inline) for the first render;
+// it can be stale, so callers still fetch a fresh one.
+let bootstrapRequest = null;
+let inlinedBootstrap;
+
+export const bootstrapAPI = {
+  getInlined: () => {
+    if (inlinedBootstrap === undefined) {
+      const element = document.getElementById('bootstrap-data');
+      try {
+        inlinedBootstrap = element ? JSON.parse(element.textContent) : null;
+      } catch (error) {
+        inlinedBootstrap = null;
+      }
+    }
+    return inlinedBootstrap;
+  },
+
+  get: () => {
+    if (!bootstrapRequest) {
+      bootstrapRequest = api.get('/bootstrap')
+        .then((response) => response.data)
+        .finally(() => {
+          bootstrapRequest = null;
+        });
+    }
+    return bootstrapRequest;
+  },
+};
+
 export const featuredAPI = {
   getAll: async () => {
     const response = await api.get('/featured');
@@ -0,0 +1,43 @@
+"""
+Every query shape in indexes.query_shapes is served by an index created by
+ensure_indexes, checked against an in-memory Mongo (no query planner, so
+from the indexes alone; `python indexes.py --check` explains them on a
+real server)
+
+    python -m pytest tests
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+import mongomock_motor
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+@pytest.mark.parametrize("layout", ["embedded", "collection"])
+def test_query_shapes_use_indexes(layout):
+    from indexes import ensure_indexes, unindexed_query_shapes
+    from media_store import media_store_for
+
+    async def check():
+        db = mongomock_motor.AsyncMongoMockClient()["portfolio_index_test"]
+        await ensure_indexes(db)
+        return await unindexed_query_shapes(db, media_store_for(db, layout))
+
+    assert asyncio.run(check()) == []
+
+def test_unindexed_shapes_are_reported():
+    from indexes import ensure_indexes, query_shapes, unindexed_query_shapes
+    from media_store import media_store_for
+
+    async def check():
+        db = mongomock_motor.AsyncMongoMockClient()["portfolio_index_test"]
+        await ensure_indexes(db)
+        await db.settings.drop_index("logo_url_1")
+        await db.media_jobs.drop_index("status_1_run_at_1")
+        await db.media_jobs.drop_index("status_1_lease_expires_at_1")
+        return await unindexed_query_shapes(db, media_store_for(db, "collection"))
+
+    assert set(asyncio.run(check())) == {"settings by logo", "claimable media job"}
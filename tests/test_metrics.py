@@ -0,0 +1,78 @@
+"""
+MetricsMiddleware: requests are counted by route template, and the CPU it
+adds per request stays within budget (backend_benchmark.py metrics_overhead
+measures the same thing at more length)
+
+    python -m pytest tests
+"""
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
+
+from metrics import MetricsMiddleware, http_requests
+
+# Same budget as the benchmark: a fraction of what a small route costs
+METRICS_OVERHEAD_BUDGET_SECONDS = 20e-6
+
+def make_app(with_metrics):
+    app = FastAPI(default_response_class=ORJSONResponse)
+
+    @app.get("/api/projects/{project_id}")
+    async def get_project(project_id: str):
+        return {"id": project_id}
+
+    if with_metrics:
+        app.add_middleware(MetricsMiddleware)
+    return app
+
+async def drive(app, count):
+    # Raw ASGI calls, so a client's own cost doesn't dilute the difference
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    for i in range(count):
+        await app({
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+            "method": "GET", "scheme": "http", "path": f"/api/projects/{i}", "raw_path": b"",
+            "root_path": "", "query_string": b"", "headers": [(b"host", b"test")],
+            "client": ("127.0.0.1", 1), "server": ("test", 80),
+        }, receive, send)
+
+def test_requests_are_counted_by_route():
+    route = "/api/projects/{project_id}"
+    before = http_requests.value("GET", route, "200")
+    asyncio.run(drive(make_app(True), 3))
+    assert http_requests.value("GET", route, "200") == before + 3
+
+def test_overhead_within_budget():
+    apps = {False: make_app(False), True: make_app(True)}
+    batch = 500
+
+    async def measure():
+        await drive(apps[False], batch)
+        await drive(apps[True], batch)
+        # Interleaved rounds, best of each, so drift in machine load cancels out
+        best = {False: float("inf"), True: float("inf")}
+        for _ in range(7):
+            for with_metrics, app in apps.items():
+                start = time.process_time()
+                await drive(app, batch)
+                best[with_metrics] = min(best[with_metrics], (time.process_time() - start) / batch)
+        return best
+
+    best = asyncio.run(measure())
+    overhead = best[True] - best[False]
+    assert overhead <= METRICS_OVERHEAD_BUDGET_SECONDS, (
+        f"metrics middleware adds {overhead * 1e6:.1f}us per request "
+        f"({best[False] * 1e6:.1f}us without it), budget {METRICS_OVERHEAD_BUDGET_SECONDS * 1e6:.0f}us"
+    )
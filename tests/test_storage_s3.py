@@ -0,0 +1,197 @@
+"""
+S3 storage backend and the direct-upload routes, against a moto bucket and
+an in-memory Mongo
+
+    python -m pytest tests
+"""
+
+import asyncio
+import base64
+import hashlib
+import io
+import os
+import sys
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import boto3
+import mongomock_motor
+import motor.motor_asyncio
+import pytest
+import requests
+from moto import mock_aws
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+BUCKET = "portfolio-media-test"
+REGION = "us-east-1"
+
+# Read when storage.py and server.py are imported; never real credentials
+os.environ.update({
+    "STORAGE_BACKEND": "s3",
+    "S3_BUCKET": BUCKET,
+    "S3_REGION": REGION,
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+})
+os.environ.pop("S3_ENDPOINT_URL", None)
+os.environ.pop("S3_PUBLIC_URL", None)
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "portfolio_storage_test")
+
+def png_bytes(color=(200, 30, 30), size=(64, 48)) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+@pytest.fixture
+def bucket():
+    with mock_aws():
+        boto3.client("s3", region_name=REGION).create_bucket(Bucket=BUCKET)
+        yield
+
+@pytest.fixture
+def storage(bucket):
+    from storage import S3Storage
+    return S3Storage(BUCKET, region=REGION)
+
+def object_keys(storage):
+    return sorted(item["Key"] for item in storage.client.list_objects_v2(Bucket=BUCKET).get("Contents", []))
+
+# ===== S3Storage =====
+
+def test_save_exists_size_and_read_head(storage, tmp_path):
+    data = png_bytes()
+    temp_path = tmp_path / "upload.part"
+    temp_path.write_bytes(data)
+    key = "ab/cd/abcd.png"
+
+    assert not asyncio.run(storage.exists(key))
+    assert asyncio.run(storage.size(key)) is None
+
+    asyncio.run(storage.save(temp_path, key))
+    assert not temp_path.exists()
+    assert asyncio.run(storage.exists(key))
+    assert asyncio.run(storage.size(key)) == len(data)
+    assert asyncio.run(storage.read_head(key, 8)) == data[:8]
+    head = storage.client.head_object(Bucket=BUCKET, Key=key)
+    assert head["ContentType"] == "image/png"
+    assert "immutable" in head["CacheControl"]
+
+    # Content-addressed keys hold the same bytes, so an existing object is
+    # kept and the temporary file is still consumed
+    temp_path.write_bytes(b"other bytes")
+    asyncio.run(storage.save(temp_path, key))
+    assert not temp_path.exists()
+    assert asyncio.run(storage.size(key)) == len(data)
+
+def test_flat_keys_are_stored_sharded(storage, tmp_path):
+    from utils import sharded_relative_path
+    temp_path = tmp_path / "upload.part"
+    temp_path.write_bytes(png_bytes())
+    asyncio.run(storage.save(temp_path, "older-upload.png"))
+    assert object_keys(storage) == [sharded_relative_path("older-upload.png")]
+    assert asyncio.run(storage.exists("older-upload.png"))
+
+def test_delete_with_derived(storage, tmp_path):
+    for key in ("ab/cd/abcd.png", "ab/cd/abcd_320w.webp", "ab/cd/abcd_poster.jpg", "ab/cd/abce.png"):
+        storage.client.put_object(Bucket=BUCKET, Key=key, Body=b"x")
+
+    asyncio.run(storage.delete_with_derived("ab/cd/abcd.png"))
+    assert object_keys(storage) == ["ab/cd/abce.png"]
+
+def test_presigned_upload_signs_length_and_checksum(storage):
+    data = png_bytes()
+    digest = hashlib.sha256(data).hexdigest()
+    url, headers = storage.presigned_upload("ab/cd/abcd.png", len(data), digest)
+
+    signed = parse_qs(urlparse(url).query)["X-Amz-SignedHeaders"][0].split(";")
+    assert {"content-length", "content-type", "x-amz-checksum-sha256"} <= set(signed)
+    assert headers["Content-Type"] == "image/png"
+    assert base64.b64decode(headers["x-amz-checksum-sha256"]) == bytes.fromhex(digest)
+
+    response = requests.put(url, data=data, headers=headers)
+    assert response.status_code == 200
+    assert storage.client.get_object(Bucket=BUCKET, Key="ab/cd/abcd.png")["Body"].read() == data
+
+# ===== Direct-upload routes =====
+
+@pytest.fixture
+def api(bucket):
+    # Mongo in memory; the app is used without its startup hooks, so no
+    # media worker or catalog runs and routes read Mongo directly
+    motor.motor_asyncio.AsyncIOMotorClient = mongomock_motor.AsyncMongoMockClient
+    import server
+    from auth import create_access_token
+    from fastapi.testclient import TestClient
+
+    client = TestClient(server.app)
+    client.headers["Authorization"] = f"Bearer {create_access_token({'sub': 'admin'})}"
+    return client
+
+def create_project(api) -> str:
+    response = api.post("/api/projects", json={"title": "Direct uploads"})
+    assert response.status_code == 200, response.text
+    return response.json()["id"]
+
+def test_direct_upload_put_then_complete(api):
+    project_id = create_project(api)
+    data = png_bytes()
+    upload = {"filename": "photo.png", "size": len(data), "sha256": hashlib.sha256(data).hexdigest()}
+
+    response = api.post(f"/api/projects/{project_id}/direct-uploads", json=upload)
+    assert response.status_code == 200, response.text
+    target = response.json()
+    assert target["upload_url"]
+
+    # Nothing in the bucket yet
+    response = api.post(f"/api/projects/{project_id}/direct-uploads/complete", json=upload)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "File has not been uploaded"
+
+    assert requests.put(target["upload_url"], data=data, headers=target["headers"]).status_code == 200
+
+    response = api.post(f"/api/projects/{project_id}/direct-uploads/complete", json=upload)
+    assert response.status_code == 200, response.text
+    media = response.json()
+    assert media["url"] == target["file_url"]
+    assert media["type"] == "image"
+    assert media["status"] == "pending"
+
+    # The same bytes again need no PUT
+    response = api.post(f"/api/projects/{project_id}/direct-uploads", json=upload)
+    assert response.status_code == 200
+    assert response.json() == {"file_url": target["file_url"], "upload_url": None, "headers": {}}
+
+def test_direct_upload_complete_rejects_mismatches(api):
+    project_id = create_project(api)
+    data = png_bytes(color=(10, 120, 240))
+    upload = {"filename": "photo.png", "size": len(data), "sha256": hashlib.sha256(data).hexdigest()}
+    target = api.post(f"/api/projects/{project_id}/direct-uploads", json=upload).json()
+    assert requests.put(target["upload_url"], data=data, headers=target["headers"]).status_code == 200
+
+    # A different checksum names different content, which was never uploaded
+    wrong_checksum = {**upload, "sha256": hashlib.sha256(data + b"!").hexdigest()}
+    response = api.post(f"/api/projects/{project_id}/direct-uploads/complete", json=wrong_checksum)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "File has not been uploaded"
+
+    wrong_size = {**upload, "size": len(data) + 1}
+    response = api.post(f"/api/projects/{project_id}/direct-uploads/complete", json=wrong_size)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Uploaded file size does not match"
+
+    # Bytes that aren't a PNG under a .png name
+    fake = b"not an image at all" * 10
+    fake_upload = {"filename": "fake.png", "size": len(fake), "sha256": hashlib.sha256(fake).hexdigest()}
+    target = api.post(f"/api/projects/{project_id}/direct-uploads", json=fake_upload).json()
+    assert requests.put(target["upload_url"], data=fake, headers=target["headers"]).status_code == 200
+    response = api.post(f"/api/projects/{project_id}/direct-uploads/complete", json=fake_upload)
+    assert response.status_code == 400
+    assert "does not match" in response.json()["detail"]
+
+    # None of them was added to the project
+    response = api.get(f"/api/projects/{project_id}")
+    assert response.status_code == 200
+    assert response.json()["media"] == []